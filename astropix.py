@@ -10,22 +10,44 @@ Maintained by: Amanda Steinhebel, amanda.l.steinhebel@nasa.gov
 from typing import Dict
 from core.spi import Spi 
 from core.nexysio import Nexysio
-from core.decode import Decode
+from core.decode import Decode, StreamDecoder
+from core.hitbatch import HitBatch
 from core.injectionboard import Injectionboard
 from core.voltageboard import Voltageboard
 from core.asic import Asic
 from bitstring import BitArray
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
+import functools
+import json
+import platform
+import subprocess
 import time
 import yaml
 import os
 
+from modules.rawdata import RUN_HEADER_VERSION
+
 # Logging stuff
 import logging
 from modules.setup_logger import logger
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=None)
+def software_version() -> dict:
+    """
+    Versions of this code (git describe, None outside a git checkout), Python and the main packages
+    """
+    try:
+        describe = subprocess.run(['git', 'describe', '--always', '--dirty', '--tags'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, timeout=5)
+        commit = describe.stdout.strip() if describe.returncode == 0 else None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'astropix': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+
 class astropixRun:
 
     # Init just opens the chip and gets the handle. After this runs
@@ -70,6 +92,10 @@ class astropixRun:
         self.chipversion = chipversion
         self.vcard_vdac = []
 
+        # Decoders are reused between readouts, keyed by (chip version, nchips, bytes per hit, sample clock period, rows, cols)
+        self._decoders = {}
+        self._stream_decoders = {}
+
 ##################### YAML INTERACTIONS #########################
 #reading done in core/asic.py
 #writing done here
@@ -88,6 +114,9 @@ class astropixRun:
             }
         }
 
+        if self.asic.layer_z is not None:
+            dicttofile[self.asic.chip]['telescope']['layer_z'] = self.asic.layer_z
+
         if self.asic.num_chips > 1:
             for chip in range(self.asic.num_chips):
                 dicttofile[self.asic.chip][f'config_{chip}'] = self.asic.asic_config[f'config_{chip}']
@@ -368,9 +397,9 @@ class astropixRun:
         else:
             return False
 
-    def get_log_header(self):
+    def _log_header_configs(self) -> dict:
         """
-        Returns header for use in a log file with all settings.
+        Settings of get_log_header by name
         """
         #Get config dictionaries from yaml
         vdacs=['thpmos', 'cardConf2','vcasc2', 'BL', 'cardConf5', 'cardConf6','vminuspix','thpix']
@@ -394,8 +423,49 @@ class astropixRun:
         for key in self.asic.asic_config['recconfig']:
                 arrayconfig[key]=self.asic.asic_config['recconfig'][key][1]
 
+        configs = {'Voltagecard': vcardconfig, 'Digital': digitalconfig, 'Biasblock': biasconfig, 'iDAC': idacconfig}
+        if self.chipversion>2:
+            configs['vDAC'] = vdacconfig
+        configs['Receiver'] = arrayconfig
+        return configs
+
+    def get_log_header(self):
+        """
+        Returns header for use in a log file with all settings.
+        """
+        configs = self._log_header_configs()
         # This is not a nice line, but its the most efficent way to get all the values in the same place.
-        return f"Voltagecard: {vcardconfig}\n" + f"Digital: {digitalconfig}\n" +f"Biasblock: {biasconfig}\n" + f"iDAC: {idacconfig}\n"+ f"vDAC: {vdacconfig}\n"+ f"Receiver: {arrayconfig}\n "
+        return ''.join(f"{name}: {config}\n" for name, config in configs.items()) + " "
+
+    def get_run_header(self, args = None) -> dict:
+        """
+        Returns the settings of get_log_header and everything else needed to redo the run as JSON compatible dict,
+        saved with the readouts by open_readout_log, see modules/rawdata.py RUN_HEADER_SUFFIX.
+
+        args - Command line arguments of the run, saved as dict
+        """
+        header = {
+            'version':          RUN_HEADER_VERSION,
+            'created':          time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'start_time':       time.time(),
+            'software':         software_version(),
+            'chip':             {'name': self.asic.chipname, 'version': self.chipversion, 'nchips': self.asic.num_chips,
+                                 'cols': self.asic.num_cols, 'rows': self.asic.num_rows},
+            'config':           self._log_header_configs(),
+            'asic_config':      self.asic.asic_config,
+            'configcards':      self.asic.asic_configcards,
+            'args':             vars(args) if args is not None else {},
+        }
+        if hasattr(self, 'vboard'):
+            header['voltageboard'] = {'pos': self.vboard.pos, 'vcal': self.vboard.vcal, 'vsupply': self.vboard.vsupply,
+                                      'dacvalues': self.vboard.dacvalues}
+        if hasattr(self, 'injector'):
+            header['injection'] = {'onchip': self.injector.onchip, 'amplitude': self.injector.amplitude,
+                                   'period': self.injector.period, 'clkdiv': self.injector.clkdiv,
+                                   'initdelay': self.injector.initdelay, 'cycle': self.injector.cycle,
+                                   'pulsesperset': self.injector.pulsesperset}
+        # Values are JSON compatible from here on, e.g. tuples as lists
+        return json.loads(json.dumps(header, default=str))
 
 
 
@@ -421,7 +491,7 @@ class astropixRun:
         return readout
 
 
-    def decode_readout(self, readout:bytearray, i:int, chip_version, printer: bool = True):
+    def decode_readout(self, readout:bytearray, i:int, chip_version, printer: bool = True, stream: bool = False, readout_time: float = None):
         """
         Decodes readout
 
@@ -432,23 +502,72 @@ class astropixRun:
 
         Optional:
         printer: bool - Print decoded output to terminal
+        stream: bool - Readouts are consecutive parts of one stream, hits cut off at the end
+                       of a readout are decoded with the next readout. See get_stream_decoder
+        readout_time: float - Host time of the readout, anchor of the chip time in stream mode
 
         Returns dataframe
         """
-        # Creates object
+        return self.decode_batch(readout, i, chip_version, printer, stream, readout_time).to_dataframe()
+
+    def decode_batch(self, readout:bytearray, i:int, chip_version, printer: bool = True, stream: bool = False, readout_time: float = None) -> HitBatch:
+        """
+        Decodes readout without creating a DataFrame, arguments as in decode_readout.
+        Collect the returned batches of a run in a core.hitbatch.HitBuffer
+
+        Returns HitBatch
+        """
+        if stream:
+            return self.get_stream_decoder(chip_version).feed(readout, i, printer, readout_time)
+
+        self.decode = self.get_decoder(chip_version)
+        frames = self.decode.frames_from_readoutstream(readout)
+
         if chip_version == 4:
-            self.decode = Decode(self.asic.sampleclockperiod, nchips=self.asic.num_chips, bytesperhit=8)
+            return self.decode.decode_astropix4_batch(frames, printer)
+        return self.decode.decode_astropix3_batch(frames, i, printer)
 
-            list_hits = self.decode.hits_from_readoutstream(readout)
-            df=self.decode.decode_astropix4_hits(list_hits, printer)
-        
-        else: 
-            self.decode = Decode(self.asic.sampleclockperiod, nchips=self.asic.num_chips)
+    def get_decoder(self, chip_version) -> Decode:
+        """
+        Returns decoder for the current ASIC configuration
 
-            list_hits = self.decode.hits_from_readoutstream(readout)
-            df=self.decode.decode_astropix3_hits(list_hits, i, printer)
+        Decoders are cached and only created again if the chip version, number of chips,
+        sample clock period or matrix geometry loaded by asic_init change.
 
-        return df
+        chip_version: version of the astropix chip
+        """
+        key = self._decoder_key(chip_version)
+
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            logger.debug("Creating decoder for chip version %d, %d chips, %d bytes per hit, %d ns sample clock, %dx%d pixels", *key)
+            decoder = Decode(self.asic.sampleclockperiod, nchips=self.asic.num_chips, bytesperhit=key[2],
+                             rows=self.asic.num_rows, cols=self.asic.num_cols)
+            self._decoders[key] = decoder
+
+        return decoder
+
+    def get_stream_decoder(self, chip_version, keep_chip_hits: bool = False, chiptime: bool = False) -> StreamDecoder:
+        """
+        Returns streaming decoder for the current ASIC configuration, used by decode_readout(stream=True)
+
+        The decoder keeps unfinished hits between readouts. Call its reset() when starting a new
+        stream and flush() at the end of one, frames_recovered and frames_dropped count cut off hits.
+        Per chip statistics and hits are kept in its chips attribute.
+
+        chip_version: version of the astropix chip
+        keep_chip_hits: bool - Keep decoded hits in one buffer per telescope chip
+        chiptime: bool - Add unwrapped chip time to the hits, see core.timestamps
+        Options only apply when the decoder is created, the first call per configuration.
+        """
+        key = self._decoder_key(chip_version)
+
+        stream_decoder = self._stream_decoders.get(key)
+        if stream_decoder is None:
+            stream_decoder = StreamDecoder(self.get_decoder(chip_version), chip_version, keep_chip_hits, chiptime)
+            self._stream_decoders[key] = stream_decoder
+
+        return stream_decoder
 
     # To be called when initalizing the asic, clears the FPGAs memory 
     def dump_fpga(self):
@@ -477,6 +596,12 @@ class astropixRun:
         except Exception: 
             raise RuntimeError("Could not read or write from astropix!")
 
+    # Decoders depend on the chip version and on the ASIC configuration loaded by asic_init
+    def _decoder_key(self, chip_version) -> tuple:
+        bytesperhit = 8 if chip_version == 4 else 5
+        return (chip_version, self.asic.num_chips, bytesperhit, self.asic.sampleclockperiod,
+                self.asic.num_rows, self.asic.num_cols)
+
     # progress bar 
     def _wait_progress(self, seconds:int):
         for _ in tqdm(range(seconds), desc=f'Wait {seconds} s'):
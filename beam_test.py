@@ -9,6 +9,9 @@ Maintained by: Amanda Steinhebel, amanda.l.steinhebel@nasa.gov
 #from http.client import SWITCHING_PROTOCOLS
 from astropix import astropixRun
 import modules.hitplotter as hitplotter
+from modules.pixelreco import PixelMatcher, PIXEL_DTYPES
+from modules.clustering import Clusterer, CLUSTER_DTYPES
+from modules.hitwriter import open_hit_writer, HIT_FORMATS
 import os
 import binascii
 import pandas as pd
@@ -17,6 +20,9 @@ import time
 import logging
 import argparse
 
+from modules.rawdata import open_readout_log
+from modules.rotation import OutputRotation
+from modules.runcatalog import register_run, written_paths
 from modules.setup_logger import logger
 
 
@@ -28,24 +34,6 @@ logname = "./runlogs/AstropixRunlog_" + time.strftime("%Y%m%d-%H%M%S") + ".log"
 
 
 
-# This is the dataframe which is written to the csv if the decoding fails
-decode_fail_frame = pd.DataFrame({
-                'readout': np.nan,
-                'Chip ID': np.nan,
-                'payload': np.nan,
-                'location': np.nan,
-                'isCol': np.nan,
-                'timestamp': np.nan,
-                'tot_msb': np.nan,
-                'tot_lsb': np.nan,
-                'tot_total': np.nan,
-                'tot_us': np.nan,
-                'hittime': np.nan
-                }, index=[0]
-)
-
-  
-
 #Initialize
 def main(args):
 
@@ -80,46 +68,50 @@ def main(args):
 
     max_errors = args.errormax
     i = 0
-    errors = 0 # Sets the threshold 
+    errors = 0 # Consecutive readouts in which every frame was rejected
     if args.maxtime is not None: 
         end_time=time.time()+(args.maxtime*60.)
     fname="" if not args.name else args.name+"_"
 
+    # Decodes readouts as one stream, created here so the output files know its columns
+    stream_decoder = astro.get_stream_decoder(args.chipVer, chiptime = args.chiptime)
+
     # Prepares the file paths 
-    if args.saveascsv and args.chipVer == 4:
-        csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-            'id',
-            'payload',
-            'row',
-            'col',
-            'ts1',
-            'tsfine1',
-            'ts2',
-            'tsfine2',
-            'tsneg1',
-            'tsneg2',
-            'tstdc1',
-            'tstdc2',
-            'ts_dec1',
-            'ts_dec2',
-            'tot_us'
-        ])
-    elif args.saveascsv: # Here for csv
+    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
+    # Long runs are split into segments listed in a manifest, see modules/rotation.py
+    rotation = OutputRotation(bitpath, max_bytes=args.rotateMB and args.rotateMB * 1e6,
+                              max_seconds=args.rotateMinutes and args.rotateMinutes * 60.)
+    csvwriters = []
+    if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        # Decoded hits are appended to the output files every few seconds, see modules/hitwriter.py
+        def hitwriter(path, dtypes):
+            writer = rotation.add(path, lambda segpath: open_hit_writer(segpath, dtypes, args.hitformat,
+                                  flush_readouts=args.flushReadouts, flush_seconds=args.flushSeconds, index_name="dec_ord"))
+            csvwriters.append(writer)
+            return writer
+        csvwriter = hitwriter(csvpath, stream_decoder.dtypes)
+        if args.perchip:
+            chipwriters = [hitwriter(csvpath.replace('.csv', f'_chip{chip}.csv'), stream_decoder.dtypes)
+                           for chip in range(stream_decoder.chips.nchips)]
+
+    # Pairs AstroPix2/3 row and column frames to pixels while taking data, needed for clustering
+    rowcol_frames = args.chipVer in (2, 3)
+    if args.clusters and rowcol_frames:
+        args.pixels = True
+    if args.pixels and rowcol_frames:
+        pixelmatcher = PixelMatcher()
+        if args.saveascsv:
+            pixelwriter = hitwriter(csvpath.replace('.csv', '_pixels.csv'), PIXEL_DTYPES)
+    elif args.pixels:
+        logger.warning("Pixel reconstruction is only needed for AstroPix2/3, ignoring --pixels")
+        args.pixels = False
+
+    # Clusters adjacent pixel hits while taking data
+    if args.clusters:
+        clusterer = Clusterer()
+        if args.saveascsv:
+            clusterwriter = hitwriter(csvpath.replace('.csv', '_clusters.csv'), CLUSTER_DTYPES)
 
     # Save final configuration to output file    
     ymlpathout=args.outdir +"/"+args.yaml+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
@@ -130,13 +122,10 @@ def main(args):
         ymlpathout=args.outdir+"/"+ypath[1]+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
         astro.write_conf_to_yaml(ymlpathout)
     # Prepare text files/logs
-    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
     # textfiles are always saved so we open it up 
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # Writes all the config information to the file, as text log or with --binary as raw file
+    bitfile = rotation.add(bitpath, lambda segpath: open_readout_log(segpath, astro.get_log_header() + str(args) + "\n",
+                           binary=args.binary, config=vars(args), run_header=astro.get_run_header(args)), log=True)
 
     # Enables the hitplotter and uses logic on whether or not to save the images
     if args.showhits: plotter = hitplotter.HitPlotter(35, outdir=(args.outdir if args.plotsave else None))
@@ -157,75 +146,73 @@ def main(args):
             # We aren't using timeit, just measuring the diffrence in ns
             if args.timeit: start = time.time_ns()
             readout = astro.get_readout()
+            readout_time = time.time()
             if args.timeit: print(f"Readout took {(time.time_ns()-start)*10**-9}s")
 
             if readout: #if there is data contained in the readout stream
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
+                # Writes the readout to the log
+                bitfile.write(i, readout, readout_time)
                 bitfile.flush() #make it simulate streaming
                 #print(binascii.hexlify(readout))
-                string_readout=str(binascii.hexlify(readout))[2:-1]
 
                 decoding_bool=True
                 if args.newfilter and args.chipVer == 4:
+                    string_readout=str(binascii.hexlify(readout))[2:-1]
                     string_list=[i for i in string_readout.replace('ff','bc').split('bc') if i!='']
                     for event in string_list:
                         if event[0:2]!='e0':
                             decoding_bool=False
 
                 if decoding_bool:
-                    # Added fault tolerance for decoding, the limits of which are set through arguments
-                    try:
-                        hits = astro.decode_readout(readout, i, args.chipVer, printer = True)
-                    except IndexError:
-                        errors += 1
-                        logger.warning(f"Decoding failed. Failure {errors} of {max_errors} on readout {i}")
-                        # We write out the failed decode dataframe
-                        hits = decode_fail_frame
-                        hits.readout = i
-                        hits.hittime = time.time()
+                    # Invalid frames are rejected by the decoder, good hits of the readout are kept
+                    hits = astro.decode_batch(readout, i, args.chipVer, printer = True, stream = True, readout_time = readout_time)
+                    i+=1
+
+                    link = stream_decoder.link.last
+                    if link['frames_rejected'] or link['bytes_skipped']:
+                        logger.debug(f"Readout {i-1}: {link['frames_decoded']} frames decoded, "
+                                     f"{link['frames_rejected']} rejected, {link['bytes_skipped']} bytes skipped")
 
-                        # This loggs the end of it all 
+                    # Terminate if the link is out of sync, single corrupted frames are only counted
+                    if link['frames_rejected'] and not link['frames_decoded']:
+                        errors += 1
+                        logger.warning(f"No valid frame in readout {i-1}. Failure {errors} of {max_errors}")
                         if errors > max_errors:
-                            logger.warning(f"Decoding failed {errors} times on an index error. Terminating Progam...")
-                    finally:
-                        i+=1
-                        # If we are saving a csv this will write it out. 
-                        if i==1 and args.chipVer==4 and args.saveascsv:
-                            csvframe=hits
-                            csvframe.columns=['id',
-                                                'payload',
-                                                'row',
-                                                'col',
-                                                'ts1',
-                                                'tsfine1',
-                                                'ts2',
-                                                'tsfine2',
-                                                'tsneg1',
-                                                'tsneg2',
-                                                'tstdc1',
-                                                'tstdc2',
-                                                'ts_dec1',
-                                                'ts_dec2',
-                                                'tot_us']
-                        elif args.saveascsv:
-                            csvframe = pd.concat([csvframe, hits])
-
-                        # This handles the hitplotting. Code by Henrike and Amanda
-                        if args.showhits:
-                            # This ensures we aren't plotting NaN values. I don't know if this would break or not but better 
-                            # safe than sorry
-                            if pd.isnull(hits.tot_msb.loc(0)):
-                                pass
-                            elif len(hits)>0:#safeguard against bad readouts without recorded decodable hits
-                                #Isolate row and column information from array returned from decoder
-                                rows = hits.location[~hits.isCol]
-                                columns = hits.location[hits.isCol]
-                                plotter.plot_event( rows, columns, i)
-
-                        # If we are logging runtime, this does it!
-                        if args.timeit:
-                            print(f"Read and decode took {(time.time_ns()-start)*10**-9}s")
+                            logger.warning(f"No valid frame in {errors} readouts in a row. Terminating Progam...")
+                    else:
+                        errors = 0
+
+                    # If we are saving a csv this will write it out. 
+                    if args.saveascsv:
+                        csvwriter.append(hits)
+                        if args.perchip:
+                            for chip, chiphits in hits.split(stream_decoder.chips.chip_column, len(chipwriters)):
+                                chipwriters[chip].append(chiphits)
+
+                    if args.pixels:
+                        pixels = pixelmatcher.match(hits)
+                        if args.saveascsv:
+                            pixelwriter.append(pixels)
+
+                    if args.clusters:
+                        clusters = clusterer.add(pixels if rowcol_frames else hits)
+                        if args.saveascsv:
+                            clusterwriter.append(clusters)
+
+                    # This handles the hitplotting. Code by Henrike and Amanda
+                    if args.showhits and len(hits)>0: #safeguard against bad readouts without recorded decodable hits
+                        #Isolate row and column information from array returned from decoder
+                        if args.chipVer == 4:
+                            rows = hits['row']
+                            columns = hits['col']
+                        else:
+                            rows = hits['location'][hits['isCol'] == 0]
+                            columns = hits['location'][hits['isCol'] == 1]
+                        plotter.plot_event( rows, columns, i)
+
+                    # If we are logging runtime, this does it!
+                    if args.timeit:
+                        print(f"Read and decode took {(time.time_ns()-start)*10**-9}s")
 
     # Ends program cleanly when a keyboard interupt is sent.
     except KeyboardInterrupt:
@@ -234,11 +221,35 @@ def main(args):
     except Exception as e:
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:
-        if args.saveascsv: 
-            csvframe.index.name = "dec_ord"
-            csvframe.to_csv(csvpath) 
+        stream_decoder.flush()
+        logger.info(f"Hits split between readouts: {stream_decoder.frames_recovered} recovered, {stream_decoder.frames_dropped} dropped")
+        logger.info(f"Link quality: {stream_decoder.link}")
+        logger.info(f"Hits per chip:\n{stream_decoder.chips.stats().to_string()}")
+        if args.pixels:
+            pixels = pixelmatcher.flush()
+            if args.saveascsv:
+                pixelwriter.append(pixels)
+            logger.info(f"Pixel reconstruction: {pixelmatcher}")
+        if args.clusters:
+            if rowcol_frames:
+                clusters = clusterer.add(pixels)
+                if args.saveascsv:
+                    clusterwriter.append(clusters)
+            clusters = clusterer.flush()
+            if args.saveascsv:
+                clusterwriter.append(clusters)
+            logger.info(f"Clustering: {clusterer}")
+        # Writes the remaining hits and closes the output files
+        for writer in csvwriters:
+            writer.close()
         if args.inject is not None: astro.stop_injection()   
         bitfile.close() # Close open file        
+        rotation.close() # Completes the manifest of a rotated run
+        # Adds the run to the catalog of the output directory, see modules/runcatalog.py
+        register_run(args.outdir, written_paths(bitfile),
+                     [ymlpathout] + [path for writer in csvwriters for path in written_paths(writer)]
+                     + ([rotation.manifest] if rotation.enabled else []),
+                     script='beam_test.py', hits=(csvwriter.hits if args.saveascsv else None))
         astro.close_connection() # Closes SPI
         logger.info("Program terminated successfully")
     # END OF PROGRAM
@@ -269,6 +280,31 @@ if __name__ == "__main__":
                     default=False, required=False, 
                     help='save output files as CSV. If False, save as txt. Default: FALSE')
     
+    parser.add_argument('--pixels', action='store_true', 
+                    default=False, required=False, 
+                    help='AstroPix2/3 only, pair row and column hits to pixels while taking data. With -c saved in an additional CSV. Default: FALSE')
+    
+    parser.add_argument('-F', '--hitformat', choices=HIT_FORMATS, default='csv', required=False,
+                    help='Format of the decoded hit files saved with -c. parquet and arrow need pyarrow. Default: csv')
+
+    parser.add_argument('--flushReadouts', type=int, default=1000, required=False,
+                    help='Write decoded hits to file after this many readouts ... Default: 1000')
+
+    parser.add_argument('--flushSeconds', type=float, default=5.0, required=False,
+                    help='... or after this many seconds. Default: 5')
+
+    parser.add_argument('--clusters', action='store_true', 
+                    default=False, required=False, 
+                    help='Cluster hits on adjacent pixels while taking data, implies --pixels for AstroPix2/3. With -c saved in an additional CSV. Default: FALSE')
+    
+    parser.add_argument('--perchip', action='store_true', 
+                    default=False, required=False, 
+                    help='With -c, additionally save one CSV per chip of the telescope. Default: FALSE')
+    
+    parser.add_argument('--chiptime', action='store_true', 
+                    default=False, required=False, 
+                    help='Add unwrapped chip timestamp in sample clock periods to decoded hits (column chiptime). Default: FALSE')
+    
     parser.add_argument('-f', '--newfilter', action='store_true', 
                     default=False, required=False, 
                     help='Turns on filtering of strings looking for header of e0 in V4. If False, no filtering. Default: FALSE')
@@ -286,7 +322,7 @@ if __name__ == "__main__":
                     help = 'Threshold voltage for digital ToT (in mV). DEFAULT value in yml OR 100mV if voltagecard not in yml')
     
     parser.add_argument('-E', '--errormax', action='store', type=int, default='100', 
-                    help='Maximum index errors allowed during decoding. DEFAULT 100')
+                    help='Maximum consecutive readouts without any valid frame before terminating. DEFAULT 100')
 
     parser.add_argument('-r', '--maxruns', type=int, action='store', default=None,
                     help = 'Maximum number of readouts')
@@ -300,7 +336,15 @@ if __name__ == "__main__":
     parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
                     help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
 
-    parser.add_argument
+    parser.add_argument('--binary', action='store_true', default=False, required=False,
+                    help='Save readouts as binary raw file (.raw) instead of text log, see convert_raw.py. Default: False')
+
+    parser.add_argument('--rotateMB', type=float, default=None, required=False,
+                    help='Start new output files when the readout log reaches this size in MB, segments are listed in a manifest. Default: no rotation')
+
+    parser.add_argument('--rotateMinutes', type=float, default=None, required=False,
+                    help='Start new output files after this many minutes, segments are listed in a manifest. Default: no rotation')
+
     args = parser.parse_args()
 
     # Sets the loglevel
@@ -133,31 +133,33 @@ def main(args):
         #create PPS file
         bitpath_pps = bitpath[:-4]+"_PPS.log"
         postProcessing = pps.postProcessing_streams(bitpath)
-
-        with open(bitpath_pps, 'w', encoding='utf-8') as f:
-            f.write("EventNmb \t BadEvents \t Data \n")
-            f.write('\n'.join(f'{tup[0]} \t {tup[1]} \t {tup[2]}' for tup in postProcessing.dump()))
-            f.close()
+        postProcessing.write_dump(bitpath_pps)
 
         #create decoded CSV
         csvpath = bitpath[:-4]+".csv"
         postProcessing2 = pps.postProcessing_streams(bitpath_pps, dec=True)
 
-        df_decoded = postProcessing2.decode()
-        df_decoded.columns = [ 
-            'readout',
-            'Chip ID',
-            'payload',
-            'location',
-            'isCol',
-            'timestamp',
-            'tot_msb',
-            'tot_lsb',
-            'tot_total',
-            'tot_us'
-        ]
-        df_decoded.index.name = "dec_ord"
-        df_decoded.to_csv(csvpath)      
+        #decoded and written in chunks of readouts
+        with open(csvpath, 'w', newline='') as f:
+            header = True
+            for df_decoded in postProcessing2.iter_decode():
+                if df_decoded.empty:
+                    continue
+                df_decoded.columns = [ 
+                    'readout',
+                    'Chip ID',
+                    'payload',
+                    'location',
+                    'isCol',
+                    'timestamp',
+                    'tot_msb',
+                    'tot_lsb',
+                    'tot_total',
+                    'tot_us'
+                ]
+                df_decoded.index.name = "dec_ord"
+                df_decoded.to_csv(f, header=header)
+                header = False
     elif i==0:
         logger.warning("No data recorded - nothing to decode. Deleting empty file")
         if os.path.exists(bitpath):
@@ -0,0 +1,323 @@
+"""
+Benchmark the decoding of raw readouts, comparing the per-byte python decoder with the vectorized NumPy decoder.
+AstroPix3 readouts are taken from recorded .log files, AstroPix4 readouts are generated
+as there are no recorded v4 files. Both decoders must return identical hits.
+
+The suite times every decode stage on synthetic streams of modules/readoutgen.py,
+for AstroPix3 including modules/postProcessing_streams.py. Pixel reconstruction of modules/pixelreco.py
+readout by readout must give the pixels found for all readouts at once, the same for clustering
+of modules/clustering.py.
+
+Usage: python bench_decode.py [-f TEST/*.log] [-r 5] [-n 1000] [-H 2 20] [-c 1]
+"""
+
+import argparse
+import binascii
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from core.decode import Decode
+from core.hitbatch import HitBatch, HitBuffer, ASTROPIX3_DTYPES, ASTROPIX4_DTYPES
+from modules.clustering import CLUSTER_DTYPES, Clusterer, cluster_hits
+from modules.pixelreco import PIXEL_DTYPES, PixelMatcher, match_pixels
+from modules.readoutgen import ReadoutGenerator
+import modules.postProcessing_streams as pps
+from utils.bitorder import BITREVERSE_LUT, BITREVERSE_TABLE
+
+
+def load_readouts(files: list) -> list:
+    """
+    Read raw readouts from .log files written by beam_test.py/injectionScan.py
+
+    :param files: List of .log files
+    :returns: List of readouts as bytes
+    """
+    readouts = []
+    for infile in files:
+        with open(infile, 'r') as f:
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) == 2 and fields[0].isdigit():
+                    readouts.append(binascii.unhexlify(fields[1].strip()[2:-1]))
+    return readouts
+
+
+def occupancy_readouts(nreadouts: int, size: int, occupancy: float, seed: int = 0) -> list:
+    """
+    Generate AstroPix3 readouts of chip 0 with a given fraction of bytes in frames
+
+    Hits of modules/readoutgen.py are spread over the first half of every readout, the rest is railing.
+    Every readout has at least one hit on average
+
+    :param nreadouts: Number of readouts
+    :param size: Bytes per readout
+    :param occupancy: Fraction of bytes belonging to frames
+    :returns: List of readouts as bytes
+    """
+    # Row and column frame per hit
+    hits = max(occupancy * size / 10, 1.0)
+    gap = 2 * max(int(size / 2 / hits) - 10, 0)
+    return ReadoutGenerator(3, hits_per_readout=hits, readout_size=size, gap=gap, seed=seed).readouts(nreadouts)
+
+
+def timeit(func, repeat: int) -> float:
+    """Return best wall time of repeat calls of func in s"""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def report(name: str, func, nbytes: int, nhits: int, repeat: int):
+    """Time func and print throughput in MB/s and hits/s"""
+    t = timeit(func, repeat)
+    hitrate = f"  {nhits/t:12.0f} hits/s" if nhits else ""
+    print(f"  {name:>24}: {t*1e3:9.2f} ms  {nbytes/t/1e6:8.2f} MB/s{hitrate}")
+
+
+def decode_python(decoder: Decode, readouts: list) -> pd.DataFrame:
+    return pd.concat([decoder.decode_astropix3_hits(decoder.hits_from_readoutstream(r), i) for i, r in enumerate(readouts)])
+
+
+def decode_numpy(decoder: Decode, readouts: list) -> pd.DataFrame:
+    return pd.concat([decoder.decode_astropix3_frames(decoder.frames_from_readoutstream(r), i) for i, r in enumerate(readouts)])
+
+
+def decode_batches(decoder: Decode, readouts: list, chipversion: int) -> pd.DataFrame:
+    """Decode into a HitBuffer, one DataFrame for the whole run"""
+    buffer = HitBuffer(ASTROPIX4_DTYPES if chipversion == 4 else ASTROPIX3_DTYPES)
+    for i, r in enumerate(readouts):
+        frames = decoder.frames_from_readoutstream(r)
+        if chipversion == 4:
+            buffer.append(decoder.decode_astropix4_batch(frames))
+        else:
+            buffer.append(decoder.decode_astropix3_batch(frames, i))
+    return buffer.to_dataframe()
+
+
+def bench_astropix3(readouts: list, repeat: int):
+    decoder = Decode()
+    nbytes = sum(len(r) for r in readouts)
+
+    # Check that both paths decode the same hits, hittime is taken at decode time.
+    # Readouts without hits give object columns in the python path, so only values are compared
+    ref = decode_python(decoder, readouts).drop(columns='hittime')
+    new = decode_numpy(decoder, readouts).drop(columns='hittime')
+    pd.testing.assert_frame_equal(ref, new, check_dtype=False)
+    pd.testing.assert_frame_equal(ref, decode_batches(decoder, readouts, 3).drop(columns='hittime'), check_dtype=False)
+
+    print(f"AstroPix3: {len(readouts)} readouts, {nbytes/1e6:.2f} MB, {len(ref)} hits")
+    report('python', lambda: decode_python(decoder, readouts), nbytes, len(ref), repeat)
+    report('numpy', lambda: decode_numpy(decoder, readouts), nbytes, len(ref), repeat)
+    report('numpy batch', lambda: decode_batches(decoder, readouts, 3), nbytes, len(ref), repeat)
+
+    # Hit search alone, without building a DataFrame per readout
+    report('python hit search', lambda: [decoder.hits_from_readoutstream(r) for r in readouts], nbytes, len(ref), repeat)
+    report('numpy hit search', lambda: [decoder.frames_from_readoutstream(r) for r in readouts], nbytes, len(ref), repeat)
+
+
+def bench_astropix4(readouts: list, repeat: int):
+    decoder = Decode(nchips=1, bytesperhit=8)
+    nbytes = sum(len(r) for r in readouts)
+
+    def decode_python():
+        return pd.concat([decoder.decode_astropix4_hits(decoder.hits_from_readoutstream(r)) for r in readouts])
+
+    def decode_numpy():
+        return pd.concat([decoder.decode_astropix4_frames(decoder.frames_from_readoutstream(r)) for r in readouts])
+
+    ref = decode_python()
+    pd.testing.assert_frame_equal(ref, decode_numpy(), check_dtype=False)
+    pd.testing.assert_frame_equal(ref, decode_batches(decoder, readouts, 4), check_dtype=False)
+
+    print(f"AstroPix4: {len(readouts)} readouts, {nbytes/1e6:.2f} MB, {len(ref)} hits")
+    report('python', decode_python, nbytes, len(ref), repeat)
+    report('numpy', decode_numpy, nbytes, len(ref), repeat)
+    report('numpy batch', lambda: decode_batches(decoder, readouts, 4), nbytes, len(ref), repeat)
+
+
+def write_pps(logpath: str, ppspath: str):
+    """Filter a raw .log file into a _PPS.log file as test_regexparse.py does"""
+    postProcessing = pps.postProcessing_streams(logpath)
+    postProcessing.write_dump(ppspath)
+
+
+def bench_suite(chipversion: int, nreadouts: int, hits_per_readout: float, nchips: int, repeat: int):
+    """
+    Time every stage of decoding on a generated stream: hit search, per-hit decoding,
+    vectorized decoding and, for AstroPix3, postProcessing_streams
+    """
+    gen = ReadoutGenerator(chipversion, nchips, hits_per_readout)
+    readouts = gen.readouts(nreadouts)
+    nbytes = sum(len(r) for r in readouts)
+    nframes = len(gen.truth_frames())
+
+    decoder = Decode(nchips=nchips, bytesperhit=gen.bytesperhit)
+    hitlists = [decoder.hits_from_readoutstream(r) for r in readouts]
+    assert sum(len(h) for h in hitlists) == nframes
+
+    print(f"AstroPix{chipversion} generated: {nreadouts} readouts, {nchips} chips, "
+          f"{hits_per_readout} hits/readout, {nbytes/1e6:.2f} MB, {nframes} frames")
+
+    report('hits_from_readoutstream', lambda: [decoder.hits_from_readoutstream(r) for r in readouts], nbytes, nframes, repeat)
+    if chipversion == 4:
+        report('decode_astropix4_hits', lambda: [decoder.decode_astropix4_hits(h) for h in hitlists], nbytes, nframes, repeat)
+    else:
+        report('decode_astropix3_hits', lambda: [decoder.decode_astropix3_hits(h, i) for i, h in enumerate(hitlists)], nbytes, nframes, repeat)
+    report('numpy batch', lambda: decode_batches(decoder, readouts, chipversion), nbytes, nframes, repeat)
+
+    if chipversion == 3:
+        # postProcessing_streams works on _PPS.log files, only its decoding is timed
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gen.reset()
+            logpath = os.path.join(tmpdir, 'generated.log')
+            ppspath = os.path.join(tmpdir, 'generated_PPS.log')
+            gen.write_log(logpath, nreadouts)
+            write_pps(logpath, ppspath)
+            # decode() keeps its result, a new instance is timed every time
+            report('postProcessing decode', lambda: pps.postProcessing_streams(ppspath, dec=True).decode(),
+                   nbytes, nframes, repeat)
+
+
+def match_streamed(batches: list, window: int) -> tuple:
+    """Pixels of PixelMatcher fed readout by readout, sorted by readout, chip, time and row"""
+    matcher = PixelMatcher(window=window)
+    pixels = HitBatch.concat([matcher.match(b) for b in batches] + [matcher.flush()], PIXEL_DTYPES).to_dataframe()
+    pixels = pixels.sort_values(['readout', 'Chip ID', 'time', 'row', 'col'], kind='stable').reset_index(drop=True)
+    return pixels, matcher
+
+
+def bench_pixels(nreadouts: int, nchips: int, repeat: int):
+    """
+    Pixel reconstruction of dense generated streams, hits close to readout boundaries.
+    Matching readout by readout must give the pixels of match_pixels on all readouts at once
+    """
+    decoder = Decode(nchips=nchips)
+    for window, hits, ticks in [(1, 20, 50), (3, 30, 100)]:
+        gen = ReadoutGenerator(3, nchips, hits, ticks_per_readout=ticks)
+        readouts = gen.readouts(nreadouts)
+        batches = [decoder.decode_astropix3_batch(decoder.frames_from_readoutstream(r), i) for i, r in enumerate(readouts)]
+
+        frames = PixelMatcher(window=window)._frames(HitBatch.concat(batches))
+        is_col = frames['isCol']
+        ref, unmatched_rows, unmatched_cols = match_pixels({k: v[~is_col] for k, v in frames.items()},
+                                                           {k: v[is_col] for k, v in frames.items()}, window)
+        ref = ref.to_dataframe().sort_values(['readout', 'Chip ID', 'time', 'row', 'col'], kind='stable').reset_index(drop=True)
+        pixels, matcher = match_streamed(batches, window)
+        pd.testing.assert_frame_equal(ref, pixels)
+        assert (matcher.unmatched_rows, matcher.unmatched_cols) == (unmatched_rows.sum(), unmatched_cols.sum())
+
+        nframes = len(frames['time'])
+        print(f"AstroPix3 pixel reconstruction: window {window}, {nframes} frames, {len(ref)} pixels, "
+              f"{ref['ambiguous'].sum()} ambiguous")
+        report('PixelMatcher', lambda: match_streamed(batches, window), sum(len(r) for r in readouts), nframes, repeat)
+
+
+def cluster_streamed(batches: list, window: int) -> pd.DataFrame:
+    """Clusters of a Clusterer fed readout by readout, sorted by chip, time, row and col"""
+    clusterer = Clusterer(window=window)
+    clusters = HitBatch.concat([clusterer.add(b) for b in batches] + [clusterer.flush()], CLUSTER_DTYPES).to_dataframe()
+    return clusters.sort_values(['Chip ID', 'time', 'row', 'col'], kind='stable').reset_index(drop=True)
+
+
+def bench_clusters(nreadouts: int, nchips: int, repeat: int):
+    """
+    Clustering of dense generated AstroPix4 streams, clusters across readout boundaries.
+    Clustering readout by readout must give the clusters of cluster_hits on all readouts at once
+    """
+    decoder = Decode(nchips=nchips, bytesperhit=8)
+    for window, hits, ticks in [(2, 20, 50), (5, 40, 100)]:
+        gen = ReadoutGenerator(4, nchips, hits, ticks_per_readout=ticks)
+        readouts = gen.readouts(nreadouts)
+        batches = [decoder.decode_astropix4_batch(decoder.frames_from_readoutstream(r)) for r in readouts]
+
+        data = Clusterer(window=window)._hits(HitBatch.concat(batches))
+        ref, _ = cluster_hits(data['chip'], data['row'], data['col'], data['time'], data['tot_us'], window)
+        ref = ref.to_dataframe().sort_values(['Chip ID', 'time', 'row', 'col'], kind='stable').reset_index(drop=True)
+        pd.testing.assert_frame_equal(ref, cluster_streamed(batches, window))
+
+        nhits = len(data['time'])
+        print(f"AstroPix4 clustering: window {window}, {nhits} hits, {len(ref)} clusters, "
+              f"mean size {nhits / max(len(ref), 1):.2f}")
+        report('Clusterer', lambda: cluster_streamed(batches, window), sum(len(r) for r in readouts), nhits, repeat)
+
+
+def bench_bitreverse(nbytes: int, repeat: int):
+    """Compare per-byte string reversal with the shared reversal table"""
+    buffer = np.random.default_rng(0).integers(0, 256, nbytes, dtype=np.uint8).tobytes()
+
+    def string_format():
+        return bytearray(int(format(b, '08b')[::-1], 2) for b in buffer)
+
+    ref = string_format()
+    assert bytes(buffer).translate(BITREVERSE_TABLE) == ref
+    assert BITREVERSE_LUT[np.frombuffer(buffer, dtype=np.uint8)].tobytes() == ref
+
+    print(f"Bit reversal of {nbytes/1024:.0f} kB")
+    report('string format', string_format, nbytes, 0, repeat)
+    report('bytes.translate', lambda: buffer.translate(BITREVERSE_TABLE), nbytes, 0, repeat)
+    report('numpy gather', lambda: BITREVERSE_LUT[np.frombuffer(buffer, dtype=np.uint8)], nbytes, 0, repeat)
+
+
+def bench_occupancy(size: int, repeat: int):
+    """
+    Hit search time for sparse to dense readouts.
+    header mask only is the lower bound of a full scan over the readout, without gathering frames
+    """
+    decoder = Decode()
+
+    print(f"AstroPix3 hit search in {size} byte readouts")
+    for occupancy in [0.001, 0.01, 0.1]:
+        readouts = occupancy_readouts(100, size, occupancy)
+        nbytes = sum(len(r) for r in readouts)
+        nhits = sum(len(decoder.hits_from_readoutstream(r)) for r in readouts)
+
+        # Both paths find the same valid frames
+        assert sum(len(decoder.frames_from_readoutstream(r)) for r in readouts) == nhits
+
+        print(f" {occupancy:.1%} occupancy, {nhits*5/nbytes:.2%} generated, {nhits} hits")
+        report('python', lambda: [decoder.hits_from_readoutstream(r) for r in readouts], nbytes, nhits, repeat)
+        report('header mask only', lambda: [np.flatnonzero(decoder._header_rev_lut[np.frombuffer(r, dtype=np.uint8)])
+                                            for r in readouts], nbytes, nhits, repeat)
+        report('numpy', lambda: [decoder.frames_from_readoutstream(r) for r in readouts], nbytes, nhits, repeat)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Decoder benchmark')
+    parser.add_argument('-f', '--files', nargs='+', default=None, required=False,
+                    help='Raw data .log files used as input. Default: TEST/*.log')
+
+    parser.add_argument('-r', '--repeat', type=int, default=5, required=False,
+                    help='Number of repetitions, best time is reported. Default: 5')
+
+    parser.add_argument('-n', '--nreadouts', type=int, default=1000, required=False,
+                    help='Number of generated readouts. Default: 1000')
+
+    parser.add_argument('-H', '--hits', type=float, nargs='+', default=[2, 20], required=False,
+                    help='Mean hits per generated readout, one benchmark per value. Default: 2 20')
+
+    parser.add_argument('-c', '--nchips', type=int, default=1, required=False,
+                    help='Number of chips in generated readouts. Default: 1')
+
+    args = parser.parse_args()
+
+    files = args.files if args.files else sorted(glob.glob('TEST/*.log'))
+    bench_bitreverse(64*1024, args.repeat)
+    bench_astropix3(load_readouts(files), args.repeat)
+    bench_occupancy(2048, args.repeat)
+    bench_occupancy(65536, args.repeat)
+    bench_astropix4(ReadoutGenerator(4, hits_per_readout=100).readouts(args.nreadouts), args.repeat)
+
+    for chipversion in [3, 4]:
+        for hits in args.hits:
+            bench_suite(chipversion, args.nreadouts, hits, args.nchips, args.repeat)
+    bench_pixels(args.nreadouts, args.nchips, args.repeat)
+    bench_clusters(args.nreadouts, args.nchips, args.repeat)
@@ -0,0 +1,175 @@
+"""
+Add the runs of existing output directories to their run catalog (runs.sqlite), see modules/runcatalog.py.
+Files are grouped into runs by name: a readout log (.log or .raw) or the manifest of a rotated run, with the
+hit, decoded and yml files of the same run. With --col, --row, --injection or --threshold the catalog is
+searched instead and the matching runs are printed.
+"""
+
+import argparse
+import logging
+import os
+
+from modules.rawdata import RAW_SUFFIX, RawReader
+from modules.rotation import MANIFEST_SUFFIX, read_manifest
+from modules.runcatalog import CATALOG_NAME, RunCatalog, count_hits, parse_run_name
+
+from modules.setup_logger import logger
+
+
+def find_runs(directory: str) -> list:
+    """
+    Group the files of a directory into runs
+
+    :returns: List of (logs, files, main hit files) per run
+    """
+    names = sorted(os.listdir(directory))
+    paths = {name: os.path.join(directory, name) for name in names}
+    used = set()
+    runs = []
+
+    #Rotated runs, all segments of the manifest
+    for name in names:
+        if not name.endswith(MANIFEST_SUFFIX):
+            continue
+        manifest = read_manifest(paths[name])
+        logs = [paths[segment['log']] for segment in manifest['segments'] if segment['log'] in paths]
+        files = [paths[f] for segment in manifest['segments'] for f in segment['files'] if f in paths and f != segment['log']]
+        if not logs:
+            continue
+        root = name[:-len(MANIFEST_SUFFIX)]
+        hitfiles = [f for f in files if os.path.splitext(os.path.basename(f))[0].startswith(root + '_')
+                    and os.path.splitext(os.path.basename(f))[0][len(root) + 1:].isdigit()]
+        runs.append((logs, files + [paths[name]], hitfiles))
+        used.update(os.path.basename(f) for f in logs + files + [paths[name]])
+
+    #Single readout logs with the files of the same name
+    stems = {}
+    for name in names:
+        if name in used or name.endswith('_PPS.log') or not (name.endswith('.log') or name.endswith(RAW_SUFFIX)):
+            continue
+        stems.setdefault(os.path.splitext(name)[0], []).append(name)
+    for stem, lognames in stems.items():
+        #A converted log and raw file are one run, the first is read
+        files = [paths[n] for n in lognames[1:]]
+        for name in names:
+            if name in used or name in lognames or name.endswith('.idx.npz') or name.endswith('.cache.json'):
+                continue
+            if name.startswith(stem + '.') or name.startswith(stem + '_'):
+                files.append(paths[name])
+        hitfiles = [f for f in files if os.path.splitext(os.path.basename(f))[0] == stem and not f.endswith('.log')]
+        hitfiles = hitfiles or [f for f in files if os.path.basename(f).startswith(stem + '_offline.')]
+        runs.append(([paths[lognames[0]]], files, hitfiles))
+        used.update(os.path.basename(f) for f in files)
+
+    #Saved configurations, named <yaml>_<run name><timestamp>.yml or <yaml>_<timestamp>.yml
+    for name in names:
+        if not name.endswith('.yml') or name in used:
+            continue
+        stem = os.path.splitext(name)[0]
+        started = parse_run_name(name)['started']
+        matches = [run for run in runs if stem.endswith('_' + os.path.splitext(os.path.basename(run[0][0]))[0])]
+        if not matches and started is not None:
+            matches = [run for run in runs if parse_run_name(run[0][0])['started'] == started]
+        if len(matches) == 1:
+            matches[0][1].append(paths[name])
+
+    return runs
+
+
+def backfill(directory: str, update: bool):
+    runs = find_runs(directory)
+    if not runs:
+        return
+    added = 0
+    with RunCatalog(directory) as catalog:
+        for logs, files, hitfiles in runs:
+            if not update and catalog.run_of(logs[0]) is not None:
+                continue
+            #Program logs of runlogs/ have neither readouts nor a log header
+            with RawReader(logs[0], save_index=False) as reader:
+                if not len(reader) and not reader.config:
+                    continue
+            counts = [count_hits(f) for f in hitfiles]
+            hits = sum(counts) if counts and None not in counts else None
+            try:
+                catalog.register(logs, files, hits=hits)
+            except (OSError, ValueError) as e:
+                logger.warning(f"{logs[0]} not added: {e}")
+                continue
+            added += 1
+        logger.info(f"{directory}: {added} of {len(runs)} runs added, {len(catalog)} runs in {catalog.path}")
+
+
+def main(args):
+
+    directories = [args.dirInput]
+    if args.recursive:
+        directories = sorted(root for root, _, _ in os.walk(args.dirInput))
+
+    criteria = {name: value for name, value in [('col', args.col), ('row', args.row), ('injection', args.injection),
+                                                  ('threshold', args.threshold)] if value is not None}
+    for directory in directories:
+        if not criteria:
+            backfill(directory, args.update)
+            continue
+        if not os.path.exists(os.path.join(directory, CATALOG_NAME)):
+            continue
+        with RunCatalog(directory) as catalog:
+            for run in catalog.find(**criteria):
+                print(f"{catalog.path_of(run['log'])}\tcol {run['col']} row {run['row']}\tinj {run['injection']} mV"
+                      f"\tthr {run['threshold']} mV\t{run['readouts']} readouts\t{run['hits']} hits\t{run['duration']} s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Add existing runs to the run catalog of their directory, or search it')
+    parser.add_argument('-d', '--dirInput', required=True,
+                    help='Output directory of the data taking scripts')
+
+    parser.add_argument('-r', '--recursive', action='store_true', default=False, required=False,
+                    help='Also subdirectories, each with its own catalog. Default: False')
+
+    parser.add_argument('--update', action='store_true', default=False, required=False,
+                    help='Read runs already in the catalog again. Default: only add new runs')
+
+    parser.add_argument('--col', type=int, default=None, required=False,
+                    help='Print the runs of this pixel column instead of adding runs')
+
+    parser.add_argument('--row', type=int, default=None, required=False,
+                    help='Print the runs of this pixel row instead of adding runs')
+
+    parser.add_argument('--injection', type=float, default=None, required=False,
+                    help='Print the runs with this injection voltage in mV instead of adding runs')
+
+    parser.add_argument('--threshold', type=float, default=None, required=False,
+                    help='Print the runs with this threshold in mV instead of adding runs')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
+
+    args = parser.parse_args()
+
+    # Sets the loglevel
+    ll = args.loglevel
+    if ll == 'D':
+        loglevel = logging.DEBUG
+    elif ll == 'I':
+        loglevel = logging.INFO
+    elif ll == 'E':
+        loglevel = logging.ERROR
+    elif ll == 'W':
+        loglevel = logging.WARNING
+    elif ll == 'C':
+        loglevel = logging.CRITICAL
+
+    # Logging - print to terminal only
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
@@ -0,0 +1,92 @@
+"""
+Convert raw readout files between text logs (.log) and the binary raw format (.raw), see modules/rawdata.py.
+The direction follows from the input file, converted files are saved next to the input unless -o is given.
+"""
+
+import argparse
+import glob
+import logging
+import os
+
+from modules.rawdata import RAW_SUFFIX, is_raw, log_to_raw, raw_to_log
+
+from modules.setup_logger import logger
+
+
+def main(args):
+
+    #Allow only -f or -d to be evoked - not both
+    if args.fileInput and args.dirInput:
+        logger.error("Input a single file with -f OR a single directory with -d... not both! Try running again")
+        exit()
+
+    if args.fileInput is not None:
+        inputFiles = [args.fileInput]
+    else:
+        suffix = '.log' if args.toRaw else RAW_SUFFIX
+        inputFiles = sorted(glob.glob(os.path.join(args.dirInput, '*' + suffix)))
+        #_PPS.log files are filtered readouts, not readout logs
+        inputFiles = [f for f in inputFiles if not f.endswith('_PPS.log')]
+
+    for infile in inputFiles:
+        outdir = args.outDir if args.outDir is not None else os.path.dirname(infile)
+        name = os.path.splitext(os.path.basename(infile))[0]
+
+        if is_raw(infile):
+            outfile = os.path.join(outdir, name + '.log')
+            readouts = raw_to_log(infile, outfile)
+        else:
+            outfile = os.path.join(outdir, name + RAW_SUFFIX)
+            try:
+                readouts = log_to_raw(infile, outfile)
+            except ValueError as e:
+                logger.error(f"{infile} not converted: {e}")
+                continue
+
+        logger.info(f"{infile} -> {outfile}: {readouts} readouts, {os.path.getsize(infile)} -> {os.path.getsize(outfile)} bytes")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Convert text logs to binary raw files and back')
+    parser.add_argument('-f', '--fileInput', default=None, required=False,
+                    help='Input file, .log or .raw')
+
+    parser.add_argument('-d', '--dirInput', default=None, required=False,
+                    help='Input directory, converts all .log files (or .raw files with --toLog)')
+
+    parser.add_argument('--toLog', dest='toRaw', action='store_false', default=True, required=False,
+                    help='With -d, convert .raw files to text logs. Default: convert .log files to raw files')
+
+    parser.add_argument('-o', '--outDir', default=None, required=False,
+                    help='Output directory. Defaults to the directory of the input')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
+
+    args = parser.parse_args()
+
+    # Sets the loglevel
+    ll = args.loglevel
+    if ll == 'D':
+        loglevel = logging.DEBUG
+    elif ll == 'I':
+        loglevel = logging.INFO
+    elif ll == 'E':
+        loglevel = logging.ERROR
+    elif ll == 'W':
+        loglevel = logging.WARNING
+    elif ll == 'C':
+        loglevel = logging.CRITICAL
+
+    # Logging - print to terminal only
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
@@ -41,6 +41,7 @@ class Asic(Nexysio):
         self.asic_tdac_config = {}
 
         self._num_chips = 1
+        self._layer_z = None
 
         self._chipname = ""
 
@@ -114,6 +115,18 @@ class Asic(Nexysio):
     def num_chips(self, chips):
         self._num_chips = chips
 
+    @property
+    def layer_z(self):
+        """Get/set z position of every telescope chip in mm
+
+        :returns: List of z positions, one per chip. None if not configured
+        """
+        return self._layer_z
+
+    @layer_z.setter
+    def layer_z(self, layer_z):
+        self._layer_z = layer_z
+
     @property
     def sampleclockperiod(self):
         """Get/set sample clock period in ns
@@ -252,6 +265,17 @@ class Asic(Nexysio):
         except (KeyError, TypeError):
             logger.warning("%s%d Telescope config not found!", chipname, chipversion)
 
+        # Get telescope layer positions, only needed for tracking
+        try:
+            self.layer_z = [float(z) for z in dict_from_yml[self.chip].get('telescope')['layer_z']]
+            if len(self.layer_z) != self.num_chips:
+                logger.error("%s%d Telescope layer_z has %d entries for %d chips!", chipname, chipversion, len(self.layer_z), self.num_chips)
+                self.layer_z = None
+            else:
+                logger.info("%s%d Telescope layer positions found!", chipname, chipversion)
+        except (KeyError, TypeError):
+            self.layer_z = None
+
         # Get sample clock
         try:
             self.sampleclockperiod = dict_from_yml[self.chip].get('general')['sampleclockperiod_ns'] 
@@ -6,21 +6,130 @@ Created on Tue Dec 28 19:03:40 2021
 @author: Nicolas Striebig
 """
 
+import numpy as np
 import pandas as pd
 import time
 
 import logging
 from modules.setup_logger import logger
+from utils.bitorder import BITREVERSE_LUT, BITREVERSE_TABLE
+from core.hitbatch import HitBatch, ChipDemux, ASTROPIX3_DTYPES, ASTROPIX4_DTYPES, hit_dtypes
+from core.timestamps import TimestampUnwrapper
 
 
 logger = logging.getLogger(__name__)
 
+# Version of the decoded output, increase when a change of the decoder changes decoded hits or columns.
+# Cached post-run decoding of older versions is redone, see modules/decodecache.py
+DECODER_VERSION = 1
+
+ASTROPIX3_COLUMNS = list(ASTROPIX3_DTYPES)
+
+ASTROPIX4_COLUMNS = list(ASTROPIX4_DTYPES)
+
+# AstroPix 4 timestamps are 17bit Gray code (14bit coarse + 3bit fine)
+_TS_BITS = 17
+
+
+def _gen_gray_lut(nbits: int) -> np.ndarray:
+    """
+    Pregenerate Gray code to decimal table for all nbits values
+
+    Decimal value is the prefix XOR of the gray code, computed in log2(nbits) shifts
+    """
+    lut = np.arange(2**nbits, dtype=np.uint32)
+    shift = 1
+    while shift < nbits:
+        lut ^= lut >> shift
+        shift <<= 1
+    return lut
+
+
+_GRAY_LUT = _gen_gray_lut(_TS_BITS)
+
+
+def _as_uint8(readout) -> np.ndarray:
+    """
+    View a readout as uint8 array without copying where possible
+
+    :param readout: bytes, bytearray, memoryview or list of ints
+
+    :returns: 1-D uint8 array
+    """
+    if isinstance(readout, (bytes, bytearray, memoryview)):
+        return np.frombuffer(readout, dtype=np.uint8)
+    return np.asarray(readout, dtype=np.uint8)
+
+
+# Filler bytes of the readout stream as sent by the FPGA, before bit order reversal
+IDLE_BYTE = 0xbc
+RAILING_BYTE = 0xff
+
+
+class LinkQuality:
+    """
+    Frame search counters, for the last readout and summed over all readouts
+
+    frames_decoded: Frames passing validation
+    frames_rejected: Header candidates failing validation, not inside a decoded frame
+    bytes_skipped: Bytes outside decoded frames which are neither idle nor railing
+    """
+
+    COUNTERS = ('frames_decoded', 'frames_rejected', 'bytes_skipped')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Set all counters to zero"""
+        self.readouts = 0
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.last = dict.fromkeys(self.COUNTERS, 0)
+
+    def add(self, frames_decoded: int, frames_rejected: int, bytes_skipped: int):
+        """Count one readout"""
+        self.readouts += 1
+        self.last = {'frames_decoded': frames_decoded, 'frames_rejected': frames_rejected, 'bytes_skipped': bytes_skipped}
+        for key, value in self.last.items():
+            self.totals[key] += value
+
+    def merge(self, other):
+        """Add the counters of another LinkQuality, e.g. of readouts decoded in another process"""
+        self.readouts += other.readouts
+        self.last = dict(other.last)
+        for key, value in other.totals.items():
+            self.totals[key] += value
+
+    @property
+    def error_rate(self) -> float:
+        """Fraction of rejected frames of all frames found"""
+        found = self.totals['frames_decoded'] + self.totals['frames_rejected']
+        return self.totals['frames_rejected'] / found if found else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.readouts} readouts, {self.totals['frames_decoded']} frames decoded, "
+                f"{self.totals['frames_rejected']} rejected ({self.error_rate:.2%}), "
+                f"{self.totals['bytes_skipped']} bytes skipped")
+
+
 class Decode:
-    def __init__(self, sampleclock_period_ns: int = 5, nchips: int = 1, bytesperhit: int = 5):
+    def __init__(self, sampleclock_period_ns: int = 5, nchips: int = 1, bytesperhit: int = 5,
+                 rows: int = None, cols: int = None):
+        """
+        :param sampleclock_period_ns: Sample clock period, unit of AstroPix 3 ToT
+        :param nchips: Number of daisy chained chips
+        :param bytesperhit: 5 for AstroPix 3, 8 for AstroPix 4
+        :param rows: Rows of the pixel matrix, frames with a larger row are rejected. Default: no check
+        :param cols: Columns of the pixel matrix, frames with a larger column are rejected. Default: no check
+        """
         self._sampleclock_period_ns = sampleclock_period_ns
         self._bytesperhit = bytesperhit
         self._idbits = 3
         self._nchips = nchips
+        self._rows = rows
+        self._cols = cols
+
+        self.link = LinkQuality()
 
         self._header = set()
         self._header_rev = set()
@@ -38,9 +147,37 @@ class Decode:
             id = (i << self._idbits) + self._bytesperhit - 1
             self._header.add(id)
 
-            id_rev = int(f'{id:08b}'[::-1], 2)
+            id_rev = BITREVERSE_TABLE[id]
             self._header_rev.add(id_rev)
 
+        # Lookup tables marking header bytes, used by the vectorized decoder
+        self._header_lut = np.zeros(256, dtype=bool)
+        self._header_lut[list(self._header)] = True
+        self._header_rev_lut = np.zeros(256, dtype=bool)
+        self._header_rev_lut[list(self._header_rev)] = True
+
+        self._gen_valid_lut()
+
+    def _gen_valid_lut(self):
+        """
+        Pregenerate validity of all values of the two frame bytes checked by valid_frames,
+        for bit order reversed and not reversed streams
+        """
+        # AstroPix 4 row/col are in byte 1 and 2, AstroPix 3 location in byte 1 and ToT MSB in byte 3
+        self._valid_offsets = (1, 2) if self._bytesperhit == 8 else (1, 3)
+
+        values = np.arange(256 * 256)
+        frames = np.zeros((len(values), self._bytesperhit), dtype=np.uint8)
+        frames[:, self._valid_offsets[0]] = values >> 8
+        frames[:, self._valid_offsets[1]] = values & 0xff
+
+        self._valid_lut = self.valid_frames(frames).reshape(256, 256)
+        self._valid_rev_lut = self._valid_lut[np.ix_(BITREVERSE_LUT, BITREVERSE_LUT)]
+
+        # Same tables as bytes indexed by (first << 8) | second, for checking single frames
+        self._valid_table = self._valid_lut.tobytes()
+        self._valid_rev_table = self._valid_rev_lut.tobytes()
+
     def gray_to_dec(self, gray: int) -> int:
         """
         Decode Gray code to decimal
@@ -54,13 +191,7 @@ class Decode:
         return gray
 
     def reverse_bitorder(self, data: bytearray) -> bytearray:
-        reversed_data = bytearray()
-
-        for item in data:
-            item_rev = int(bin(item)[2:].zfill(8)[::-1], 2)
-            reversed_data.append(item_rev)
-
-        return reversed_data
+        return bytearray(data).translate(BITREVERSE_TABLE)
 
     def hits_from_readoutstream(self, readout: bytearray, reverse_bitorder: bool = True) -> list:
         """
@@ -95,6 +226,282 @@ class Decode:
 
         return hitlist
 
+    def _find_headers(self, raw: bytes, reverse_bitorder: bool = True) -> list:
+        """
+        Sorted positions of header bytes found with bytes.find
+
+        :returns: List of positions, None if there are more candidates than a small budget
+        """
+        header = self._header_rev if reverse_bitorder else self._header
+        find = raw.find
+
+        budget = 16 + (len(raw) >> 9)
+        positions = []
+        for h in header:
+            p = find(h)
+            while p != -1:
+                positions.append(p)
+                if len(positions) > budget:
+                    return None
+                p = find(h, p + 1)
+
+        if len(header) > 1:
+            positions.sort()
+        return positions
+
+    def header_candidates(self, data: np.ndarray, reverse_bitorder: bool = True) -> np.ndarray:
+        """
+        Find all bytes in readoutstream matching a header
+
+        Readouts are mostly idle (0xBC) and railing (0xFF) bytes. For sparse readouts bytes.find
+        jumps from header byte to header byte at memchr speed, so the cost scales with the number of hits.
+        If a readout has more candidates than a small budget, a vectorized mask over the stream is used.
+
+        :param data: Readout stream as uint8 array
+        :param reverse_bitorder: Reverse Bitorder per byte
+
+        :returns: Sorted array of candidate positions
+        """
+        positions = self._find_headers(data.tobytes(), reverse_bitorder)
+        if positions is not None:
+            return np.array(positions, dtype=np.intp)
+
+        # Dense readout
+        header = self._header_rev if reverse_bitorder else self._header
+        if len(header) == 1:
+            return np.flatnonzero(data == next(iter(header)))
+
+        header_lut = self._header_rev_lut if reverse_bitorder else self._header_lut
+        return np.flatnonzero(header_lut[data])
+
+    def valid_frames(self, frames: np.ndarray) -> np.ndarray:
+        """
+        Check frames for values the chip never sends
+
+        AstroPix 3: reserved location bit 6 and upper nibble of ToT MSB must be 0,
+                    row/column within the matrix
+        AstroPix 4: row and column within the matrix
+
+        :param frames: 2-D array with one frame per row, bit order already reversed
+
+        :returns: Boolean array, True for valid frames
+        """
+        if self._bytesperhit == 8:
+            valid = np.ones(len(frames), dtype=bool)
+            if self._rows is not None:
+                valid &= (frames[:, 1] >> 3) < self._rows
+            if self._cols is not None:
+                valid &= (((frames[:, 1] & 0b111) << 2) + (frames[:, 2] >> 6)) < self._cols
+            return valid
+
+        location = frames[:, 1]
+        valid = ((location & 0b1000000) == 0) & ((frames[:, 3] & 0b11110000) == 0)
+        if self._rows is not None and self._cols is not None:
+            limit = np.where(location >> 7, self._cols, self._rows)
+            valid &= (location & 0b111111) < limit
+        return valid
+
+    def frame_positions(self, data: np.ndarray, reverse_bitorder: bool = True, validate: bool = True) -> tuple:
+        """
+        Find start of all complete frames in readoutstream
+
+        Frames are taken greedily from the first header candidate on,
+        a candidate inside an already taken frame is payload.
+        Candidates failing valid_frames are rejected and the search resynchronizes on the next
+        header, even inside the rejected frame. Counters are updated in self.link.
+
+        :param data: Readout stream as uint8 array
+        :param reverse_bitorder: Reverse Bitorder per byte
+        :param validate: Reject invalid frames
+
+        :returns: Array with start of complete frames, start of the unfinished frame at the end
+                  of the stream or None if the last frame is complete
+        """
+        raw = data.tobytes()
+        positions = self._find_headers(raw, reverse_bitorder)
+
+        if positions is None:
+            return self._frame_positions_dense(data, raw, reverse_bitorder, validate)
+
+        # Sparse readout, a few candidates are faster checked one by one than with array operations
+        bytesperhit = self._bytesperhit
+        first, second = self._valid_offsets
+        valid_table = (self._valid_rev_table if reverse_bitorder else self._valid_table) if validate else None
+        end = len(raw)
+
+        starts = []
+        tail = None
+        rejected = 0
+        next_frame = 0
+        for p in positions:
+            if p < next_frame:
+                continue
+            if p + bytesperhit > end:
+                tail = p
+                break
+            if valid_table is not None and not valid_table[(raw[p + first] << 8) | raw[p + second]]:
+                rejected += 1
+                continue
+            starts.append(p)
+            next_frame = p + bytesperhit
+
+        idle = IDLE_BYTE if reverse_bitorder else BITREVERSE_TABLE[IDLE_BYTE]
+        filler = 0
+        for p in starts:
+            frame = raw[p:p + bytesperhit]
+            filler += frame.count(idle) + frame.count(RAILING_BYTE)
+
+        self._count_link(raw, len(starts), filler, tail, rejected, idle)
+
+        return np.array(starts, dtype=np.intp), tail
+
+    def _frame_positions_dense(self, data: np.ndarray, raw: bytes, reverse_bitorder: bool, validate: bool) -> tuple:
+        """Vectorized frame_positions for readouts with many header candidates"""
+        bytesperhit = self._bytesperhit
+
+        candidates = self.header_candidates(data, reverse_bitorder)
+        rejected = candidates[:0]
+
+        if validate and len(candidates):
+            # Complete frames are a prefix of the sorted candidates, the unfinished one can not be checked yet
+            ncomplete = np.searchsorted(candidates, len(data) - bytesperhit, side='right')
+            complete = candidates[:ncomplete]
+            valid_lut = self._valid_rev_lut if reverse_bitorder else self._valid_lut
+            first, second = self._valid_offsets
+            valid = valid_lut[data[complete + first], data[complete + second]]
+            if not valid.all():
+                keep = np.ones(len(candidates), dtype=bool)
+                keep[:ncomplete] = valid
+                rejected = candidates[~keep]
+                candidates = candidates[keep]
+
+        if len(candidates) > 1 and np.any(np.diff(candidates) < bytesperhit):
+            # Headers found inside payload, follow the chain of frames.
+            # next_frame[j] is the first candidate after the frame starting at candidate j
+            next_frame = np.searchsorted(candidates, candidates + bytesperhit).tolist()
+            chain = []
+            j = 0
+            while j < len(next_frame):
+                chain.append(j)
+                j = next_frame[j]
+            candidates = candidates[chain]
+
+        # Only the last frame of the chain can be cut off at the end of the stream
+        tail = None
+        if len(candidates) and candidates[-1] + bytesperhit > len(data):
+            candidates, tail = candidates[:-1], int(candidates[-1])
+
+        if len(rejected) and len(candidates):
+            # Rejected headers inside a decoded frame were payload anyway
+            previous = np.searchsorted(candidates, rejected, side='right') - 1
+            inside = (previous >= 0) & (rejected < candidates[np.maximum(previous, 0)] + bytesperhit)
+            rejected = rejected[~inside]
+        if tail is not None:
+            rejected = rejected[rejected < tail]
+
+        idle = IDLE_BYTE if reverse_bitorder else BITREVERSE_TABLE[IDLE_BYTE]
+        frames = data[candidates[:, None] + np.arange(bytesperhit)]
+        filler = int(np.count_nonzero((frames == idle) | (frames == RAILING_BYTE)))
+
+        self._count_link(raw, len(candidates), filler, tail, len(rejected), idle)
+
+        return candidates, tail
+
+    def _count_link(self, raw: bytes, nframes: int, filler: int, tail: int, rejected: int, idle: int):
+        """
+        Update self.link for one readout, see frame_positions
+
+        Everything apart from idle and railing bytes, decoded frames and the unfinished frame was skipped.
+        filler is the number of bytes with idle or railing values inside decoded frames, they are payload.
+        """
+        end = len(raw) if tail is None else tail
+        skipped = end - raw.count(idle, 0, end) - raw.count(RAILING_BYTE, 0, end) - nframes * self._bytesperhit + filler
+
+        self.link.add(nframes, rejected, skipped)
+
+    def frames_from_readoutstream(self, readout: bytearray, reverse_bitorder: bool = True, validate: bool = True) -> np.ndarray:
+        """
+        Find hits in readoutstream, vectorized version of hits_from_readoutstream
+
+        A hit cut off at the end of the stream is dropped, see StreamDecoder to keep it.
+
+        :param readout: Readout stream
+        :param reverse_bitorder: Reverse Bitorder per byte
+        :param validate: Reject invalid frames, see frame_positions
+
+        :returns: 2-D uint8 array with one frame per row
+        """
+        data = _as_uint8(readout)
+        starts, _ = self.frame_positions(data, reverse_bitorder, validate)
+
+        return self.gather_frames(data, starts, reverse_bitorder)
+
+    def gather_frames(self, data: np.ndarray, starts: np.ndarray, reverse_bitorder: bool = True) -> np.ndarray:
+        """
+        Gather frames from readoutstream
+
+        :param data: Readout stream as uint8 array
+        :param starts: Start of frames, see frame_positions
+        :param reverse_bitorder: Reverse Bitorder per byte
+
+        :returns: 2-D uint8 array with one frame per row
+        """
+        frames = data[starts[:, None] + np.arange(self._bytesperhit)]
+
+        if reverse_bitorder:
+            frames = BITREVERSE_LUT[frames]
+
+        return frames
+
+    def decode_astropix3_batch(self, frames: np.ndarray, i: int, printer: bool = False) -> HitBatch:
+        """
+        Decode 5byte Frames from AstroPix 3, vectorized version of decode_astropix3_hits
+
+        :param frames: 2-D array with one frame per row, see frames_from_readoutstream
+        i: int - Readout number
+
+        :returns: HitBatch with decoded hits
+        """
+        header      = frames[:, 0]
+        location    = frames[:, 1]
+        tot_msb     = frames[:, 3] & 0b1111
+        tot_lsb     = frames[:, 4]
+        tot_total   = (tot_msb.astype(np.uint16) << 8) + tot_lsb
+
+        hits = HitBatch({
+            'readout':      i,
+            'Chip ID':      header >> 3,
+            'payload':      header & 0b111,
+            'location':     location & 0b111111,
+            'isCol':        location >> 7 & 1,
+            'timestamp':    frames[:, 2],
+            'tot_msb':      tot_msb,
+            'tot_lsb':      tot_lsb,
+            'tot_total':    tot_total,
+            'tot_us':       (tot_total * self._sampleclock_period_ns) / 1000.0,
+            'hittime':      time.time(),
+        }, ASTROPIX3_DTYPES)
+
+        if printer:
+            for hit in zip(*hits.columns.values()):
+                logger.info(
+                "Header: ChipId: %d\tPayload: %d\t"
+                "Location: %d\tRow/Col: %d\t"
+                "Timestamp: %d\t"
+                "ToT: MSB: %d\tLSB: %d Total: %d (%f us)",
+                hit[1], hit[2], hit[3], hit[4], hit[5], hit[6], hit[7], hit[8], hit[9]
+                )
+
+        return hits
+
+    def decode_astropix3_frames(self, frames: np.ndarray, i: int, printer: bool = False) -> pd.DataFrame:
+        """
+        Decode 5byte Frames from AstroPix 3, see decode_astropix3_batch
+
+        :returns: Dataframe with decoded hits
+        """
+        return self.decode_astropix3_batch(frames, i, printer).to_dataframe()
+
     def decode_astropix3_hits(self, list_hits: list, i:int, printer:bool = False) -> pd.DataFrame:
         """
         Decode 5byte Frames from AstroPix 3
@@ -141,7 +548,68 @@ class Decode:
                     id, payload, location, col, timestamp, tot_msb, tot_lsb, tot_total, tot_us
                     )
 
-        return pd.DataFrame(hit_pd, columns=['readout','Chip ID','payload','location', 'isCol', 'timestamp', 'tot_msb','tot_lsb','tot_total', 'tot_us', 'hittime'])
+        return pd.DataFrame(hit_pd, columns=ASTROPIX3_COLUMNS)
+
+    def decode_astropix4_batch(self, frames: np.ndarray, printer: bool = False) -> HitBatch:
+        """
+        Decode 8byte Frames from AstroPix 4, vectorized version of decode_astropix4_hits
+
+        Gray coded timestamps are decoded with a pregenerated lookup table.
+
+        :param frames: 2-D array with one frame per row, see frames_from_readoutstream
+
+        :returns: HitBatch with decoded hits
+        """
+        header, byte1, byte2, byte3, byte4, byte5, byte6, byte7 = frames.astype(np.int64).T
+
+        ts1         = ((byte2 & 0b11111) << 9) + (byte3 << 1) + (byte4 >> 7)
+        tsfine1     = (byte4 >> 4) & 0b111
+        ts2         = ((byte5 & 0b111111) << 8) + byte6
+        tsfine2     = (byte7 >> 5) & 0b111
+
+        ts_dec1     = _GRAY_LUT[(ts1 << 3) + tsfine1]
+        ts_dec2     = _GRAY_LUT[(ts2 << 3) + tsfine2]
+
+        hits = HitBatch({
+            'id':       header >> 3,
+            'payload':  header & 0b111,
+            'row':      byte1 >> 3,
+            'col':      ((byte1 & 0b111) << 2) + (byte2 >> 6),
+            'ts1':      ts1,
+            'tsfine1':  tsfine1,
+            'ts2':      ts2,
+            'tsfine2':  tsfine2,
+            'tsneg1':   (byte2 >> 5) & 0b1,
+            'tsneg2':   (byte5 >> 6) & 0b1,
+            'tstdc1':   ((byte4 & 0b1111) << 1) + (byte5 >> 7),
+            'tstdc2':   byte7 & 0b11111,
+            'ts_dec1':  ts_dec1,
+            'ts_dec2':  ts_dec2,
+            # If TS counter wrapped -> ts_dec2 < ts_dec1, the modulo adds 2**17
+            'tot_us':   ((ts_dec2.astype(np.int64) - ts_dec1) % 2**_TS_BITS) / 20,
+        }, ASTROPIX4_DTYPES)
+
+        if printer:
+            for hit in zip(*hits.columns.values()):
+                logger.info(
+                "Header: ChipId: %d\tPayload: %d\t"
+                "Row: %d\t Col: %d\t"
+                "TS1: %d\t TS1_fine %d\t"
+                "TS2: %d\t TS2_fine %d\t"
+                "TS1_dec: %d\t TS2_dec %d\t"
+                "Total ToT [us]: %f us",
+                hit[0], hit[1], hit[2], hit[3], hit[4], hit[5], hit[6], hit[7], hit[12], hit[13], hit[14]
+                )
+
+        return hits
+
+    def decode_astropix4_frames(self, frames: np.ndarray, printer: bool = False) -> pd.DataFrame:
+        """
+        Decode 8byte Frames from AstroPix 4, see decode_astropix4_batch
+
+        :returns: Dataframe with decoded hits
+        """
+        return self.decode_astropix4_batch(frames, printer).to_dataframe()
 
     def decode_astropix4_hits(self, list_hits: list, printer:bool = False) -> pd.DataFrame:
         """
@@ -194,5 +662,111 @@ class Decode:
                     id, payload, row, col, ts1, tsfine1, ts2, tsfine2, ts_dec1, ts_dec2, tot_us
                     )
 
-        return pd.DataFrame(hit_pd, columns=['id', 'payload', 'row', 'col', 'ts1', 'tsfine1', 'ts2',
-                                             'tsfine2', 'tsneg1', 'tsneg2', 'tstdc1', 'tstdc2', 'ts_dec1', 'ts_dec2','tot_us'])
+        return pd.DataFrame(hit_pd, columns=ASTROPIX4_COLUMNS)
+
+
+class StreamDecoder:
+    """
+    Stateful decoder for a continuous readout stream
+
+    A frame cut off at the end of a readout is kept and prepended to the next readout,
+    instead of being dropped as in Decode.frames_from_readoutstream.
+    Decoded hits are routed per chip of the telescope into self.chips, see core.hitbatch.ChipDemux.
+    Frame search counters are kept in self.link, see LinkQuality.
+    With chiptime, hits get a 'chiptime' column with the unwrapped timestamp, see core.timestamps.
+    """
+
+    def __init__(self, decoder: Decode, chipversion: int = 3, keep_chip_hits: bool = False, chiptime: bool = False):
+        """
+        :param decoder: Decode object matching the ASIC configuration
+        :param chipversion: Chip version, selects the AstroPix 3 or 4 frame format
+        :param keep_chip_hits: Keep decoded hits in one buffer per chip, otherwise only per chip statistics
+        :param chiptime: Add monotonic chip time in sample clock periods to the hits
+        """
+        self.decoder = decoder
+        self.chipversion = chipversion
+
+        self._carry = b''
+        self.frames_recovered = 0
+        self.frames_dropped = 0
+
+        self.unwrapper = TimestampUnwrapper(chipversion, decoder._sampleclock_period_ns) if chiptime else None
+
+        self._dtypes = hit_dtypes(chipversion, chiptime)
+
+        self.chips = ChipDemux(decoder._nchips, self.dtypes, keep_hits=keep_chip_hits)
+
+    @property
+    def link(self) -> LinkQuality:
+        """Frame search counters of the decoder"""
+        return self.decoder.link
+
+    @property
+    def carry(self) -> bytes:
+        """Unfinished frame waiting for the next readout"""
+        return self._carry
+
+    @property
+    def dtypes(self) -> dict:
+        """Columns of the decoded hits"""
+        return self._dtypes
+
+    def feed(self, readout: bytearray, i: int = 0, printer: bool = False, readout_time: float = None) -> HitBatch:
+        """
+        Decode next readout of the stream
+
+        :param readout: Readout stream
+        :param i: Readout number
+        :param printer: Print decoded output to terminal
+        :param readout_time: Host time of the readout in s, anchor for the chip time. Default: None, no anchor
+
+        :returns: HitBatch with decoded hits, including a frame started in the previous readout
+        """
+        carried = len(self._carry)
+        data = np.frombuffer(self._carry + bytes(readout), dtype=np.uint8)
+
+        starts, tail = self.decoder.frame_positions(data)
+
+        if carried and len(starts) and starts[0] < carried:
+            self.frames_recovered += 1
+        elif carried and (tail is None or tail >= carried):
+            # Carried bytes are not the start of a valid frame in this readout, nor still waiting
+            self.frames_dropped += 1
+            logger.debug("Dropped unfinished frame %s, not continued by readout %d", self._carry.hex(), i)
+
+        self._carry = b'' if tail is None else data[tail:].tobytes()
+        frames = self.decoder.gather_frames(data, starts)
+
+        if self.chipversion == 4:
+            hits = self.decoder.decode_astropix4_batch(frames, printer)
+        else:
+            hits = self.decoder.decode_astropix3_batch(frames, i, printer)
+
+        if self.unwrapper is not None:
+            timestamps = hits['ts_dec1'] if self.chipversion == 4 else hits['timestamp']
+            hits = HitBatch({**hits.columns, 'chiptime': self.unwrapper.unwrap(timestamps, readout_time)}, self.dtypes)
+
+        self.chips.add(hits, readout_time)
+
+        return hits
+
+    def flush(self) -> None:
+        """
+        End of stream, drops the unfinished frame
+        """
+        if self._carry:
+            self.frames_dropped += 1
+            logger.debug("Dropped unfinished frame %s at end of stream", self._carry.hex())
+        self._carry = b''
+
+    def reset(self) -> None:
+        """
+        Start a new stream, drops the unfinished frame and resets counters and per chip hits
+        """
+        self.flush()
+        self.frames_recovered = 0
+        self.frames_dropped = 0
+        self.chips.clear()
+        self.decoder.link.reset()
+        if self.unwrapper is not None:
+            self.unwrapper.reset()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Columnar containers for decoded hits
+
+HitBatch holds the hits of one decoded readout as one NumPy array per column,
+HitBuffer collects batches of a whole run in preallocated arrays,
+ChipDemux splits them into one HitBuffer per telescope chip.
+"""
+
+import numpy as np
+import pandas as pd
+import time
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Column names and dtypes of decoded AstroPix 3 hits
+ASTROPIX3_DTYPES = {
+    'readout':      np.uint32,
+    'Chip ID':      np.uint8,
+    'payload':      np.uint8,
+    'location':     np.uint8,
+    'isCol':        np.uint8,
+    'timestamp':    np.uint8,
+    'tot_msb':      np.uint8,
+    'tot_lsb':      np.uint8,
+    'tot_total':    np.uint16,
+    'tot_us':       np.float64,
+    'hittime':      np.float64,
+}
+
+# Column names and dtypes of decoded AstroPix 4 hits
+ASTROPIX4_DTYPES = {
+    'id':           np.uint8,
+    'payload':      np.uint8,
+    'row':          np.uint8,
+    'col':          np.uint8,
+    'ts1':          np.uint16,
+    'tsfine1':      np.uint8,
+    'ts2':          np.uint16,
+    'tsfine2':      np.uint8,
+    'tsneg1':       np.uint8,
+    'tsneg2':       np.uint8,
+    'tstdc1':       np.uint8,
+    'tstdc2':       np.uint8,
+    'ts_dec1':      np.uint32,
+    'ts_dec2':      np.uint32,
+    'tot_us':       np.float64,
+}
+
+
+# Optional column of unwrapped chip time in sample clock periods, see core.timestamps
+CHIPTIME_DTYPES = {
+    'chiptime':     np.int64,
+}
+
+
+def hit_dtypes(chipversion: int, chiptime: bool = False) -> dict:
+    """
+    Columns of decoded hits
+
+    :param chipversion: Chip version, 4 or older
+    :param chiptime: Add the chiptime column
+    """
+    dtypes = ASTROPIX4_DTYPES if chipversion == 4 else ASTROPIX3_DTYPES
+    return {**dtypes, **CHIPTIME_DTYPES} if chiptime else dtypes
+
+
+class HitBatch:
+    """
+    Decoded hits, one NumPy array per column
+    """
+
+    def __init__(self, columns: dict, dtypes: dict = None):
+        """
+        :param columns: Dict of column name to array or scalar, scalars are broadcast to all hits
+        :param dtypes: Dict of column name to dtype, defines column order. Default: dtypes of columns
+        """
+        if dtypes is None:
+            dtypes = {name: np.asarray(col).dtype for name, col in columns.items()}
+
+        length = max((np.size(col) for col in columns.values() if np.ndim(col)), default=0)
+
+        self.dtypes = dtypes
+        self.columns = {}
+        for name, dtype in dtypes.items():
+            col = np.asarray(columns[name], dtype=dtype)
+            self.columns[name] = col if col.ndim else np.full(length, col, dtype=dtype)
+
+    @classmethod
+    def empty(cls, dtypes: dict):
+        """Batch without hits"""
+        return cls({name: np.empty(0, dtype=dtype) for name, dtype in dtypes.items()}, dtypes)
+
+    @classmethod
+    def concat(cls, batches: list, dtypes: dict = None):
+        """
+        Concatenate batches with the same columns
+
+        :param batches: List of HitBatch
+        :param dtypes: Column dtypes, only needed if batches is empty
+        """
+        if not batches:
+            return cls.empty(dtypes)
+        dtypes = batches[0].dtypes
+        return cls({name: np.concatenate([b.columns[name] for b in batches]) for name in dtypes}, dtypes)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), ()))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def select(self, mask: np.ndarray):
+        """
+        Subset of hits
+
+        :param mask: Boolean mask or index array
+        """
+        return HitBatch({name: col[mask] for name, col in self.columns.items()}, self.dtypes)
+
+    def split(self, column: str, n: int) -> list:
+        """
+        Hits grouped by an integer column with one stable sort, e.g. by chip ID
+
+        :param column: Column with values 0 to n - 1, hits with larger values are left out
+        :param n: Number of groups
+
+        :returns: List of (value, HitBatch) for every value with hits
+        """
+        values = self.columns[column]
+        counts = np.bincount(values, minlength=n)[:n]
+        order = np.argsort(values, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        return [(int(v), self.select(order[bounds[v]:bounds[v + 1]])) for v in np.flatnonzero(counts)]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Convert to DataFrame with one column per field"""
+        return pd.DataFrame(self.columns)
+
+
+class HitBuffer:
+    """
+    Growable buffer for the decoded hits of a whole run
+
+    Batches are copied into preallocated arrays, which double in size when full.
+    Appending costs O(hits) amortized, independent of the number of hits already in the buffer.
+    """
+
+    def __init__(self, dtypes: dict, capacity: int = 4096):
+        """
+        :param dtypes: Column names and dtypes, ASTROPIX3_DTYPES or ASTROPIX4_DTYPES
+        :param capacity: Initial number of hits
+        """
+        self.dtypes = dtypes
+        self._size = 0
+        self._capacity = capacity
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in dtypes.items()}
+        # Position of each hit in its batch, used as DataFrame index
+        self._order = np.empty(capacity, dtype=np.uint32)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _grow(self, size: int):
+        capacity = max(size, 2 * self._capacity)
+        logger.debug("Growing hit buffer to %d hits", capacity)
+
+        for name, col in self._columns.items():
+            new = np.empty(capacity, dtype=col.dtype)
+            new[:self._size] = col[:self._size]
+            self._columns[name] = new
+
+        order = np.empty(capacity, dtype=np.uint32)
+        order[:self._size] = self._order[:self._size]
+        self._order = order
+
+        self._capacity = capacity
+
+    def append(self, batch: HitBatch, order: np.ndarray = None):
+        """
+        Copy hits of a batch to the end of the buffer
+
+        :param batch: HitBatch with the columns of this buffer
+        :param order: Position of each hit in its readout, if the batch holds several readouts. Default: position in the batch
+        """
+        n = len(batch)
+        end = self._size + n
+
+        if end > self._capacity:
+            self._grow(end)
+
+        for name, col in self._columns.items():
+            col[self._size:end] = batch.columns[name]
+        self._order[self._size:end] = np.arange(n) if order is None else order
+
+        self._size = end
+
+    def clear(self):
+        """Remove all hits, keeps allocated memory"""
+        self._size = 0
+
+    @property
+    def order(self) -> np.ndarray:
+        """Position of each hit in its batch, view into the buffer"""
+        return self._order[:self._size]
+
+    def to_batch(self) -> HitBatch:
+        """All hits as HitBatch, arrays are views into the buffer"""
+        return HitBatch({name: col[:self._size] for name, col in self._columns.items()}, self.dtypes)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        All hits as DataFrame, indexed by the position of the hit in its batch
+        as when concatenating the DataFrames of single readouts
+        """
+        return pd.DataFrame({name: col[:self._size].copy() for name, col in self._columns.items()},
+                            index=self._order[:self._size].astype(np.int64))
+
+
+class ChipDemux:
+    """
+    Route decoded hits of a telescope to one HitBuffer per chip and keep statistics per chip
+
+    Hits are split with one stable sort per batch, so consumers of a single chip do not
+    need to filter the whole run by chip ID again.
+    """
+
+    def __init__(self, nchips: int, dtypes: dict, keep_hits: bool = True):
+        """
+        :param nchips: Number of chips in the telescope
+        :param dtypes: Column names and dtypes, ASTROPIX3_DTYPES or ASTROPIX4_DTYPES
+        :param keep_hits: Keep hits in per chip buffers, if False only statistics are kept
+        """
+        self.nchips = nchips
+        self.dtypes = dtypes
+        self.keep_hits = keep_hits
+        self.chip_column = 'Chip ID' if 'Chip ID' in dtypes else 'id'
+
+        self.buffers = [HitBuffer(dtypes) for _ in range(nchips)] if keep_hits else []
+        self.clear()
+
+    def clear(self):
+        """Remove all hits and reset statistics"""
+        for buffer in self.buffers:
+            buffer.clear()
+
+        self.hits = np.zeros(self.nchips, dtype=np.int64)
+        self.tot_us = np.zeros(self.nchips, dtype=np.float64)
+        self.readouts = 0
+        self.start_time = None
+        self.last_time = None
+
+    def add(self, batch: HitBatch, readout_time: float = None):
+        """
+        Add hits of one readout
+
+        :param batch: Decoded hits
+        :param readout_time: Host time of the readout. Default: time.time()
+        """
+        readout_time = time.time() if readout_time is None else readout_time
+        if self.start_time is None:
+            self.start_time = readout_time
+        self.last_time = readout_time
+        self.readouts += 1
+
+        if not len(batch):
+            return
+
+        chip = batch[self.chip_column]
+        if chip.max() >= self.nchips:
+            logger.warning("Dropping hits with chip ID >= %d", self.nchips)
+            batch = batch.select(chip < self.nchips)
+            chip = batch[self.chip_column]
+
+        counts = np.bincount(chip, minlength=self.nchips)
+        self.hits += counts
+        self.tot_us += np.bincount(chip, weights=batch['tot_us'], minlength=self.nchips)
+
+        if self.keep_hits:
+            if self.nchips == 1:
+                self.buffers[0].append(batch)
+                return
+            for c, chip_batch in batch.split(self.chip_column, self.nchips):
+                self.buffers[c].append(chip_batch)
+
+    def __getitem__(self, chip: int) -> HitBuffer:
+        return self.buffers[chip]
+
+    def rates(self) -> np.ndarray:
+        """Hit rate per chip in Hz of host time"""
+        elapsed = (self.last_time - self.start_time) if self.start_time is not None else 0.0
+        return self.hits / elapsed if elapsed > 0 else np.zeros(self.nchips)
+
+    def stats(self) -> pd.DataFrame:
+        """Statistics per chip: hits, hit rate, hits per readout, summed and mean ToT"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pd.DataFrame({
+                'chip':             np.arange(self.nchips),
+                'hits':             self.hits,
+                'rate_hz':          self.rates(),
+                'hits_per_readout': self.hits / max(self.readouts, 1),
+                'tot_us_sum':       self.tot_us,
+                'tot_us_mean':      self.tot_us / self.hits,
+            }).set_index('chip')
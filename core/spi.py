@@ -8,6 +8,7 @@ Created on Tue Jul 12 20:07:13 2021
 import logging
 from bitstring import BitArray
 from modules.setup_logger import logger
+from utils.bitorder import BITREVERSE_TABLE
 
 
 # SR
@@ -299,8 +300,7 @@ class Spi:
         """
 
         if not MSBfirst:
-           for index in range(len(data)):
-                data[index] = int(format(data[index], '08b')[::-1], 2)
+            data[:] = bytearray(data).translate(BITREVERSE_TABLE)
 
         logger.debug('SPIdata: %s', data)
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Reconstruction of a continuous chip time from wrapping hit timestamps
+
+AstroPix 3 hits carry an 8bit timestamp, AstroPix 4 hits a 17bit timestamp (ts_dec1),
+both counters wrap many times per second. TimestampUnwrapper counts the wraps across
+readouts and returns a 64bit chip time in sample clock periods.
+"""
+
+import numpy as np
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Timestamp counter width per chip version
+TS_BITS = {3: 8, 4: 17}
+
+# Period of one timestamp count in ns, AstroPix 4 counts 20 per us (see tot_us)
+TS_PERIOD_NS = {3: 500, 4: 50}
+
+
+class TimestampUnwrapper:
+    """
+    Unwrap timestamp counters of consecutive readouts to a monotonic 64bit chip time
+
+    Within a readout hits are in stream order, every step forward in the counter
+    is added to the time. Steps back by less than out_of_order counts are hits sent out of order.
+    Between readouts the host time of the readouts gives the number of full wraps,
+    which can not be seen in the counter. This is exact as long as hits are read out
+    well within half a wrap period, see wrap_period_s.
+    """
+
+    def __init__(self, chipversion: int = 3, sampleclock_period_ns: int = 5, ts_period_ns: int = None,
+                 out_of_order: int = None):
+        """
+        :param chipversion: Chip version, selects counter width
+        :param sampleclock_period_ns: Sample clock period, unit of the returned chip time
+        :param ts_period_ns: Period of one timestamp count. Default: TS_PERIOD_NS of the chip version
+        :param out_of_order: Maximum step back of the counter within a readout. Default: 1/16 of the counter range
+        """
+        self.bits = TS_BITS[chipversion]
+        self.modulo = 1 << self.bits
+        self.ts_period_ns = TS_PERIOD_NS[chipversion] if ts_period_ns is None else ts_period_ns
+        self.sampleclock_period_ns = sampleclock_period_ns
+        self.out_of_order = self.modulo // 16 if out_of_order is None else out_of_order
+
+        self.reset()
+
+    def reset(self):
+        """Start a new run, chip time restarts at the first timestamp"""
+        self._last = None
+        self._last_host = None
+        self.wraps_from_host = 0
+
+    @property
+    def ticks(self) -> int:
+        """Sample clock periods per timestamp count"""
+        return max(round(self.ts_period_ns / self.sampleclock_period_ns), 1)
+
+    @property
+    def wrap_period_s(self) -> float:
+        """Time until the counter wraps"""
+        return self.modulo * self.ts_period_ns * 1e-9
+
+    def unwrap(self, timestamps: np.ndarray, readout_time: float = None) -> np.ndarray:
+        """
+        Unwrap the timestamps of one readout
+
+        :param timestamps: Counter values of the hits in stream order
+        :param readout_time: Host time of the readout in s, used to count wraps since the previous readout.
+            Without it only wraps visible in the counter are counted.
+
+        :returns: int64 array of chip time in sample clock periods
+        """
+        ts = np.asarray(timestamps, dtype=np.int64)
+        if not len(ts):
+            return np.empty(0, dtype=np.int64)
+
+        if self._last is None:
+            steps = np.diff(ts, prepend=ts[0]) % self.modulo
+            start = ts[0]
+        else:
+            steps = np.diff(ts, prepend=self._last % self.modulo) % self.modulo
+            start = self._last
+
+        # Large steps forward are small steps back of hits sent out of order
+        steps[steps >= self.modulo - self.out_of_order] -= self.modulo
+
+        if readout_time is not None:
+            if self._last is not None:
+                steps[0] += self._host_wraps(int(steps[0]), readout_time) * self.modulo
+            self._last_host = readout_time
+
+        counts = start + np.cumsum(steps)
+        self._last = int(counts[-1])
+
+        return counts * self.ticks
+
+    def _host_wraps(self, step: int, readout_time: float) -> int:
+        """Full wraps between the last readout with hits and this one, from host time"""
+        if self._last_host is None:
+            return 0
+
+        elapsed = (readout_time - self._last_host) * 1e9 / self.ts_period_ns
+        wraps = max(int(round((elapsed - step) / self.modulo)), 0)
+        if wraps:
+            self.wraps_from_host += wraps
+            logger.debug("%d timestamp wraps between readouts from host time", wraps)
+        return wraps
@@ -7,31 +7,150 @@ amanda.l.steinhebel@nasa.gov
 
 from astropix import astropixRun
 import glob
-import binascii
+import itertools
+import multiprocessing
+import os
+import time
 import pandas as pd
 import numpy as np
 import logging
 import argparse
 import re
 from core.asic import Asic
+from core.decode import LinkQuality
+from core.hitbatch import HitBatch, HitBuffer
+from modules.decodecache import CACHE_SUFFIX, decode_settings, plan_decode, save_entry
+from modules.hitwriter import open_hit_writer, APPEND_FORMATS, HIT_FORMATS
+from modules.rawdata import RAW_SUFFIX, RawReader
+from modules.rotation import iter_segments
+from modules.runcatalog import register_files
 
 from modules.setup_logger import logger
 
+#Decoder of a worker process, set up once per process by init_worker
+worker = {}
+
+def init_worker(chipVer, chiptime, printDecode):
+    worker['astro'] = astropixRun(offline=True)
+    worker['options'] = (chipVer, chiptime, printDecode)
+
+
+def output_name(outpath, infile):
+    #split Mac or OS path; identify file name and eliminate '.log' or '.raw'
+    return outpath + re.split(r'\\|/',infile)[-1][:-4] + '_offline'
+
+
+def segment_inputs(manifest, follow=False):
+    """
+    Segments of a rotated run as inputs of chunk_tasks, each continues the stream of the previous one
+
+    :yields: Log of the segment, log of the previous segment, whether it is the last segment of the run
+    """
+    previous = None
+    for segment in iter_segments(manifest, follow=follow):
+        if segment['log'] is None:
+            continue
+        yield segment['log'], previous, segment['last']
+        previous = segment['log']
+
+
+def chunk_tasks(inputs, chunkReadouts, outpath, settings, reuse=True):
+    """
+    Split input files into chunks of readouts, decoded in order by decode_chunk
+    Indexing a file saves its offset index next to it, so workers do not scan the file again
+    With reuse, readouts decoded before with the same settings are skipped, see modules/decodecache.py
+
+    :param inputs: File, file whose stream it continues or None, whether the stream ends with the file
+
+    :yields: File, first readout, end of the chunk, readouts of the file, first readout decoded, cache entry,
+             previous file, end of stream
+    """
+    for infile, previous, last in inputs:
+        with RawReader(infile) as reader:
+            nreadouts = len(reader)
+            #Chip time is unwrapped from the first readout, appended hits would not continue it
+            append = settings['hitformat'] in APPEND_FORMATS and not settings['chiptime']
+            first, entry = plan_decode(reader, output_name(outpath, infile) + CACHE_SUFFIX, settings, append, reuse)
+
+        if first is None:
+            logger.info(f"{infile}: {nreadouts} readouts decoded before, skipping")
+            continue
+        if first:
+            logger.info(f"{infile}: {first} readouts decoded before, continuing with readout {first}")
+
+        size = chunkReadouts if chunkReadouts else max(nreadouts - first, 1)
+        for start in range(first, max(nreadouts, first + 1), size):
+            yield infile, start, min(start + size, nreadouts), nreadouts, first, entry, previous, last
+
+
+def previous_readout(path):
+    """Last readout of a file, as record -1 of the file continuing its stream"""
+    with RawReader(path) as reader:
+        if len(reader):
+            yield -1, next(reader.records(len(reader) - 1))
+
+
+def decode_chunk(task):
+    """
+    Decode one chunk of readouts as part of the stream of its file
+    The readout before the chunk is decoded first and dropped, so hits split at the chunk boundary are kept as when decoding the file at once
+    The first chunk of a segment of a rotated run starts with the last readout of the previous segment
+
+    :returns: task, HitBatch, position of the hits in their readout, LinkQuality, frames recovered and dropped
+    """
+    infile, start, stop, nreadouts, _, _, previous, last = task
+    chipVer, chiptime, printDecode = worker['options']
+    astro = worker['astro']
+
+    #Readouts are replayed as one stream, hits split between two readouts are decoded
+    stream_decoder = astro.get_stream_decoder(chipVer, chiptime=chiptime)
+    stream_decoder.reset()
+
+    #hittime of AstroPix2/3 hits is the host time of the readout, AstroPix4 hits have no hittime as in beam_test.py
+    dtypes = stream_decoder.dtypes
+    hitbuffer = HitBuffer(dtypes)
+
+    #Import data file, text log or raw file is memory mapped and read one readout at a time
+    with RawReader(infile) as reader:
+        #Raw files keep the host time of every readout, NaN for text logs
+        host_times = np.nan_to_num(reader.index['host_time'])
+
+        first = max(start - 1, 0)
+        records = enumerate(reader.records(first, stop), first)
+        if start == 0 and previous is not None:
+            records = itertools.chain(previous_readout(previous), records)
+        for i,(_, host_time, rawdata) in records:
+            #Lose hittime of text logs - computed during decoding so this info is lost when decoding offline
+            readout_time = None if np.isnan(host_time) else host_time
+            #Invalid frames and empty readouts are handled by the decoder
+            hits = astro.decode_batch(rawdata, max(i, 0), printer = printDecode and i >= start, chip_version=chipVer, stream=True,
+                                      readout_time=readout_time)
+            if i < start: #readout of the previous chunk or segment, only its unfinished frame is kept
+                stream_decoder.frames_recovered = 0
+                stream_decoder.link.reset()
+                continue
+            if 'hittime' in dtypes:
+                hits = HitBatch(dict(hits.columns, hittime=host_times[hits['readout']]), dtypes)
+            hitbuffer.append(hits)
+
+    #The unfinished frame of a segment is continued by the next one
+    if stop == nreadouts and last:
+        stream_decoder.flush()
+
+    return task, hitbuffer.to_batch(), hitbuffer.order, stream_decoder.link, stream_decoder.frames_recovered, stream_decoder.frames_dropped
+
+
 #Initialize
 def main(args):
         
-    #Allow only -f or -d to be evoked - not both
-    if args.fileInput and args.dirInput:
-        logger.error("Input a single file with -f OR a single directory with -d... not both! Try running again")
+    #Allow only -f, -d or -m to be evoked - not several
+    if sum(arg is not None for arg in (args.fileInput, args.dirInput, args.manifest)) > 1:
+        logger.error("Input a single file with -f OR a single directory with -d OR a manifest with -m... not several! Try running again")
         exit()
 
     #Define boolean for args.fileInput
     f_in = True if args.fileInput is not None else False
 
-    #Create objet
-    astro = astropixRun(offline=True)
-    #astro.asic_init()
-
     #Define output file path
     if args.outDir is not None:
         outpath = args.outDir
@@ -43,76 +162,73 @@ def main(args):
         outpath = args.fileInput[:dirInd+1] #add 1 to keep final delimiter in path
     elif args.dirInput is not None:
         outpath = args.dirInput
+    elif args.manifest is not None:
+        outpath = os.path.join(os.path.dirname(args.manifest), '')
     
     #Symmetrize structure
-    inputFiles = [args.fileInput] if f_in else glob.glob(f'{args.dirInput}*.log')
-
-    #Run over all input files
-    for infile in inputFiles:
-
-        #Define output file name
-        csvname = re.split(r'\\|/',infile)[-1][:-4] #split Mac or OS path; identify file name and eliminate '.log'
-        csvpath = outpath + csvname + '_offline.csv'
-
-        #Setup CSV structure
-        if args.chipVer==4:
-            csvframe =pd.DataFrame(columns = [
-            'id',
-            'payload',
-            'row',
-            'col',
-            'ts1',
-            'tsfine1',
-            'ts2',
-            'tsfine2',
-            'tsneg1',
-            'tsneg2',
-            'tstdc1',
-            'tstdc2',
-            'ts_dec1',
-            'ts_dec2',
-            'tot_us'
-            ])
-        else:
-            csvframe =pd.DataFrame(columns = [
-                    'readout',
-                    'Chip ID',
-                    'payload',
-                    'location',
-                    'isCol',
-                    'timestamp',
-                    'tot_msb',
-                    'tot_lsb',
-                    'tot_total',
-                    'tot_us',
-                    'hittime'
-            ])
-
-        #Import data file           
-        if args.chipVer==4: 
-            f=np.loadtxt(infile, skiprows=7, dtype=str)
-        else:
-            f=np.loadtxt(infile, skiprows=6, dtype=str)
-
-        #isolate only bitstream without b'...' structure 
-        strings = [a[2:-1] for a in f[:,1]]
-
-        for i,s in enumerate(strings):
-            #convert hex to binary and decode
-            rawdata = list(binascii.unhexlify(s))
-            try:
-                hits = astro.decode_readout(rawdata, i, printer = args.printDecode, chip_version=args.chipVer)
-                #Lose hittime - computed during decoding so this info is lost when decoding offline (don't even get relative times because they are processed in offline decoding at machine speed)
-                hits['hittime']=0.0
-                #Populate csv
-                csvframe = pd.concat([csvframe, hits])
-            except IndexError: #cannot decode empty bitstream so skip it
-                continue
+    if args.manifest is not None:
+        #Segments of a rotated run, finished segments are decoded while the run continues with --follow
+        inputs = segment_inputs(args.manifest, follow=args.follow)
+    else:
+        inputFiles = [args.fileInput] if f_in else sorted(glob.glob(f'{args.dirInput}*.log') + glob.glob(f'{args.dirInput}*{RAW_SUFFIX}'))
+        inputs = [(infile, None, True) for infile in inputFiles]
+
+    #Files, and large files in chunks of readouts, are decoded in parallel and saved in readout order
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    chunkReadouts = args.chunkReadouts
+    if args.chiptime and chunkReadouts:
+        logger.warning("Chip time is unwrapped over the whole file, files are not split into chunks with --chiptime")
+        chunkReadouts = 0
+    #Unchanged inputs decoded before are skipped, grown inputs continued
+    settings = decode_settings(args.chipVer, args.chiptime, args.hitformat)
+    tasks = chunk_tasks(inputs, chunkReadouts, outpath, settings, reuse=not args.noCache)
+    initargs = (args.chipVer, args.chiptime, args.printDecode)
+    if jobs > 1:
+        logger.info(f"Decoding with {jobs} processes")
+        pool = multiprocessing.Pool(jobs, init_worker, initargs)
+        results = pool.imap(decode_chunk, tasks)
+    else:
+        pool = None
+        init_worker(*initargs)
+        results = map(decode_chunk, tasks)
+
+    start_time = time.time()
+    decoded = 0
+    try:
+        for (infile, start, stop, nreadouts, first, entry, _, _), hits, order, link, recovered, dropped in results:
+            #Define output file name
+            csvname = output_name(outpath, infile)
+
+            if start == first:
+                csvpath = csvname + '.csv'
+                #Setup CSV structure, decoded hits are written in batches, appended to hits decoded before
+                csvwriter = open_hit_writer(csvpath, hits.dtypes, args.hitformat, flush_readouts=args.flushReadouts,
+                                            flush_seconds=np.inf, index_name="dec_order", append=first > 0)
+                filelink = LinkQuality()
+                frames_recovered = frames_dropped = 0
+
+            #Populate csv
+            csvwriter.append(hits, order, readouts=stop - start)
+            filelink.merge(link)
+            frames_recovered += recovered
+            frames_dropped += dropped
 
-        #Save csv
-        csvframe.index.name = "dec_order"
-        logger.info(f"Saving to {csvpath}")
-        csvframe.to_csv(csvpath)
+            decoded += stop - start
+            logger.info(f"{infile}: {stop}/{nreadouts} readouts decoded, {decoded / max(time.time() - start_time, 1e-9):.0f} readouts/s")
+
+            if stop == nreadouts:
+                logger.info(f"Hits split between readouts: {frames_recovered} recovered, {frames_dropped} dropped")
+                logger.info(f"Link quality: {filelink}")
+
+                #Save csv
+                logger.info(f"Saving to {csvwriter.path}")
+                csvwriter.close()
+                entry['output'] = os.path.basename(csvwriter.path)
+                save_entry(csvname + CACHE_SUFFIX, entry)
+                register_files(infile, [csvwriter.path], 'decoded')
+    finally:
+        if pool is not None:
+            pool.terminate()
     
 
 if __name__ == "__main__":
@@ -124,6 +240,12 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--dirInput', default=None, required=False,
                     help='Input directory of data files to decode')
 
+    parser.add_argument('-m', '--manifest', default=None, required=False,
+                    help='Manifest of a run with rotated output files, decodes every finished segment')
+
+    parser.add_argument('--follow', action='store_true', default=False, required=False,
+                    help='With -m, wait for new segments until the run is complete. Default: False')
+
     parser.add_argument('-o', '--outDir', default=None, required=False,
                     help='Output Directory for all decoded datafiles. Defaults to directory raw data is saved in')
 
@@ -136,7 +258,24 @@ if __name__ == "__main__":
     parser.add_argument('-V', '--chipVer', default=3, required=False, type=int,
                     help='Chip version - provide an int')
 
-    parser.add_argument
+    parser.add_argument('--chiptime', action='store_true', default=False, required=False,
+                    help='Add chip timestamp unwrapped over the whole file (column chiptime). Without host readout times, wraps between readouts are not counted. Default: False')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1, required=False,
+                    help='Number of processes decoding files and chunks of files in parallel, 0 for all cores. Default: 1')
+
+    parser.add_argument('--chunkReadouts', type=int, default=20000, required=False,
+                    help='Split files into chunks of this many readouts, decoded in parallel with --jobs. 0 to decode files at once. Default: 20000')
+
+    parser.add_argument('--noCache', action='store_true', default=False, required=False,
+                    help='Decode all readouts again, even if unchanged inputs were decoded before with the same settings. Default: False')
+
+    parser.add_argument('-F', '--hitformat', choices=HIT_FORMATS, default='csv', required=False,
+                    help='Output format of decoded hits. parquet and arrow need pyarrow. Default: csv')
+
+    parser.add_argument('--flushReadouts', type=int, default=1000, required=False,
+                    help='Write decoded hits to file every N readouts. Default: 1000')
+
     args = parser.parse_args()
 
     # Sets the loglevel
@@ -16,6 +16,10 @@ import time
 import logging
 import argparse
 
+from modules.rawdata import open_readout_log
+from core.hitbatch import hit_dtypes
+from modules.runcatalog import register_run
+from modules.hitwriter import open_hit_writer, HIT_FORMATS
 from modules.setup_logger import logger
 
 
@@ -26,21 +30,6 @@ if os.path.exists(logdir) == False:
 logname = "./runlogs/AstropixRunlog_" + time.strftime("%Y%m%d-%H%M%S") + ".log"
 
 
-# This is the dataframe which is written to the csv if the decoding fails
-decode_fail_frame = pd.DataFrame({
-                'readout': np.nan,
-                'Chip ID': np.nan,
-                'payload': np.nan,
-                'location': np.nan,
-                'isCol': np.nan,
-                'timestamp': np.nan,
-                'tot_msb': np.nan,
-                'tot_lsb': np.nan,
-                'tot_total': np.nan,
-                'tot_us': np.nan,
-                'hittime': np.nan
-                }, index=[0]
-)
   
 
 #Init 
@@ -81,27 +70,15 @@ def main(args,row,col,injectPix):
     i = 0
     if args.maxtime is not None: 
         end_time=time.time()+(args.maxtime*60.)
-    strPix = "c{0}r{1}_{2}thr".format(        str(col)
-                                              str(row)
-                                              args.threshold)
+    strPix = "c{0}r{1}_{2}thr".format(str(col), str(row), args.threshold)
     fname= args.name+"_"+strPix+"_"
 
     # Prepares the file paths 
     if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        # Decoded hits are appended to the file every few seconds, see modules/hitwriter.py
+        csvwriter = open_hit_writer(csvpath, hit_dtypes(args.chipVer), args.hitformat, flush_readouts=args.flushReadouts,
+                                    flush_seconds=args.flushSeconds, index_name="dec_order")
 
     # Save final configuration to output file    
     ymlpathout=args.outdir+"/"+args.yaml+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
@@ -109,11 +86,8 @@ def main(args,row,col,injectPix):
     # And here for the text files/logs
     bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
     # textfiles are always saved so we open it up 
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # Writes all the config information to the file, as text log or with --binary as raw file
+    bitfile = open_readout_log(bitpath, astro.get_log_header() + str(args) + "\n", binary=args.binary, config=vars(args), run_header=astro.get_run_header(args))
 
     try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly
         
@@ -129,27 +103,17 @@ def main(args,row,col,injectPix):
             
             if readout:
 
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
+                # Writes the readout to the log
+                bitfile.write(i, readout, time.time())
                 print(binascii.hexlify(readout))
 
-                # Added fault tolerance for decoding, the limits of which are set through arguments
-                try:
-                    hits = astro.decode_readout(readout, i, args.chipVer, printer = True)
+                # Invalid frames are rejected by the decoder, good hits of the readout are kept
+                hits = astro.decode_batch(readout, i, args.chipVer, printer = True)
+                i += 1
 
-                except IndexError:
-                    # We write out the failed decode dataframe
-                    logger.warning(f"Decoding failed. Failure {errors} of {max_errors} on readout {i}")
-                    hits = decode_fail_frame
-                    hits.readout = i
-                    hits.hittime = time.time()
-
-                finally:
-                    i += 1
-
-                    # If we are saving a csv this will write it out. 
-                    if args.saveascsv:
-                        csvframe = pd.concat([csvframe, hits])
+                # If we are saving a csv this will write it out. 
+                if args.saveascsv:
+                    csvwriter.append(hits)
 
             # If no hits are present this waits for some to accumulate
             else: time.sleep(.001)
@@ -163,10 +127,12 @@ def main(args,row,col,injectPix):
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvwriter.close()
         if args.inject: astro.stop_injection()   
         bitfile.close() # Close open file       
+        # Adds the run to the catalog of the output directory, see modules/runcatalog.py
+        register_run(args.outdir, [bitfile.path], [ymlpathout] + ([csvwriter.path] if args.saveascsv else []),
+                     script='example_loop.py', hits=csvwriter.hits if args.saveascsv else None)
         astro.close_connection() # Closes SPI
         logger.info("Program terminated successfully")
     # END OF PROGRAM
@@ -213,6 +179,18 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rowrange', action='store', default=[0,33], type=int, nargs=2,
                     help =  'Loop over given range of rows. Default: 0 34')
 
+    parser.add_argument('--binary', action='store_true', default=False, required=False,
+                    help='Save readouts as binary raw file (.raw) instead of text log, see convert_raw.py. Default: False')
+
+    parser.add_argument('-F', '--hitformat', choices=HIT_FORMATS, default='csv', required=False,
+                    help='Format of the decoded hit file saved with -c. parquet and arrow need pyarrow. Default: csv')
+
+    parser.add_argument('--flushReadouts', type=int, default=1000, required=False,
+                    help='Write decoded hits to file after this many readouts ... Default: 1000')
+
+    parser.add_argument('--flushSeconds', type=float, default=5.0, required=False,
+                    help='... or after this many seconds. Default: 5')
+
     parser.add_argument
     args = parser.parse_args()
     
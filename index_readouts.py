@@ -0,0 +1,84 @@
+"""
+Build the readout offset index of text logs (.log) and raw files (.raw), see modules/rawdata.py.
+Files written by the data taking scripts have their index already, with host times. The index of older
+files is built from the file, without host times. Indexes are saved next to the files as <file>.idx.npz.
+"""
+
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+
+from modules.rawdata import INDEX_SUFFIX, RAW_SUFFIX, RawReader
+
+from modules.setup_logger import logger
+
+
+def main(args):
+
+    #Allow only -f or -d to be evoked - not both
+    if args.fileInput and args.dirInput:
+        logger.error("Input a single file with -f OR a single directory with -d... not both! Try running again")
+        exit()
+
+    if args.fileInput is not None:
+        inputFiles = [args.fileInput]
+    else:
+        inputFiles = sorted(glob.glob(os.path.join(args.dirInput, '*.log')) + glob.glob(os.path.join(args.dirInput, '*' + RAW_SUFFIX)))
+        #_PPS.log files are filtered readouts, not readout logs
+        inputFiles = [f for f in inputFiles if not f.endswith('_PPS.log')]
+
+    for infile in inputFiles:
+        if args.rebuild and os.path.exists(infile + INDEX_SUFFIX):
+            os.remove(infile + INDEX_SUFFIX)
+
+        with RawReader(infile) as reader:
+            times = reader.index['host_time']
+            timed = times[~np.isnan(times)]
+            span = f"{timed[-1] - timed[0]:.1f} s of host time" if len(timed) else "no host times"
+            logger.info(f"{infile}: {len(reader)} readouts, {reader.header_length} bytes of header, {span}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Build the readout offset index of text logs and raw files')
+    parser.add_argument('-f', '--fileInput', default=None, required=False,
+                    help='Input file, .log or .raw')
+
+    parser.add_argument('-d', '--dirInput', default=None, required=False,
+                    help='Input directory, indexes all .log and .raw files')
+
+    parser.add_argument('--rebuild', action='store_true', default=False, required=False,
+                    help='Build the index again from the file, drops host times saved while taking data. Default: keep up to date indexes')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
+
+    args = parser.parse_args()
+
+    # Sets the loglevel
+    ll = args.loglevel
+    if ll == 'D':
+        loglevel = logging.DEBUG
+    elif ll == 'I':
+        loglevel = logging.INFO
+    elif ll == 'E':
+        loglevel = logging.ERROR
+    elif ll == 'W':
+        loglevel = logging.WARNING
+    elif ll == 'C':
+        loglevel = logging.CRITICAL
+
+    # Logging - print to terminal only
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
@@ -14,6 +14,10 @@ import time
 import logging
 import argparse
 
+from modules.rawdata import open_readout_log
+from core.hitbatch import hit_dtypes
+from modules.hitwriter import open_hit_writer, HIT_FORMATS
+from modules.runcatalog import register_run
 from modules.setup_logger import logger
 
 
@@ -23,21 +27,6 @@ if os.path.exists(logdir) == False:
     os.mkdir(logdir)
 logname = "./runlogs/AstropixRunlog_" + time.strftime("%Y%m%d-%H%M%S") + ".log"
 
-# This is the dataframe which is written to the csv if the decoding fails
-decode_fail_frame = pd.DataFrame({
-                'readout': np.nan,
-                'Chip ID': np.nan,
-                'payload': np.nan,
-                'location': np.nan,
-                'isCol': np.nan,
-                'timestamp': np.nan,
-                'tot_msb': np.nan,
-                'tot_lsb': np.nan,
-                'tot_total': np.nan,
-                'tot_us': np.nan,
-                'hittime': np.nan
-                }, index=[0]
-)
 
 #Init 
 def main(args, injv, fpgaCon:bool=True, fpgaDiscon:bool=True):
@@ -88,29 +77,16 @@ def main(args, injv, fpgaCon:bool=True, fpgaDiscon:bool=True):
     # Prepares the file paths 
     if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        # Decoded hits are appended to the file every few seconds, see modules/hitwriter.py
+        csvwriter = open_hit_writer(csvpath, hit_dtypes(args.chipVer), args.hitformat, flush_readouts=args.flushReadouts,
+                                    flush_seconds=args.flushSeconds, index_name="dec_order")
     # Save final configuration to output file    
     ymlpathout=args.outdir+pathdelim+args.yaml+"_"+fname+time.strftime("%Y%m%d-%H%M%S")+".yml"
     astro.write_conf_to_yaml(ymlpathout)
     # And here for the text files/logs
     bitpath = args.outdir + pathdelim + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # Writes all the config information to the file, as text log or with --binary as raw file
+    bitfile = open_readout_log(bitpath, astro.get_log_header() + str(args) + "\n", binary=args.binary, config=vars(args), run_header=astro.get_run_header(args))
 
     try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly    
         while (True): # Loop continues 
@@ -120,14 +96,14 @@ def main(args, injv, fpgaCon:bool=True, fpgaDiscon:bool=True):
             readout = astro.get_readout()
             
             if readout: # Checks if hits are present
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
+                # Writes the readout to the log
+                bitfile.write(i, readout, time.time())
                 print(binascii.hexlify(readout))
-                hits = astro.decode_readout(readout, i, args.chipVer, printer = True)
+                hits = astro.decode_batch(readout, i, args.chipVer, printer = True)
                 i += 1
                 # If we are saving a csv this will write it out. 
                 if args.saveascsv:
-                    csvframe = pd.concat([csvframe, hits])
+                    csvwriter.append(hits)
 
             # If no hits are present this waits for some to accumulate
             else: time.sleep(.001)
@@ -140,9 +116,12 @@ def main(args, injv, fpgaCon:bool=True, fpgaDiscon:bool=True):
     finally:  
         astro.stop_injection()
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvwriter.close()
         bitfile.close() # Close open file       
+        # Adds the run to the catalog of the output directory, see modules/runcatalog.py
+        register_run(args.outdir, [bitfile.path], [ymlpathout] + ([csvwriter.path] if args.saveascsv else []),
+                     script='injectionScan.py', hits=csvwriter.hits if args.saveascsv else None,
+                     col=args.inject[1], row=args.inject[0], injection=injv)
         if fpgaDiscon:
             astro.close_connection() # Closes SPI
             logger.info('FPGA Connection ended')
@@ -185,6 +164,18 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--injectStep', action='store', default=100, type=float,
                     help =  'Step used for scanning through injections in mV. Default: 100')
 
+    parser.add_argument('--binary', action='store_true', default=False, required=False,
+                    help='Save readouts as binary raw file (.raw) instead of text log, see convert_raw.py. Default: False')
+
+    parser.add_argument('-F', '--hitformat', choices=HIT_FORMATS, default='csv', required=False,
+                    help='Format of the decoded hit file saved with -c. parquet and arrow need pyarrow. Default: csv')
+
+    parser.add_argument('--flushReadouts', type=int, default=1000, required=False,
+                    help='Write decoded hits to file after this many readouts ... Default: 1000')
+
+    parser.add_argument('--flushSeconds', type=float, default=5.0, required=False,
+                    help='... or after this many seconds. Default: 5')
+
     parser.add_argument
     args = parser.parse_args()
     
@@ -17,6 +17,8 @@ import time
 import logging
 import argparse
 
+from core.hitbatch import hit_dtypes
+from modules.hitwriter import open_hit_writer, HIT_FORMATS
 from modules.setup_logger import logger
 
 
@@ -27,21 +29,6 @@ if os.path.exists(logdir) == False:
 logname = "./runlogs/AstropixRunlog_" + time.strftime("%Y%m%d-%H%M%S") + ".log"
 
 
-# This is the dataframe which is written to the csv if the decoding fails
-decode_fail_frame = pd.DataFrame({
-                'readout': np.nan,
-                'Chip ID': np.nan,
-                'payload': np.nan,
-                'location': np.nan,
-                'isCol': np.nan,
-                'timestamp': np.nan,
-                'tot_msb': np.nan,
-                'tot_lsb': np.nan,
-                'tot_total': np.nan,
-                'tot_us': np.nan,
-                'hittime': np.nan
-                }, index=[0]
-)
 
   
 
@@ -92,19 +79,9 @@ def main(args,dac):
     # Prepares the file paths 
     if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        # Decoded hits are appended to the file every few seconds, see modules/hitwriter.py
+        csvwriter = open_hit_writer(csvpath, hit_dtypes(astro.chipversion), args.hitformat, flush_readouts=args.flushReadouts,
+                                    flush_seconds=args.flushSeconds, index_name="dec_order")
 
     # Save final configuration to output file    
     ymlpathout=args.outdir+pathdelim+args.yaml+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
@@ -135,22 +112,13 @@ def main(args,dac):
                 bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
                 print(binascii.hexlify(readout))
 
-                # Added fault tolerance for decoding, the limits of which are set through arguments
-                try:
-                    hits = astro.decode_readout(readout, i, printer = True)
+                # Invalid frames are rejected by the decoder, good hits of the readout are kept
+                hits = astro.decode_batch(readout, i, astro.chipversion, printer = True)
+                i += 1
 
-                except IndexError:
-                    # We write out the failed decode dataframe
-                    hits = decode_fail_frame
-                    hits.readout = i
-                    hits.hittime = time.time()
-
-                finally:
-                    i += 1
-
-                    # If we are saving a csv this will write it out. 
-                    if args.saveascsv:
-                        csvframe = pd.concat([csvframe, hits])
+                # If we are saving a csv this will write it out. 
+                if args.saveascsv:
+                    csvwriter.append(hits)
 
             # If no hits are present this waits for some to accumulate
             else: time.sleep(.001)
@@ -164,8 +132,7 @@ def main(args,dac):
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvwriter.close()
         if args.inject: astro.stop_injection()   
         bitfile.close() # Close open file       
         astro.close_connection() # Closes SPI
@@ -219,6 +186,15 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--dacrange', action='store', default=[0,60,5], type=int, nargs=3,
                     help =  'Range to scan over DAC value and increment. Default: 0 60 5')
 
+    parser.add_argument('-F', '--hitformat', choices=HIT_FORMATS, default='csv', required=False,
+                    help='Format of the decoded hit file saved with -c. parquet and arrow need pyarrow. Default: csv')
+
+    parser.add_argument('--flushReadouts', type=int, default=1000, required=False,
+                    help='Write decoded hits to file after this many readouts ... Default: 1000')
+
+    parser.add_argument('--flushSeconds', type=float, default=5.0, required=False,
+                    help='... or after this many seconds. Default: 5')
+
     parser.add_argument
     args = parser.parse_args()
     
@@ -0,0 +1,265 @@
+"""
+Clustering of adjacent pixel hits
+
+Hits of a chip are sorted by time and split into time windows wherever two hits are more
+than window apart. Within a window, hits on neighbouring pixels are connected components,
+labelled with NumPy only: neighbour pairs are found by searching pixel keys in a sorted array,
+labels are propagated along these pairs until every component carries its smallest hit index.
+
+Works on AstroPix 4 hits and on AstroPix 3 pixel hits of modules.pixelreco.
+"""
+
+import numpy as np
+
+from core.hitbatch import HitBatch
+from core.timestamps import TimestampUnwrapper
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Columns of clusters
+CLUSTER_DTYPES = {
+    'Chip ID':      np.uint8,
+    'time':         np.int64,
+    'duration':     np.int64,
+    'size':         np.uint16,
+    'tot_us_sum':   np.float64,
+    'row':          np.float64,
+    'col':          np.float64,
+}
+
+# Neighbours in forward direction as (row, col) offsets, the backward ones are the same pairs
+NEIGHBOURS = {
+    4: [(0, 1), (1, 0)],
+    8: [(0, 1), (1, -1), (1, 0), (1, 1)],
+}
+
+
+def _label(key: np.ndarray, connectivity: int) -> np.ndarray:
+    """
+    Connected components of pixel keys (window << 16) + (row << 8) + col
+
+    :returns: Label per hit, the smallest hit index of its component
+    """
+    n = len(key)
+    korder = np.argsort(key, kind='stable')
+    ksorted = key[korder]
+
+    first, second = [], []
+
+    # Same pixel more than once in a window
+    same = np.flatnonzero(ksorted[1:] == ksorted[:-1])
+    first.append(korder[same])
+    second.append(korder[same + 1])
+
+    row = (key >> 8) & 0xff
+    col = key & 0xff
+    for drow, dcol in NEIGHBOURS[connectivity]:
+        inside = (row + drow <= 0xff) & (col + dcol >= 0) & (col + dcol <= 0xff)
+        idx = np.flatnonzero(inside)
+        neighbour = key[idx] + (drow << 8) + dcol
+        pos = np.minimum(np.searchsorted(ksorted, neighbour), n - 1)
+        found = ksorted[pos] == neighbour
+        first.append(idx[found])
+        second.append(korder[pos[found]])
+
+    a = np.concatenate(first)
+    b = np.concatenate(second)
+
+    labels = np.arange(n)
+    while len(a):
+        low = np.minimum(labels[a], labels[b])
+        new = labels.copy()
+        np.minimum.at(new, a, low)
+        np.minimum.at(new, b, low)
+        # Pointer jumping, a label points to a hit with a smaller or the same label
+        new = new[new]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+
+    return labels
+
+
+def cluster_hits(chip: np.ndarray, row: np.ndarray, col: np.ndarray, time: np.ndarray, tot_us: np.ndarray,
+                 window: int = 2, connectivity: int = 8) -> tuple:
+    """
+    Cluster hits on adjacent pixels within a time window
+
+    :param chip: Chip ID per hit
+    :param row: Row per hit
+    :param col: Column per hit
+    :param time: Monotonic time per hit
+    :param tot_us: ToT per hit in us
+    :param window: Hits further apart in time than window start a new window, in units of time
+    :param connectivity: 4 or 8, with 8 diagonal pixels are adjacent
+
+    :returns: HitBatch of clusters sorted by chip and time with CLUSTER_DTYPES columns,
+              cluster index per hit
+    """
+    n = len(time)
+    if not n:
+        return HitBatch.empty(CLUSTER_DTYPES), np.empty(0, dtype=np.intp)
+
+    time = np.asarray(time, dtype=np.int64)
+    order = np.lexsort((time, chip))
+    c = np.asarray(chip)[order]
+    t = time[order]
+
+    new_window = np.ones(n, dtype=bool)
+    new_window[1:] = (c[1:] != c[:-1]) | (np.diff(t) > window)
+    windows = np.cumsum(new_window) - 1
+
+    r = np.asarray(row, dtype=np.int64)[order]
+    cl = np.asarray(col, dtype=np.int64)[order]
+    labels = _label((windows << 16) + (r << 8) + cl, connectivity)
+
+    roots, cluster = np.unique(labels, return_inverse=True)
+    tot = np.asarray(tot_us, dtype=np.float64)[order]
+
+    size = np.bincount(cluster)
+    tot_sum = np.bincount(cluster, weights=tot)
+    # ToT weighted centroid, unweighted for clusters without ToT
+    weight = np.where(tot_sum[cluster] > 0, tot, 1.0)
+    weight_sum = np.bincount(cluster, weights=weight)
+    end = np.full(len(roots), np.iinfo(np.int64).min)
+    np.maximum.at(end, cluster, t)
+
+    clusters = HitBatch({
+        'Chip ID':      c[roots],
+        # Hits are sorted by time, the root of a cluster is its first hit
+        'time':         t[roots],
+        'duration':     end - t[roots],
+        'size':         np.minimum(size, np.iinfo(np.uint16).max),
+        'tot_us_sum':   tot_sum,
+        'row':          np.bincount(cluster, weights=weight * r) / weight_sum,
+        'col':          np.bincount(cluster, weights=weight * cl) / weight_sum,
+    }, CLUSTER_DTYPES)
+
+    cluster_of_hit = np.empty(n, dtype=np.intp)
+    cluster_of_hit[order] = cluster
+
+    return clusters, cluster_of_hit
+
+
+def open_windows(chip: np.ndarray, time: np.ndarray, window: int) -> np.ndarray:
+    """
+    Hits in the last time window of their chip, which hits of a later readout can still join
+
+    The window of a chip reaches back from its latest hit until two hits are more than window apart,
+    hits before it cannot be connected to later hits.
+
+    :returns: Boolean mask per hit
+    """
+    n = len(time)
+    time = np.asarray(time, dtype=np.int64)
+    order = np.lexsort((time, chip))
+    c = np.asarray(chip)[order]
+    t = time[order]
+
+    new_window = np.ones(n, dtype=bool)
+    new_window[1:] = (c[1:] != c[:-1]) | (np.diff(t) > window)
+    windows = np.cumsum(new_window) - 1
+
+    # Window of the latest hit of every chip
+    chip_end = np.searchsorted(c, c, side='right') - 1
+    mask = np.empty(n, dtype=bool)
+    mask[order] = windows == windows[chip_end]
+    return mask
+
+
+class Clusterer:
+    """
+    Cluster hits of consecutive decoded readouts
+
+    Hits in the last time window of their chip are kept until the next call, they could still be joined
+    by hits of the next readout. The clusters are the ones of cluster_hits on all readouts at once.
+    Hits of later readouts must not be earlier than the latest hit of their chip.
+    Accepts AstroPix 4 hits (columns id, row, col, ts_dec1) and AstroPix 3 pixel hits
+    of modules.pixelreco (columns Chip ID, row, col, time).
+    """
+
+    def __init__(self, window: int = 2, connectivity: int = 8, time_column: str = None):
+        """
+        :param window: Maximum time between hits of a cluster, in units of time_column
+        :param connectivity: 4 or 8, with 8 diagonal pixels are adjacent
+        :param time_column: Monotonic time of the hits. Default: 'time' of pixel hits,
+            'chiptime' if decoded with it or AstroPix 4 ts_dec1 unwrapped in stream order
+        """
+        self.window = window
+        self.connectivity = connectivity
+        self.time_column = time_column
+
+        self._unwrapper = TimestampUnwrapper(4, sampleclock_period_ns=1, ts_period_ns=1)
+        self.reset()
+
+    def reset(self):
+        """Start a new run"""
+        self._unwrapper.reset()
+        self._pending = None
+        self.clusters = 0
+        self.hits = 0
+
+    def _hits(self, hits: HitBatch) -> dict:
+        """Columns needed for clustering"""
+        time_column = self.time_column
+        if time_column is None:
+            time_column = next((name for name in ('time', 'chiptime') if name in hits), None)
+
+        if time_column is None:
+            time = self._unwrapper.unwrap(hits['ts_dec1'])
+        else:
+            time = np.asarray(hits[time_column], dtype=np.int64)
+
+        return {
+            'chip':     hits['Chip ID'] if 'Chip ID' in hits else hits['id'],
+            'row':      hits['row'],
+            'col':      hits['col'],
+            'time':     time,
+            'tot_us':   hits['tot_us'],
+        }
+
+    def add(self, hits: HitBatch) -> HitBatch:
+        """
+        Cluster hits of the next readout
+
+        :returns: HitBatch of finished clusters with CLUSTER_DTYPES columns
+        """
+        data = self._hits(hits)
+        if self._pending is not None:
+            data = {key: np.concatenate([self._pending[key], value]) for key, value in data.items()}
+
+        if not len(data['time']):
+            return HitBatch.empty(CLUSTER_DTYPES)
+
+        # Clusters are found within time windows, only the windows before the last one of a chip are finished
+        hold = open_windows(data['chip'], data['time'], self.window)
+        self._pending = {key: value[hold] for key, value in data.items()}
+
+        done = {key: value[~hold] for key, value in data.items()}
+        clusters, _ = cluster_hits(done['chip'], done['row'], done['col'], done['time'],
+                                   done['tot_us'], self.window, self.connectivity)
+        return self._count(clusters)
+
+    def flush(self) -> HitBatch:
+        """Cluster the hits kept from the last readout, at the end of a run"""
+        if self._pending is None or not len(self._pending['time']):
+            self._pending = None
+            return HitBatch.empty(CLUSTER_DTYPES)
+
+        data, self._pending = self._pending, None
+        clusters, _ = cluster_hits(data['chip'], data['row'], data['col'], data['time'],
+                                   data['tot_us'], self.window, self.connectivity)
+        return self._count(clusters)
+
+    def _count(self, clusters: HitBatch) -> HitBatch:
+        self.clusters += len(clusters)
+        self.hits += int(clusters['size'].sum(dtype=np.int64))
+        return clusters
+
+    def __str__(self) -> str:
+        mean = self.hits / self.clusters if self.clusters else 0.0
+        return f"{self.clusters} clusters of {self.hits} hits, mean size {mean:.2f}"
@@ -0,0 +1,148 @@
+"""
+Cache of post-run decoding
+
+Next to every decoded output, decode_postRun.py saves <name>_offline.cache.json with the decoder settings,
+the number of decoded readouts and a hash of the input up to the end of the last decoded readout.
+Decoding the input again is:
+
+    skipped     Same settings and the input is unchanged, or grew without a complete new readout
+    resumed     Same settings and the input grew with its decoded part unchanged, e.g. the current segment
+                of a rotated run. Only new readouts are decoded and appended to the output, csv only
+    redone      Anything else: other settings or DECODER_VERSION, changed input, missing output
+
+Unchanged inputs are recognized by size and modification time without reading them. Before resuming,
+the output is cut back to its size when the cache entry was saved, dropping hits of an interrupted run.
+"""
+
+import hashlib
+import json
+import os
+
+from core.decode import DECODER_VERSION
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = '.cache.json'
+CACHE_VERSION = 1
+
+_HASH_BLOCK = 1 << 20
+
+
+def decode_settings(chipversion: int, chiptime: bool, hitformat: str) -> dict:
+    """Everything the decoded output depends on besides the input"""
+    return {
+        'decoder_version':  DECODER_VERSION,
+        'chip_version':     chipversion,
+        'chiptime':         bool(chiptime),
+        'hitformat':        hitformat,
+    }
+
+
+def hash_prefixes(path: str, ends: list) -> list:
+    """
+    Content hashes of the first bytes of a file, read once
+
+    :param path: Input file
+    :param ends: Increasing prefix lengths in bytes
+
+    :returns: Hex digest per prefix
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    digests = []
+    pos = 0
+    with open(path, 'rb') as f:
+        for end in ends:
+            while pos < end:
+                block = f.read(min(_HASH_BLOCK, end - pos))
+                if not block:
+                    raise ValueError(f"{path} is shorter than {end} bytes")
+                hasher.update(block)
+                pos += len(block)
+            digests.append(hasher.hexdigest())
+    return digests
+
+
+def load_entry(path: str) -> dict:
+    """Cache entry, None if missing or unreadable"""
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get('version') == CACHE_VERSION else None
+
+
+def save_entry(path: str, entry: dict):
+    """Replace the cache entry, after the output given by entry['output'] is complete"""
+    entry['output_size'] = os.path.getsize(os.path.join(os.path.dirname(path), entry['output']))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(tmp, path)
+
+
+def plan_decode(reader, cachepath: str, settings: dict, append: bool = True, reuse: bool = True) -> tuple:
+    """
+    Decide which readouts of an input need decoding
+
+    :param reader: RawReader of the input
+    :param cachepath: Cache entry of the output
+    :param settings: See decode_settings
+    :param append: The output format can be appended to, otherwise grown inputs are decoded again
+    :param reuse: Use the saved cache entry, False to decode everything and replace the entry
+
+    :returns: First readout to decode or None if the output is up to date, cache entry to save when done
+    """
+    nreadouts = len(reader)
+    end = int(reader.index['offset'][-1] + reader.index['length'][-1]) if nreadouts else 0
+    stat = os.stat(reader.path)
+
+    entry = {
+        'version':      CACHE_VERSION,
+        'input':        os.path.basename(reader.path),
+        'settings':     settings,
+        'readouts':     nreadouts,
+        'end':          end,
+        'size':         stat.st_size,
+        'mtime_ns':     stat.st_mtime_ns,
+        'hash':         None,
+        'output':       None,
+        'output_size':  None,
+    }
+
+    old = load_entry(cachepath) if reuse else None
+    output = os.path.join(os.path.dirname(cachepath), old['output']) if old is not None and old['output'] else None
+    output_size = os.path.getsize(output) if output is not None and os.path.exists(output) else -1
+    usable = (old is not None and old['settings'] == settings and old['input'] == entry['input']
+              and output_size >= old['output_size'])
+    if not usable:
+        entry['hash'], = hash_prefixes(reader.path, [end])
+        return 0, entry
+
+    entry['output'] = old['output']
+    if (old['size'], old['mtime_ns'], old['output_size']) == (stat.st_size, stat.st_mtime_ns, output_size):
+        return None, old
+
+    if 0 < old['readouts'] <= nreadouts and old['end'] <= end:
+        old_hash, entry['hash'] = hash_prefixes(reader.path, [old['end'], end])
+        if old_hash == old['hash']:
+            if old['readouts'] == nreadouts and old['output_size'] == output_size:
+                save_entry(cachepath, entry)
+                return None, entry
+            if append:
+                if output_size > old['output_size']:
+                    logger.info("Removing %d bytes of hits from %s written after the last cached decoding",
+                                output_size - old['output_size'], output)
+                    os.truncate(output, old['output_size'])
+                return old['readouts'], entry
+            logger.info("%s grew, %s output is decoded again", reader.path, settings['hitformat'])
+            return 0, entry
+    else:
+        entry['hash'], = hash_prefixes(reader.path, [end])
+
+    logger.info("%s changed since it was decoded, decoding again", reader.path)
+    return 0, entry
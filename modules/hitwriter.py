@@ -0,0 +1,256 @@
+"""
+Streaming output of decoded hits
+
+Decoded batches are collected in a HitBuffer and appended to the output file every
+flush_readouts batches or flush_seconds, so memory use stays flat and a crash loses
+at most the hits of the last seconds.
+
+Formats:
+    csv         Same layout as DataFrame.to_csv of all hits, index dec_ord
+    parquet     One row group per flush, dtypes of the decoder. The footer is written on close(),
+                a file of a crashed run is not readable, use arrow or file rotation
+    arrow       Arrow IPC stream, one record batch per flush, readable up to the last flush
+
+Parquet and Arrow need pyarrow, which is imported only when used. Only csv files can be appended to.
+"""
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from core.hitbatch import HitBuffer
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+HIT_FORMATS = ('csv', 'parquet', 'arrow')
+HIT_SUFFIX = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+# Formats whose files can be continued with append=True
+APPEND_FORMATS = ('csv',)
+
+# Name of the index column, the position of a hit in its readout
+INDEX_NAME = 'dec_ord'
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        logger.error("Parquet and Arrow output need pyarrow, install it with 'pip install pyarrow' or use csv")
+        raise
+    return pyarrow
+
+
+class HitWriter:
+    """
+    Append decoded batches to a file
+
+    Subclasses implement _open, _write and _close for one format.
+    """
+
+    suffix = None
+
+    def __init__(self, path: str, dtypes: dict, flush_readouts: int = 1000, flush_seconds: float = 5.0,
+                 index_name: str = INDEX_NAME, append: bool = False):
+        """
+        :param path: Output file
+        :param dtypes: Column names and dtypes of the batches, e.g. StreamDecoder.dtypes
+        :param flush_readouts: Write after this many batches ...
+        :param flush_seconds: ... or after this many seconds since the last write
+        :param index_name: Name of the index column, None to leave it out
+        :param append: Continue an existing file written with the same dtypes, see APPEND_FORMATS
+        """
+        self.path = path
+        self.dtypes = dtypes
+        self.flush_readouts = flush_readouts
+        self.flush_seconds = flush_seconds
+        self.index_name = index_name
+        self.appending = append
+
+        self._buffer = HitBuffer(dtypes)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self.hits = 0
+        self.flushes = 0
+
+        self._open()
+
+    def append(self, batch, order=None, readouts: int = 1):
+        """
+        Add the hits of one readout, written when a flush is due
+
+        :param batch: HitBatch with the columns of dtypes
+        :param order: Position of each hit in its readout, for batches of several readouts, see HitBuffer.append
+        :param readouts: Number of readouts in the batch
+        """
+        self._buffer.append(batch, order)
+        self._pending += readouts
+        if (self._pending >= self.flush_readouts
+                or time.monotonic() - self._last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Write the collected hits"""
+        if len(self._buffer):
+            self._write(self._buffer.to_dataframe())
+            self.hits += len(self._buffer)
+            self.flushes += 1
+            self._buffer.clear()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Write remaining hits and close the file"""
+        self.flush()
+        self._close()
+        logger.info("%d hits written to %s", self.hits, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _write(self, frame: pd.DataFrame):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class CsvHitWriter(HitWriter):
+    """CSV, the header is written with the first hits"""
+
+    suffix = '.csv'
+
+    def _open(self):
+        #An appended file has its header already
+        self._header = not (self.appending and os.path.exists(self.path))
+        self._file = open(self.path, 'a' if self.appending else 'w', newline='')
+
+    def _write(self, frame: pd.DataFrame):
+        frame.index.name = self.index_name
+        frame.to_csv(self._file, header=self._header, index=self.index_name is not None)
+        self._header = False
+        self._file.flush()
+
+    def _close(self):
+        # Keep the header of a run without hits
+        if self._header:
+            self._write(pd.DataFrame({name: np.empty(0, dtype=dtype) for name, dtype in self.dtypes.items()}))
+        self._file.close()
+
+
+class _ArrowHitWriter(HitWriter):
+    """Common part of the pyarrow based writers"""
+
+    def _open(self):
+        if self.appending:
+            raise ValueError(f"{self.suffix} files cannot be appended to, use one of {APPEND_FORMATS}")
+        self._pa = _import_pyarrow()
+        fields = [(self.index_name, self._pa.uint32())] if self.index_name is not None else []
+        fields += [(name, self._pa.from_numpy_dtype(np.dtype(dtype))) for name, dtype in self.dtypes.items()]
+        self._schema = self._pa.schema(fields)
+        self._file = open(self.path, 'wb')
+
+    def _table(self, frame: pd.DataFrame):
+        if self.index_name is not None:
+            frame = frame.rename_axis(self.index_name).reset_index()
+            frame[self.index_name] = frame[self.index_name].astype(np.uint32)
+        return self._pa.Table.from_pandas(frame, schema=self._schema, preserve_index=False)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+class ParquetHitWriter(_ArrowHitWriter):
+    """Parquet with one row group per flush"""
+
+    suffix = '.parquet'
+
+    def _open(self):
+        super()._open()
+        self._writer = self._pa.parquet.ParquetWriter(self._file, self._schema, compression='zstd')
+
+    def _write(self, frame: pd.DataFrame):
+        self._writer.write_table(self._table(frame))
+        self._sync()
+
+    def _close(self):
+        self._writer.close()
+        self._file.close()
+
+
+class ArrowHitWriter(_ArrowHitWriter):
+    """Arrow IPC stream with one record batch per flush"""
+
+    suffix = '.arrow'
+
+    def _open(self):
+        super()._open()
+        self._writer = self._pa.ipc.new_stream(self._file, self._schema)
+
+    def _write(self, frame: pd.DataFrame):
+        for batch in self._table(frame).to_batches():
+            self._writer.write_batch(batch)
+        self._sync()
+
+    def _close(self):
+        self._writer.close()
+        self._file.close()
+
+
+WRITERS = {'csv': CsvHitWriter, 'parquet': ParquetHitWriter, 'arrow': ArrowHitWriter}
+
+
+def open_hit_writer(path: str, dtypes: dict, fmt: str = 'csv', **kwargs) -> HitWriter:
+    """
+    Open a writer for the format, the suffix of path is replaced by the one of the format
+
+    :param path: Output file, e.g. ending in .csv
+    :param dtypes: Column names and dtypes of the batches
+    :param fmt: One of HIT_FORMATS
+    :param kwargs: flush_readouts, flush_seconds, index_name, append, see HitWriter
+
+    :returns: HitWriter
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown hit format {fmt}, use one of {HIT_FORMATS}")
+
+    root, suffix = os.path.splitext(path)
+    if suffix in HIT_SUFFIX.values():
+        path = root
+    return WRITERS[fmt](path + HIT_SUFFIX[fmt], dtypes, **kwargs)
+
+
+def read_hits(path: str, index_name: str = INDEX_NAME) -> pd.DataFrame:
+    """
+    Read hits written by a HitWriter, format by suffix
+
+    :param index_name: Index column of the writer
+
+    :returns: DataFrame indexed by index_name if present
+    """
+    suffix = os.path.splitext(path)[1]
+    if suffix == HIT_SUFFIX['csv']:
+        frame = pd.read_csv(path)
+    else:
+        pa = _import_pyarrow()
+        if suffix == HIT_SUFFIX['parquet']:
+            frame = pa.parquet.read_table(path).to_pandas()
+        else:
+            with pa.OSFile(path, 'rb') as source:
+                frame = pa.ipc.open_stream(source).read_all().to_pandas()
+
+    return frame.set_index(index_name) if index_name in frame else frame
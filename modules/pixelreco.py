@@ -0,0 +1,257 @@
+"""
+Pixel hit reconstruction for AstroPix 3
+
+AstroPix 3 sends a row and a column frame for every hit. Row and column frames of the
+same chip are paired if their timestamps are within a window and their ToT is similar.
+Pairs are found with a merge join of the time sorted frames, without loops over hits.
+A row with several matching columns, or a column matched by several rows, is flagged ambiguous.
+"""
+
+import numpy as np
+
+from core.hitbatch import HitBatch
+from core.timestamps import TimestampUnwrapper
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Columns of reconstructed pixel hits
+PIXEL_DTYPES = {
+    'readout':      np.uint32,
+    'Chip ID':      np.uint8,
+    'row':          np.uint8,
+    'col':          np.uint8,
+    'time':         np.int64,
+    'dt':           np.int32,
+    'tot_us_row':   np.float64,
+    'tot_us_col':   np.float64,
+    'tot_us':       np.float64,
+    'candidates':   np.uint8,
+    'ambiguous':    np.bool_,
+}
+
+# Offset keeping time keys of different chips apart
+_CHIP_STRIDE = np.int64(1) << 40
+
+
+def _pairs(rows: dict, cols: dict, window: int, tot_abs_us: float, tot_rel: float) -> tuple:
+    """
+    All row and column pairs within the time window and ToT tolerance
+
+    :returns: Row index, column index, time difference and ToT difference per pair
+    """
+    row_key = rows['chip'].astype(np.int64) * _CHIP_STRIDE + rows['time']
+    col_key = cols['chip'].astype(np.int64) * _CHIP_STRIDE + cols['time']
+
+    col_order = np.argsort(col_key, kind='stable')
+    col_sorted = col_key[col_order]
+
+    # Candidate columns of every row are a contiguous range of the sorted columns
+    lo = np.searchsorted(col_sorted, row_key - window, side='left')
+    hi = np.searchsorted(col_sorted, row_key + window, side='right')
+    ncand = hi - lo
+
+    row_idx = np.repeat(np.arange(len(row_key)), ncand)
+    offsets = np.arange(len(row_idx)) - np.repeat(np.cumsum(ncand) - ncand, ncand)
+    col_idx = col_order[lo[row_idx] + offsets]
+
+    tot_row = rows['tot_us'][row_idx]
+    tot_col = cols['tot_us'][col_idx]
+    dtot = np.abs(tot_row - tot_col)
+    ok = dtot <= np.maximum(tot_abs_us, tot_rel * np.maximum(tot_row, tot_col))
+
+    row_idx, col_idx, dtot = row_idx[ok], col_idx[ok], dtot[ok]
+    dt = cols['time'][col_idx] - rows['time'][row_idx]
+
+    return row_idx, col_idx, dt, dtot
+
+
+def _pixels(rows: dict, cols: dict, pairs: tuple, row_candidates: np.ndarray, col_candidates: np.ndarray) -> HitBatch:
+    """Best column per row of the pairs, one pixel per row with candidates in row order"""
+    row_idx, col_idx, dt, dtot = pairs
+
+    # Best column per row: closest in time, then in ToT
+    best = np.lexsort((dtot, np.abs(dt), row_idx))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = row_idx[best][1:] != row_idx[best][:-1]
+    best = best[first]
+
+    r, c = row_idx[best], col_idx[best]
+
+    return HitBatch({
+        'readout':      rows['readout'][r],
+        'Chip ID':      rows['chip'][r],
+        'row':          rows['location'][r],
+        'col':          cols['location'][c],
+        'time':         rows['time'][r],
+        'dt':           dt[best],
+        'tot_us_row':   rows['tot_us'][r],
+        'tot_us_col':   cols['tot_us'][c],
+        'tot_us':       (rows['tot_us'][r] + cols['tot_us'][c]) / 2,
+        'candidates':   np.minimum(row_candidates[r], 255),
+        'ambiguous':    (row_candidates[r] > 1) | (col_candidates[c] > 1),
+    }, PIXEL_DTYPES)
+
+
+def match_pixels(rows: dict, cols: dict, window: int = 1, tot_abs_us: float = 0.5, tot_rel: float = 0.2) -> tuple:
+    """
+    Pair row and column frames
+
+    :param rows: Row frames, dict of arrays 'time', 'chip', 'tot_us', 'location', 'readout'
+    :param cols: Column frames, same keys as rows
+    :param window: Maximum time difference of a pair, in units of 'time'
+    :param tot_abs_us: ToT of a pair may differ by tot_abs_us ...
+    :param tot_rel: ... or by tot_rel times the larger ToT
+
+    :returns: HitBatch of pixel hits, one per row frame with a matching column,
+              boolean mask of unmatched rows, boolean mask of unmatched columns
+    """
+    pairs = _pairs(rows, cols, window, tot_abs_us, tot_rel)
+    row_candidates = np.bincount(pairs[0], minlength=len(rows['time']))
+    col_candidates = np.bincount(pairs[1], minlength=len(cols['time']))
+
+    pixels = _pixels(rows, cols, pairs, row_candidates, col_candidates)
+    return pixels, row_candidates == 0, col_candidates == 0
+
+
+class PixelMatcher:
+    """
+    Pair row and column frames of consecutive decoded readouts
+
+    Frames close to the end of a readout are kept until the next call, so pairs split between
+    two readouts are found. A row is returned once no later frame can pair with it or with its
+    columns, so the pixels are the ones match_pixels finds for all readouts at once.
+    Frames of later readouts must not be earlier than the last frame of the current one.
+    Without a time column, the 8bit timestamps are unwrapped in stream order.
+    """
+
+    def __init__(self, window: int = 1, tot_abs_us: float = 0.5, tot_rel: float = 0.2, time_column: str = None):
+        """
+        :param window: Maximum time difference of row and column frame, in units of time_column
+        :param tot_abs_us: Maximum ToT difference in us ...
+        :param tot_rel: ... or relative to the larger ToT
+        :param time_column: Monotonic time of the hits, e.g. 'chiptime'. Default: timestamp counts unwrapped in stream order
+        """
+        self.window = window
+        self.tot_abs_us = tot_abs_us
+        self.tot_rel = tot_rel
+        self.time_column = time_column
+
+        # One unwrapped count per timestamp count
+        self._unwrapper = TimestampUnwrapper(3, sampleclock_period_ns=1, ts_period_ns=1)
+        self.reset()
+
+    def reset(self):
+        """Start a new run"""
+        self._unwrapper.reset()
+        self._pending = None
+        self.pixels = 0
+        self.ambiguous = 0
+        self.unmatched_rows = 0
+        self.unmatched_cols = 0
+
+    def _frames(self, hits: HitBatch) -> dict:
+        """Frames of a decoded batch with time keys"""
+        if self.time_column is None:
+            time = self._unwrapper.unwrap(hits['timestamp'])
+        else:
+            time = np.asarray(hits[self.time_column], dtype=np.int64)
+
+        return {
+            'time':     time,
+            'chip':     hits['Chip ID'],
+            'tot_us':   hits['tot_us'],
+            'location': hits['location'],
+            'readout':  hits['readout'],
+            'isCol':    hits['isCol'].astype(bool),
+            # Pairs of a column with rows returned before
+            'prior':    np.zeros(len(time), dtype=np.int64),
+        }
+
+    def match(self, hits: HitBatch) -> HitBatch:
+        """
+        Reconstruct pixel hits of the next decoded readout
+
+        :param hits: Decoded AstroPix 3 hits, see Decode.decode_astropix3_batch
+
+        :returns: HitBatch with PIXEL_DTYPES columns. Rows near the end of the readout are returned with the next call
+        """
+        frames = self._frames(hits)
+        if self._pending is not None:
+            frames = {key: np.concatenate([self._pending[key], value]) for key, value in frames.items()}
+
+        if not len(frames['time']):
+            self._pending = None
+            return HitBatch.empty(PIXEL_DTYPES)
+
+        # Rows which could still be paired with frames of the next readout, or whose columns could be.
+        # Columns are kept as long as a kept row can pair with them
+        last = frames['time'].max()
+        hold = frames['time'] >= last - np.where(frames['isCol'], 3, 2) * self.window
+
+        pixels = self._match(frames, ~hold)
+
+        self._pending = {key: value[hold] for key, value in frames.items()}
+        return pixels
+
+    def flush(self) -> HitBatch:
+        """Pair the frames kept from the last readout, at the end of a run"""
+        if self._pending is None:
+            return HitBatch.empty(PIXEL_DTYPES)
+
+        frames, self._pending = self._pending, None
+        return self._match(frames, np.ones(len(frames['time']), dtype=bool))
+
+    def _match(self, frames: dict, done: np.ndarray) -> HitBatch:
+        """
+        Pair all frames, return pixels of rows marked done
+
+        Frames not done are kept for the next call. Pairs of kept columns with returned rows
+        are counted in 'prior', for the ambiguity and unmatched count of the column.
+        """
+        is_col = frames['isCol']
+        rows = {key: value[~is_col] for key, value in frames.items()}
+        cols = {key: value[is_col] for key, value in frames.items()}
+        rows_done = done[~is_col]
+        cols_done = done[is_col]
+
+        pairs = _pairs(rows, cols, self.window, self.tot_abs_us, self.tot_rel)
+        row_idx, col_idx = pairs[0], pairs[1]
+        row_candidates = np.bincount(row_idx, minlength=len(rows['time']))
+        col_candidates = np.bincount(col_idx, minlength=len(cols['time'])) + cols['prior']
+
+        # Keep pixels of finished rows, pixels are sorted like the rows
+        pixels = _pixels(rows, cols, pairs, row_candidates, col_candidates)
+        pixels = pixels.select(rows_done[row_candidates > 0])
+
+        # Returned rows are not paired again in the next call
+        frames['prior'][is_col] = cols['prior'] + np.bincount(col_idx[rows_done[row_idx]], minlength=len(cols['time']))
+
+        self.pixels += len(pixels)
+        self.ambiguous += int(np.count_nonzero(pixels['ambiguous']))
+        self.unmatched_rows += int(np.count_nonzero((row_candidates == 0) & rows_done))
+        self.unmatched_cols += int(np.count_nonzero((col_candidates == 0) & cols_done))
+
+        return pixels
+
+    def __str__(self) -> str:
+        return (f"{self.pixels} pixels, {self.ambiguous} ambiguous, "
+                f"{self.unmatched_rows} rows and {self.unmatched_cols} columns without match")
+
+
+def reconstruct_pixels(hits: HitBatch, window: int = 1, tot_abs_us: float = 0.5, tot_rel: float = 0.2,
+                       time_column: str = None) -> HitBatch:
+    """
+    Reconstruct pixel hits of a whole run, see PixelMatcher
+
+    :param hits: Decoded AstroPix 3 hits in stream order, e.g. HitBuffer.to_batch()
+
+    :returns: HitBatch with PIXEL_DTYPES columns
+    """
+    matcher = PixelMatcher(window, tot_abs_us, tot_rel, time_column)
+    pixels = HitBatch.concat([matcher.match(hits), matcher.flush()], PIXEL_DTYPES)
+    logger.info("Pixel reconstruction: %s", matcher)
+    return pixels
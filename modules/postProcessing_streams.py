@@ -1,25 +1,65 @@
+import binascii
+import itertools
 import re
+
+import numpy as np
 import pandas as pd
 
+from modules.rawdata import read_log_header
+from utils.bitorder import BITREVERSE_LUT, BITREVERSE_TABLE
+
+# Binary string of the bit order reversed byte, same as readbyte(byte)[::-1] for every byte value
+REVERSED_BINARY = [bytearray(f'{b:08b}', encoding='utf8') for b in BITREVERSE_TABLE]
+
+# Lines filtered or decoded at once by the iter_ functions, bounds their memory use
+CHUNK_LINES = 10000
+
+# Header of XXX_PPS.log files
+PPS_HEADER = "EventNmb \t BadEvents \t Data \n"
+
 class postProcessing_streams:
     """
     Manage raw data streams post data collection
         Remove railing from streams
         Save compressed *.log file
         Decode raw hits and save decoded info in compressed csv
+
+    The iter_ methods read the file while iterating, in chunks of chunk_lines lines.
+    dump(), hits() and decode() return everything and keep their result for the next call.
     """
     
-    def __init__(self,filepath, dec:bool=False):
+    def __init__(self,filepath, dec:bool=False, chunk_lines:int=CHUNK_LINES):
+
+        self.filepath = filepath
+        self.dec = dec
+        #eliminate header, its lines up to the first readout if inputting raw data file (.log)
+        self.beginRead = 1 if dec else read_log_header(filepath).count('\n')
+        self.chunk_lines = chunk_lines
+        self._dump = None
+        self._decoded = None
+
+    def iter_lines(self):
+        """
+        Yields the readout lines of the file
+        """
+        with open(self.filepath,"r") as f:
+            yield from itertools.islice(f, self.beginRead, None)
+
+    def iter_dump(self):
+        """
+        Yields per readout: Index, # Removed Bad Events, Hit List
+        """
+        if self._dump is not None:
+            return iter(self._dump)
+        return iter_filtered(self.iter_lines(), self.chunk_lines)
 
-        beginRead = 1 if dec else 7 #eliminate header if inputting raw data file (.log)
-        with open(filepath,"r") as f:
-            self.lines = f.readlines()[beginRead:]
-    
     def dump(self):
         """
         Returns data structure: Index, # Removed Bad Events, Hit List
         """
-        return [regex_filter(i) for i in self.lines]
+        if self._dump is None:
+            self._dump = list(self.iter_dump())
+        return self._dump
     
     def hits(self):
         """
@@ -27,16 +67,35 @@ class postProcessing_streams:
         """
         return [hit for data in self.dump() for hit in data[2]]
 
+    def write_dump(self, ppspath):
+        """
+        Writes the filtered readouts to a XXX_PPS.log file while filtering
+        """
+        with open(ppspath, 'w', encoding='utf-8') as f:
+            f.write(PPS_HEADER)
+            for n, data in enumerate(self.iter_dump()):
+                f.write(pps_line(data) if n == 0 else '\n' + pps_line(data))
+
+    def iter_decode(self):
+        """
+        Yields decoded hits as DataFrame per chunk of readouts, see decode()
+        A raw data file (.log) is filtered first, as if decoding its XXX_PPS.log file
+        """
+        if self._decoded is not None:
+            return iter([self._decoded])
+        lines = self.iter_lines() if self.dec else (pps_line(data) for data in self.iter_dump())
+        return iter_decoded(lines, self.chunk_lines)
+
     def decode(self):
         """
         Returns all decoded hits as DataFrame, structure: readout, Chip ID, payload, location, isCol, timestamp, tot_msb, tot_lsb, tot_total, tot_us
         """
-        data = [hit_decoder(i) for i in self.lines]
-        try:
-            data_df = pd.concat(data)
-            return data_df
-        except ValueError: #no data recorded so nothing to concatenate
-            return
+        if self._decoded is None:
+            frames = list(self.iter_decode())
+            if not frames: #no data recorded so nothing to concatenate
+                return
+            self._decoded = pd.concat(frames)
+        return self._decoded
     
 def readstream(stream):
     """Simple function to read a bytestream from a binary file and
@@ -96,8 +155,8 @@ def hit_decoder(li):
     #separates string into bytes
     bytes_data = [readstream(d) for d in data]
 
-    # converts to binary strings, reverses strings (individually reverse bytes)
-    bin_output = [[readbyte(s)[::-1] for s in a]  for a in bytes_data]
+    # converts to binary strings of the reversed bytes (individually reverse bytes)
+    bin_output = [[REVERSED_BINARY[int(s, 16)] for s in a]  for a in bytes_data]
 
     hit_list = [[packet[i:i + bytesPerHit] for i in range(0, len(packet), bytesPerHit)] for packet in bin_output]
 
@@ -126,3 +185,165 @@ def hit_decoder(li):
             decoded_hits.append(hits)
 
     return pd.DataFrame(decoded_hits)
+
+
+# Faster versions of regex_filter and hit_decoder with identical results. Lines they cannot
+# handle exactly are passed to regex_filter and hit_decoder.
+
+_RAILING = re.compile(r"(ff){2,}")
+
+
+def _filter_line(li):
+    """
+    regex_filter of a line f"{index}\\tb'{hex}'\\n" without rescanning it for every expression
+
+    The railing run at the end of a readout is compared instead of matched, only the text before it is copied.
+    Idle runs are replaced without regex, pairs by spaces, the 'bc' left of an odd run follows a space and is dropped.
+    None if regex_filter is needed
+    """
+    tab = li.find("\tb'")
+    end = len(li) - 2
+    if tab <= 0 or not li.endswith("'\n"):
+        return None
+    index = li[:tab]
+
+    start = li.find('ffff', tab + 3, end)
+    if start >= 0 and li[start:end] == 'f' * (end - start):
+        #(ff){2,} takes pairs up to the end, an odd f is left over
+        text = li[tab + 3:start] + 'f' * ((end - start) % 2)
+    else:
+        text = li[tab + 3:end]
+        if start >= 0:
+            text = _RAILING.sub('', text)
+    if not index.isascii() or not index.isdigit() or "'" in text or '\t' in text or ' ' in text:
+        return None
+
+    if 'bcbc' in text:
+        text = text.replace('bcbc', ' ').replace(' bc', ' ')
+    return int(index), 0, text.split()
+
+
+def filter_lines(lines: list) -> list:
+    """
+    regex_filter of all lines of a file
+
+    input:  lines of AstroPix_V3 XXX.log file
+    output: list of datastring index {int}, # dropped hits {int}, good hits {string list} per line
+    """
+    out = []
+    for li in lines:
+        filtered = _filter_line(li)
+        out.append(regex_filter(li) if filtered is None else filtered)
+    return out
+
+
+def _split_decoded_line(li):
+    """Readout number and hex texts of the hits of a XXX_PPS.log line as hit_decoder reads them, None if it would fail"""
+    fields = li.split()
+    if len(fields) < 3 or not fields[0].isascii() or not fields[0].isdigit():
+        return None
+    data = fields[2:]
+    data[0] = data[0][1:]
+    data = [d[1:-2] for d in data]
+    #readstream reads a last single hex digit as a byte
+    data = [d if len(d) % 2 == 0 else d[:-1] + '0' + d[-1] for d in data]
+    return int(fields[0]), data
+
+
+def decode_lines(lines: list) -> pd.DataFrame:
+    """
+    hit_decoder of all lines of a XXX_PPS.log file, decoded as arrays of bytes
+
+    input:  lines of AstroPix_V3 XXX_PPS.log file (generated with regex_filter)
+    output: DataFrame with the hits of all lines, indexed by the hit number in its line as pd.concat of hit_decoder
+    """
+    bytesPerHit = 5
+    sampleclock_period_ns = 5
+
+    frames = []
+    readouts, packets, lineno = np.zeros(len(lines), dtype=np.int64), [], []
+    for n, li in enumerate(lines):
+        parsed = _split_decoded_line(li)
+        if parsed is None:
+            #hit_decoder decides, usually by raising the same error
+            frames.append((n, hit_decoder(li)))
+            continue
+        readouts[n], data = parsed
+        packets.extend(data)
+        lineno.extend([n] * len(data))
+
+    try:
+        raw = binascii.unhexlify(''.join(packets))
+    except binascii.Error: #not hex as read by int(s, 16), decoded by hit_decoder
+        return pd.concat([hit_decoder(li) for li in lines])
+
+    # Padded so the rows of cut off hits can be gathered too
+    rev = np.concatenate([BITREVERSE_LUT[np.frombuffer(raw, dtype=np.uint8)], np.zeros(bytesPerHit, dtype=np.uint8)])
+    size = np.array([len(d) // 2 for d in packets], dtype=np.int64)
+    offset = np.cumsum(size) - size
+    line = np.array(lineno, dtype=np.int64)
+
+    # One row per 5 bytes of a hit, one row of -1 for a hit cut off at the end of the stream
+    full = size // bytesPerHit
+    rows = full + (size % bytesPerHit > 0)
+    packet = np.repeat(np.arange(len(packets)), rows)
+    k = np.arange(len(packet)) - np.repeat(np.cumsum(rows) - rows, rows)
+    valid = k < full[packet]
+    start = np.where(valid, offset[packet] + bytesPerHit * k, 0)
+    hit = rev[start[:, None] + np.arange(bytesPerHit)].astype(np.int64)
+
+    id          = hit[:, 0] >> 4
+    payload     = hit[:, 0] & 0b111
+    location    = hit[:, 1] & 0b111111
+    col         = hit[:, 1] >> 7
+    timestamp   = hit[:, 2]
+    tot_msb     = hit[:, 3] & 0b1111
+    tot_lsb     = hit[:, 4]
+    tot_total   = (tot_msb << 8) + tot_lsb
+    columns = [id, payload, location, col, timestamp, tot_msb, tot_lsb, tot_total]
+    columns = [np.where(valid, c, -1) for c in columns]
+    tot_us = (columns[-1] * sampleclock_period_ns) / 1000.0
+
+    # Readout number and hit number within the line of every row
+    rowline = line[packet]
+    first = np.searchsorted(rowline, rowline, side='left')
+
+    frame = pd.DataFrame(dict(enumerate([readouts[rowline], *columns, tot_us])), index=np.arange(len(packet)) - first)
+    if not frames:
+        return frame if len(frame) else pd.concat([pd.DataFrame([])] * len(lines))
+
+    #Lines decoded by hit_decoder are put in their place
+    parts = [(n, frame[rowline == n]) for n in np.unique(rowline).tolist()] + frames
+    return pd.concat([f for _, f in sorted(parts, key=lambda part: part[0])])
+
+
+def _chunks(lines, size: int):
+    """Lists of up to size consecutive lines"""
+    lines = iter(lines)
+    while chunk := list(itertools.islice(lines, size)):
+        yield chunk
+
+
+def iter_filtered(lines, chunk_lines: int = CHUNK_LINES):
+    """
+    regex_filter of lines read while iterating, e.g. from an open XXX.log file past its header
+
+    yields: datastring index {int}, # dropped hits {int}, good hits {string list} per line
+    """
+    for chunk in _chunks(lines, chunk_lines):
+        yield from filter_lines(chunk)
+
+
+def pps_line(data) -> str:
+    """Line of a XXX_PPS.log file for a result of regex_filter, without line end"""
+    return f'{data[0]} \t {data[1]} \t {data[2]}'
+
+
+def iter_decoded(lines, chunk_lines: int = CHUNK_LINES):
+    """
+    hit_decoder of lines read while iterating, e.g. from an open XXX_PPS.log file past its header
+
+    yields: DataFrame of the hits of chunk_lines lines, see decode_lines
+    """
+    for chunk in _chunks(lines, chunk_lines):
+        yield decode_lines(chunk)
@@ -0,0 +1,631 @@
+"""
+Raw readout files
+
+Readouts are saved either as text log (one line f"{index}\\t{hexlify(readout)}" per readout after the
+log header) or as binary raw file:
+
+    magic       8 bytes     RAW_MAGIC
+    length      uint32      length of the header
+    header      JSON        format version, log header text, run configuration
+    records     RECORD      readout index (uint32), host time in s (float64),
+                            stored bytes (uint32), railing bytes (uint32), followed by the stored bytes
+
+All numbers are little endian. The railing bytes (0xFF) padding the end of a readout are not stored,
+only counted, so readouts are restored exactly. Text logs have no host time, it is NaN when converted.
+
+RawReader memory maps either layout and serves single readouts by position from an offset index,
+which is saved next to the file and reused as long as the file is unchanged. LogWriter and RawWriter
+save the index when closed, with the host time of every readout, also for text logs. The index holds
+the length of the header and the configuration parsed from the log header, see parse_log_header.
+
+The run header of astropixRun.get_run_header(), with the full configuration, arguments, software version
+and start time as JSON, is saved next to the readouts as <file>.header.json and embedded in the header of
+raw files. read_run_header loads it without parsing the log header text.
+"""
+
+import ast
+import binascii
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+
+import numpy as np
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+RAW_MAGIC = b'APXRAW\r\n'
+RAW_VERSION = 1
+RAW_SUFFIX = '.raw'
+
+# Readout index, host time, stored bytes, railing bytes
+RECORD = struct.Struct('<IdII')
+_LENGTH = struct.Struct('<I')
+
+RAILING_BYTE = 0xff
+
+# Run header saved next to a raw file or text log, see astropixRun.get_run_header
+RUN_HEADER_SUFFIX = '.header.json'
+RUN_HEADER_VERSION = 1
+
+# Offset index saved next to a raw file or text log
+INDEX_SUFFIX = '.idx.npz'
+INDEX_VERSION = 2
+
+
+class _IndexRecords:
+    """Offset index collected while writing, compact arrays instead of a list per readout"""
+
+    def __init__(self):
+        self.readout = array('I')
+        self.host_time = array('d')
+        self.offset = array('q')
+        self.length = array('q')
+        self.railing = array('I')
+
+    def add(self, index: int, host_time: float, offset: int, length: int, railing: int):
+        self.readout.append(index)
+        self.host_time.append(math.nan if host_time is None else host_time)
+        self.offset.append(offset)
+        self.length.append(length)
+        self.railing.append(railing)
+
+    def arrays(self) -> dict:
+        """Index as read by RawReader"""
+        return {
+            'readout':      np.frombuffer(self.readout, dtype=np.uint32),
+            'host_time':    np.frombuffer(self.host_time, dtype=np.float64),
+            'offset':       np.frombuffer(self.offset, dtype=np.int64),
+            'length':       np.frombuffer(self.length, dtype=np.int64),
+            'railing':      np.frombuffer(self.railing, dtype=np.uint32),
+        }
+
+
+class LogWriter:
+    """Write readouts to a text log, as done by the data taking scripts"""
+
+    def __init__(self, path: str, log_header: str, index: bool = True, run_header: dict = None):
+        """
+        :param path: Output file
+        :param log_header: Text before the first readout, astropixRun.get_log_header() and the arguments
+        :param index: Save the offset index with host times next to the file on close, see INDEX_SUFFIX
+        :param run_header: astropixRun.get_run_header(), saved next to the file, see RUN_HEADER_SUFFIX
+        """
+        self.path = path
+        if run_header is not None:
+            write_run_header(path, run_header)
+        self.log_header = log_header
+        # No newline translation, the index counts characters as bytes
+        self._file = open(path, 'w', encoding='utf-8', newline='\n')
+        self._file.write(log_header)
+        self._size = len(log_header.encode('utf-8'))
+        self._header_length = self._size
+        self._index = _IndexRecords() if index else None
+
+    def write(self, index: int, readout: bytes, host_time: float = None):
+        """Append one readout, the host time is saved in the index only"""
+        line = f"{index}\t{str(binascii.hexlify(readout))}\n"
+        self._file.write(line)
+        if self._index is not None:
+            prefix = len(str(index)) + 3
+            self._index.add(index, host_time, self._size + prefix, len(line) - prefix - 2, 0)
+        self._size += len(line)
+
+    @property
+    def size(self) -> int:
+        """Bytes written so far"""
+        return self._size
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        if self._index is not None:
+            save_index(self.path, self._index.arrays(), self._header_length, parse_log_header(self.log_header))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RawWriter:
+    """Write readouts to a binary raw file"""
+
+    def __init__(self, path: str, log_header: str, config: dict = None, index: bool = True, run_header: dict = None):
+        """
+        :param path: Output file
+        :param log_header: Log header text, restored when converting to a text log
+        :param config: Run configuration saved in the header, e.g. vars(args). Values are saved as text if not JSON compatible
+        :param index: Save the offset index next to the file on close, see INDEX_SUFFIX
+        :param run_header: astropixRun.get_run_header(), saved in the header and next to the file
+        """
+        self.path = path
+        if run_header is not None:
+            write_run_header(path, run_header)
+        self.log_header = log_header
+        self.readouts = 0
+
+        header = {
+            'version':      RAW_VERSION,
+            'created':      time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'log_header':   log_header,
+            'config':       config if config is not None else {},
+        }
+        if run_header is not None:
+            header['run'] = run_header
+        header = json.dumps(header, default=str).encode('utf-8')
+
+        self._file = open(path, 'wb')
+        self._file.write(RAW_MAGIC + _LENGTH.pack(len(header)) + header)
+        self._size = len(RAW_MAGIC) + _LENGTH.size + len(header)
+        self._header_length = self._size
+        self._index = _IndexRecords() if index else None
+
+    def write(self, index: int, readout: bytes, host_time: float = None):
+        """
+        Append one readout
+
+        :param index: Readout number
+        :param readout: Raw bytes as returned by astropixRun.get_readout()
+        :param host_time: Host time of the readout in s, NaN if None
+        """
+        stored = len(readout.rstrip(b'\xff'))
+        self._file.write(RECORD.pack(index, math.nan if host_time is None else host_time,
+                                     stored, len(readout) - stored))
+        self._file.write(readout[:stored])
+        if self._index is not None:
+            self._index.add(index, host_time, self._size + RECORD.size, stored, len(readout) - stored)
+        self.readouts += 1
+        self._size += RECORD.size + stored
+
+    @property
+    def size(self) -> int:
+        """Bytes written so far"""
+        return self._size
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        if self._index is not None:
+            save_index(self.path, self._index.arrays(), self._header_length, parse_log_header(self.log_header))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_readout_log(path: str, log_header: str, binary: bool = False, config: dict = None, index: bool = True,
+                     run_header: dict = None):
+    """
+    Open a text log or, with binary, a raw file with RAW_SUFFIX instead of the suffix of path
+
+    :returns: LogWriter or RawWriter
+    """
+    if not binary:
+        return LogWriter(path, log_header, index, run_header)
+
+    if path.endswith('.log'):
+        path = path[:-4]
+    return RawWriter(path + RAW_SUFFIX, log_header, config, index, run_header)
+
+
+def write_run_header(path: str, run_header: dict):
+    """Save the run header next to the readout file path, see RUN_HEADER_SUFFIX"""
+    tmp = path + RUN_HEADER_SUFFIX + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(run_header, f, default=str)
+    os.replace(tmp, path + RUN_HEADER_SUFFIX)
+
+
+def read_run_header(path: str) -> dict:
+    """
+    Run header of a text log or raw file, see astropixRun.get_run_header
+
+    Files without run header get one with version 0, config and args parsed from the log header.
+
+    :returns: Dict with at least version, config and args
+    """
+    if os.path.exists(path + RUN_HEADER_SUFFIX):
+        with open(path + RUN_HEADER_SUFFIX) as f:
+            run_header = json.load(f)
+    elif is_raw(path):
+        header = read_raw_header(path)
+        run_header = header.get('run')
+        if run_header is None:
+            config = parse_log_header(header['log_header'])
+            args = header['config'] or config.get('args')
+    else:
+        run_header = None
+        config = parse_log_header(read_log_header(path))
+        args = config.get('args')
+
+    if run_header is not None:
+        if run_header.get('version', 0) > RUN_HEADER_VERSION:
+            logger.warning("%s has run header version %s, newer than %d", path, run_header.get('version'), RUN_HEADER_VERSION)
+        return run_header
+
+    config.pop('args', None)
+    return {'version': 0, 'config': config, 'args': args if isinstance(args, dict) else {}}
+
+
+def is_raw(path: str) -> bool:
+    """True if path is a binary raw file"""
+    with open(path, 'rb') as f:
+        return f.read(len(RAW_MAGIC)) == RAW_MAGIC
+
+
+def _parse_header(data: bytes, path: str) -> tuple:
+    """Header dict and offset of the first record"""
+    if data[:len(RAW_MAGIC)] != RAW_MAGIC or len(data) < len(RAW_MAGIC) + _LENGTH.size:
+        raise ValueError(f"{path} is not a raw readout file")
+
+    start = len(RAW_MAGIC) + _LENGTH.size
+    length, = _LENGTH.unpack_from(data, len(RAW_MAGIC))
+    header = json.loads(data[start:start + length].decode('utf-8'))
+
+    if header.get('version', 0) > RAW_VERSION:
+        logger.warning("%s has raw format version %s, newer than %d", path, header.get('version'), RAW_VERSION)
+
+    return header, start + length
+
+
+def _read_raw_header(f, path: str) -> dict:
+    """Read the header of an open raw file, the file is left at the first record"""
+    start = f.read(len(RAW_MAGIC) + _LENGTH.size)
+    if len(start) < len(RAW_MAGIC) + _LENGTH.size:
+        raise ValueError(f"{path} is not a raw readout file")
+    length, = _LENGTH.unpack_from(start, len(RAW_MAGIC))
+    header, _ = _parse_header(start + f.read(length), path)
+    return header
+
+
+def read_raw_header(path: str) -> dict:
+    """
+    Header of a raw file
+
+    :returns: Dict with version, created, log_header and config
+    """
+    with open(path, 'rb') as f:
+        return _read_raw_header(f, path)
+
+
+def iter_raw(path: str):
+    """
+    Iterate over the readouts of a raw file, read record by record
+
+    :yields: Readout index, host time in s, readout bytes
+    """
+    railing = bytes([RAILING_BYTE])
+
+    with open(path, 'rb') as f:
+        _read_raw_header(f, path)
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                break
+            index, host_time, stored, nrailing = RECORD.unpack(record)
+            data = f.read(stored)
+            if len(data) < stored:
+                logger.warning("%s ends within readout %d, %d bytes missing", path, index, stored - len(data))
+                break
+            yield index, host_time, data + railing * nrailing
+
+
+def read_log_header(path: str) -> str:
+    """Text before the first readout of a text log"""
+    lines = []
+    with open(path, 'r') as f:
+        for line in f:
+            if _is_readout_line(line):
+                break
+            lines.append(line)
+    return ''.join(lines)
+
+
+def _literal(node):
+    """Value of a Python literal, its text otherwise"""
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return ast.unparse(node) if isinstance(node, ast.AST) else node
+
+
+def parse_log_header(log_header: str) -> dict:
+    """
+    Configuration in the header of a text log, astropixRun.get_log_header() and the arguments
+
+    Lines "Name: {...}" give a dict per name, the line "Namespace(...)" of the arguments
+    gives a dict 'args'. Values that are not Python literals are kept as text.
+    """
+    config = {}
+    for line in log_header.splitlines():
+        line = line.strip()
+        if line.startswith('Namespace('):
+            try:
+                call = ast.parse(line, mode='eval').body
+            except SyntaxError:
+                config['args'] = line
+                continue
+            config['args'] = {kw.arg: _literal(kw.value) for kw in call.keywords} if isinstance(call, ast.Call) else line
+            continue
+
+        name, sep, value = line.partition(': ')
+        if sep and name.isidentifier():
+            config[name] = _literal(value)
+        elif line:
+            logger.debug("Log header line not parsed: %s", line[:80])
+    return config
+
+
+def save_index(path: str, index: dict, header_length: int, config: dict):
+    """
+    Save the offset index of a closed file next to it, see INDEX_SUFFIX
+
+    :param index: Arrays readout, host_time, offset, length and railing, see RawReader
+    :param header_length: Bytes before the first readout
+    :param config: Parsed log header, saved as JSON
+    """
+    stat = os.stat(path)
+    try:
+        with open(path + INDEX_SUFFIX, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                     header_length=header_length, config=json.dumps(config, default=str), **index)
+    except OSError as e:
+        logger.debug("Index of %s not saved: %s", path, e)
+
+
+def _is_readout_line(line: str) -> bool:
+    index, tab, data = line.partition('\t')
+    return bool(tab) and index.isdigit() and data.startswith("b'")
+
+
+def iter_log(path: str):
+    """
+    Iterate over the readouts of a text log
+
+    :yields: Readout index, NaN host time, readout bytes
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            if not _is_readout_line(line):
+                continue
+            index, _, data = line.rstrip('\n').partition('\t')
+            yield int(index), math.nan, binascii.unhexlify(data[2:-1])
+
+
+def iter_readouts(path: str):
+    """
+    Iterate over the readouts of a text log or raw file
+
+    :yields: Readout index, host time in s (NaN for text logs), readout bytes
+    """
+    return iter_raw(path) if is_raw(path) else iter_log(path)
+
+
+class RawReader:
+    """
+    Random access to the readouts of a raw file or text log
+
+    The file is memory mapped, only the offset index is held in memory:
+    readout number, host time, offset and length of the data, railing bytes.
+    view() returns the stored data without copy, the hex text for text logs.
+    Host times of text logs are known if the index was saved by LogWriter, NaN otherwise.
+    """
+
+    def __init__(self, path: str, save_index: bool = True):
+        """
+        :param path: Raw file or text log
+        :param save_index: Save a newly built index next to the file, see INDEX_SUFFIX
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.binary = self._mm[:len(RAW_MAGIC)] == RAW_MAGIC
+
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = self._build_index()
+            if save_index:
+                self._save_index()
+
+    def __len__(self) -> int:
+        return len(self.index['offset'])
+
+    @property
+    def indexpath(self) -> str:
+        return self.path + INDEX_SUFFIX
+
+    def _stat(self) -> tuple:
+        stat = os.fstat(self._file.fileno())
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load_index(self) -> dict:
+        """Saved index, None if missing or outdated"""
+        try:
+            with np.load(self.indexpath) as saved:
+                index = {name: saved[name] for name in saved.files}
+        except (OSError, ValueError, KeyError):
+            return None
+
+        stamp = (int(index.pop('version')), int(index.pop('size')), int(index.pop('mtime_ns')))
+        if stamp != (INDEX_VERSION, *self._stat()):
+            logger.debug("Index of %s is outdated, rebuilding", self.path)
+            return None
+        self.header_length = int(index.pop('header_length'))
+        self.config = json.loads(str(index.pop('config')))
+        return index
+
+    def _save_index(self):
+        save_index(self.path, self.index, self.header_length, self.config)
+
+    def _build_index(self) -> dict:
+        records = self._index_raw() if self.binary else self._index_log()
+        readout, host_time, offset, length, railing = zip(*records) if records else ((),) * 5
+        logger.debug("Indexed %d readouts of %s", len(offset), self.path)
+
+        if self.binary:
+            header, self.header_length = _parse_header(self._mm, self.path)
+            log_header = header['log_header']
+        else:
+            self.header_length = self._mm.rfind(b'\n', 0, offset[0]) + 1 if offset else len(self._mm)
+            log_header = self._mm[:self.header_length].decode('utf-8')
+        #As loaded from a saved index
+        self.config = json.loads(json.dumps(parse_log_header(log_header), default=str))
+
+        return {
+            'readout':      np.array(readout, dtype=np.uint32),
+            'host_time':    np.array(host_time, dtype=np.float64),
+            'offset':       np.array(offset, dtype=np.int64),
+            'length':       np.array(length, dtype=np.int64),
+            'railing':      np.array(railing, dtype=np.uint32),
+        }
+
+    def _index_raw(self) -> list:
+        mm = self._mm
+        _, pos = _parse_header(mm, self.path)
+        end = len(mm)
+        records = []
+        while pos + RECORD.size <= end:
+            index, host_time, stored, nrailing = RECORD.unpack_from(mm, pos)
+            pos += RECORD.size
+            if pos + stored > end:
+                logger.warning("%s ends within readout %d, %d bytes missing", self.path, index, pos + stored - end)
+                break
+            records.append((index, host_time, pos, stored, nrailing))
+            pos += stored
+        return records
+
+    def _index_log(self) -> list:
+        """Readout lines f"{index}\\t{hexlify(readout)}", header lines have no tab"""
+        mm = self._mm
+        records = []
+        pos = mm.find(b"\tb'")
+        while pos >= 0:
+            line = mm.rfind(b'\n', 0, pos) + 1
+            start = pos + 3
+            end = mm.find(b"'", start)
+            if end < 0:
+                logger.warning("%s ends within readout line at byte %d", self.path, line)
+                break
+            records.append((int(mm[line:pos]), math.nan, start, end - start, 0))
+            pos = mm.find(b"\tb'", end)
+        return records
+
+    @property
+    def header(self):
+        """Header dict of raw files, log header text of text logs"""
+        if self.binary:
+            return _parse_header(self._mm, self.path)[0]
+        return self._mm[:self.header_length].decode('utf-8')
+
+    def find_readout(self, readout: int) -> int:
+        """Position of the readout with number readout, raises KeyError if not in the file"""
+        numbers = self.index['readout']
+        i = int(np.searchsorted(numbers, readout))
+        if i < len(numbers) and numbers[i] == readout:
+            return i
+        #Numbers not increasing, e.g. a restarted run appended to the file
+        found = np.flatnonzero(numbers == readout)
+        if not len(found):
+            raise KeyError(f"Readout {readout} is not in {self.path}")
+        return int(found[0])
+
+    def find_time(self, host_time: float) -> int:
+        """Position of the first readout at or after host_time in s, len(self) if none"""
+        times = self.index['host_time']
+        if len(times) and np.isnan(times).all():
+            raise ValueError(f"{self.path} has no host times, its index was not saved while taking data")
+        return int(np.searchsorted(times, host_time, side='left'))
+
+    def view(self, i: int) -> memoryview:
+        """Stored data of readout i without copy, hex text for text logs"""
+        start = int(self.index['offset'][i])
+        return memoryview(self._mm)[start:start + int(self.index['length'][i])]
+
+    def readout(self, i: int) -> bytes:
+        """Readout i as returned by astropixRun.get_readout()"""
+        data = self.view(i)
+        if not self.binary:
+            return binascii.unhexlify(data)
+        railing = int(self.index['railing'][i])
+        return bytes(data) + bytes([RAILING_BYTE]) * railing if railing else bytes(data)
+
+    def __getitem__(self, key):
+        """Readout by position, list of readouts for a slice or array of positions"""
+        if isinstance(key, slice):
+            return [self.readout(i) for i in range(*key.indices(len(self)))]
+        if np.ndim(key):
+            return [self.readout(i) for i in np.asarray(key)]
+        return self.readout(key)
+
+    def records(self, start: int = 0, stop: int = None):
+        """
+        Iterate over readouts start to stop
+
+        :yields: Readout index, host time in s (NaN for text logs), readout bytes
+        """
+        readout = self.index['readout']
+        host_time = self.index['host_time']
+        for i in range(*slice(start, stop).indices(len(self))):
+            yield int(readout[i]), float(host_time[i]), self.readout(i)
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def log_to_raw(logpath: str, rawpath: str) -> int:
+    """
+    Convert a text log to a raw file
+
+    :returns: Number of readouts
+    """
+    #e.g. a _PPS.log file of postProcessing_streams, neither log header nor readout lines
+    if not parse_log_header(read_log_header(logpath)) and next(iter_log(logpath), None) is None:
+        raise ValueError(f"{logpath} is not a readout log, no log header and no readouts")
+    run_header = read_run_header(logpath)
+    with RawWriter(rawpath, read_log_header(logpath), {'converted_from': logpath},
+                   run_header=run_header if run_header['version'] else None) as writer:
+        for index, host_time, readout in iter_log(logpath):
+            writer.write(index, readout, host_time)
+    return writer.readouts
+
+
+def raw_to_log(rawpath: str, logpath: str) -> int:
+    """
+    Convert a raw file to a text log, host times are lost
+
+    :returns: Number of readouts
+    """
+    readouts = 0
+    header = read_raw_header(rawpath)
+    with LogWriter(logpath, header['log_header'], run_header=header.get('run')) as writer:
+        for index, host_time, readout in iter_raw(rawpath):
+            writer.write(index, readout, host_time)
+            readouts += 1
+    return readouts
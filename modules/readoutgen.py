@@ -0,0 +1,274 @@
+"""
+Synthetic AstroPix readout streams for decoder tests and benchmarks
+
+Generates readouts as returned by astropixRun.get_readout(): bit order reversed frames
+between idle bytes (0xBC), padded with railing bytes (0xFF) to the readout size.
+Hits, truncated frames and corrupted bytes are drawn from a seeded generator, so
+the same settings always give the same stream.
+
+AstroPix 3 hits are written as a row and a column frame (5 bytes each),
+AstroPix 4 hits as one frame of 8 bytes with Gray coded timestamps.
+"""
+
+import binascii
+
+import numpy as np
+
+from core.hitbatch import HitBatch
+from utils.bitorder import BITREVERSE_LUT
+
+IDLE_BYTE = 0xbc
+RAILING_BYTE = 0xff
+
+# Pixel matrix per chip version as (rows, cols)
+GEOMETRY = {3: (35, 35), 4: (16, 13)}
+
+# Columns of the generated hits, see ReadoutGenerator.truth
+TRUTH_DTYPES = {
+    'readout':  np.uint32,
+    'chip':     np.uint8,
+    'row':      np.uint8,
+    'col':      np.uint8,
+    'time':     np.int64,
+    'tot_us':   np.float64,
+}
+
+
+def gray_encode(value: np.ndarray) -> np.ndarray:
+    """Binary to Gray code, inverse of Decode.gray_to_dec"""
+    return value ^ (value >> 1)
+
+
+class ReadoutGenerator:
+    """
+    Deterministic generator of AstroPix 3/4 readouts
+
+    Hit times count in ticks of the chip timestamp, the AstroPix 3 timestamp is the lower 8 bits,
+    the AstroPix 4 timestamps (ts_dec1, ts_dec2) the lower 17 bits of it.
+    """
+
+    def __init__(self, chipversion: int = 3, nchips: int = 1, hits_per_readout: float = 2.0,
+                 readout_size: int = 2048, idle_before: int = 2, idle_after: int = 12, gap: int = 0,
+                 truncate: float = 0.0, corrupt: float = 0.0, ticks_per_readout: int = 1000,
+                 sampleclock_period_ns: int = 5, seed: int = 0):
+        """
+        :param chipversion: 3 or 4, selects frame format
+        :param nchips: Number of daisy chained chips, hits are spread evenly
+        :param hits_per_readout: Mean of the Poisson distributed number of hits per readout
+        :param readout_size: Bytes per readout, filled with railing after the last idle byte.
+            Readouts are longer if the hits do not fit.
+        :param idle_before: Idle bytes before the first frame
+        :param idle_after: Idle bytes after the last frame
+        :param gap: Maximum number of idle bytes between hits, drawn uniformly
+        :param truncate: Probability to cut a readout in its last frame, the rest of the frame
+            starts the next readout
+        :param corrupt: Probability for every frame byte to get one bit flipped
+        :param ticks_per_readout: Timestamp ticks between two readouts
+        :param sampleclock_period_ns: Sample clock period, AstroPix 3 ToT unit
+        :param seed: Seed of the random generator
+        """
+        if chipversion not in GEOMETRY:
+            raise ValueError(f"Unknown chip version {chipversion}, use 3 or 4")
+
+        self.chipversion = chipversion
+        self.nchips = nchips
+        self.hits_per_readout = hits_per_readout
+        self.readout_size = readout_size
+        self.idle_before = idle_before
+        self.idle_after = idle_after
+        self.gap = gap
+        self.truncate = truncate
+        self.corrupt = corrupt
+        self.ticks_per_readout = ticks_per_readout
+        self.sampleclock_period_ns = sampleclock_period_ns
+        self.seed = seed
+
+        self.bytesperhit = 8 if chipversion == 4 else 5
+        self.rows, self.cols = GEOMETRY[chipversion]
+
+        self.reset()
+
+    def reset(self):
+        """Restart the stream from the seed"""
+        self._rng = np.random.default_rng(self.seed)
+        self._carry = b''
+        self._readout = 0
+        self._truth = []
+        self._frames = []
+        self.frames_truncated = 0
+        self.bytes_corrupted = 0
+
+    def config(self) -> dict:
+        """Generator settings, written to the header of log files"""
+        return {
+            'chipversion':          self.chipversion,
+            'nchips':               self.nchips,
+            'hits_per_readout':     self.hits_per_readout,
+            'readout_size':         self.readout_size,
+            'idle_before':          self.idle_before,
+            'idle_after':           self.idle_after,
+            'gap':                  self.gap,
+            'truncate':             self.truncate,
+            'corrupt':              self.corrupt,
+            'ticks_per_readout':    self.ticks_per_readout,
+            'sampleclock_period_ns': self.sampleclock_period_ns,
+            'seed':                 self.seed,
+        }
+
+    def _hits(self) -> HitBatch:
+        """Draw the hits of the next readout, sorted by time"""
+        rng = self._rng
+        n = rng.poisson(self.hits_per_readout)
+        start = self._readout * self.ticks_per_readout
+
+        return HitBatch({
+            'readout':  self._readout,
+            'chip':     rng.integers(0, self.nchips, n),
+            'row':      rng.integers(0, self.rows, n),
+            'col':      rng.integers(0, self.cols, n),
+            'time':     start + np.sort(rng.integers(0, self.ticks_per_readout, n)),
+            # Typical MIP signals, a few us. Limited to the 12bit AstroPix 3 ToT counter
+            'tot_us':   np.clip(rng.gamma(4.0, 1.25, n), 0.01, 20.0),
+        }, TRUTH_DTYPES)
+
+    def _astropix3_frames(self, hits: HitBatch) -> np.ndarray:
+        """Row and column frame for every hit, not bit order reversed"""
+        n = len(hits)
+        tot_total = np.rint(hits['tot_us'] * 1000.0 / self.sampleclock_period_ns).astype(np.int64)
+
+        frames = np.empty((n, 2, 5), dtype=np.uint8)
+        frames[:, :, 0] = ((hits['chip'].astype(np.int64) << 3) + self.bytesperhit - 1)[:, None]
+        frames[:, 0, 1] = hits['row']
+        frames[:, 1, 1] = (1 << 7) | hits['col']
+        frames[:, :, 2] = (hits['time'] & 0xff)[:, None]
+        frames[:, :, 3] = (tot_total >> 8)[:, None]
+        frames[:, :, 4] = (tot_total & 0xff)[:, None]
+
+        return frames.reshape(2 * n, 5)
+
+    def _astropix4_frames(self, hits: HitBatch) -> np.ndarray:
+        """One frame per hit, not bit order reversed"""
+        mask = 2**17 - 1
+        ts_dec1 = hits['time'] & mask
+        ts_dec2 = (ts_dec1 + np.rint(hits['tot_us'] * 20).astype(np.int64)) & mask
+
+        gray1 = gray_encode(ts_dec1)
+        gray2 = gray_encode(ts_dec2)
+        ts1, tsfine1 = gray1 >> 3, gray1 & 0b111
+        ts2, tsfine2 = gray2 >> 3, gray2 & 0b111
+
+        row = hits['row'].astype(np.int64)
+        col = hits['col'].astype(np.int64)
+
+        frames = np.empty((len(hits), 8), dtype=np.uint8)
+        frames[:, 0] = (hits['chip'].astype(np.int64) << 3) + self.bytesperhit - 1
+        frames[:, 1] = (row << 3) | (col >> 2)
+        frames[:, 2] = ((col & 0b11) << 6) | (ts1 >> 9)
+        frames[:, 3] = (ts1 >> 1) & 0xff
+        frames[:, 4] = ((ts1 & 1) << 7) | (tsfine1 << 4)
+        frames[:, 5] = ts2 >> 8
+        frames[:, 6] = ts2 & 0xff
+        frames[:, 7] = tsfine2 << 5
+
+        return frames
+
+    def _corrupt(self, frames: np.ndarray) -> np.ndarray:
+        """Flip one random bit in a fraction of the frame bytes"""
+        flips = self._rng.random(frames.shape) < self.corrupt
+        nflips = int(flips.sum())
+        if nflips:
+            frames = frames.copy()
+            frames[flips] ^= (1 << self._rng.integers(0, 8, nflips)).astype(np.uint8)
+            self.bytes_corrupted += nflips
+        return frames
+
+    def readout(self) -> bytes:
+        """Generate the next readout"""
+        rng = self._rng
+        hits = self._hits()
+
+        frames = self._astropix4_frames(hits) if self.chipversion == 4 else self._astropix3_frames(hits)
+        self._truth.append(hits)
+        self._frames.append(frames)
+
+        if self.corrupt:
+            frames = self._corrupt(frames)
+
+        # Idle bytes in front of every hit, frames of one AstroPix 3 hit are not separated
+        nframes = len(frames)
+        per_hit = 2 if self.chipversion == 3 else 1
+        idle = np.zeros(nframes, dtype=np.int64)
+        if self.gap:
+            idle[::per_hit] = rng.integers(0, self.gap + 1, nframes // per_hit)
+        idle[0:1] = self.idle_before
+
+        starts = np.cumsum(idle + self.bytesperhit) - self.bytesperhit
+        body_length = int(starts[-1] + self.bytesperhit) if nframes else self.idle_before
+
+        body = np.full(body_length, IDLE_BYTE, dtype=np.uint8)
+        body[starts[:, None] + np.arange(self.bytesperhit)] = BITREVERSE_LUT[frames]
+
+        readout = self._carry + body.tobytes()
+        self._carry = b''
+
+        if nframes and rng.random() < self.truncate:
+            # Readout ends within the last frame, the remaining bytes arrive with the next readout
+            cut = len(readout) - int(rng.integers(1, self.bytesperhit))
+            readout, self._carry = readout[:cut], readout[cut:]
+            self.frames_truncated += 1
+        else:
+            readout += bytes([IDLE_BYTE]) * self.idle_after
+            readout += bytes([RAILING_BYTE]) * max(self.readout_size - len(readout), 0)
+
+        self._readout += 1
+        return readout
+
+    def readouts(self, nreadouts: int) -> list:
+        """Generate the next nreadouts readouts"""
+        return [self.readout() for _ in range(nreadouts)]
+
+    def stream(self, nreadouts: int = None):
+        """Iterate over readouts, endless if nreadouts is None"""
+        i = 0
+        while nreadouts is None or i < nreadouts:
+            yield self.readout()
+            i += 1
+
+    def truth(self) -> HitBatch:
+        """All generated hits so far, independent of truncation and corruption"""
+        return HitBatch.concat(self._truth, TRUTH_DTYPES)
+
+    def truth_frames(self) -> np.ndarray:
+        """All generated frames so far in stream order, uncorrupted and not bit order reversed"""
+        if not self._frames:
+            return np.empty((0, self.bytesperhit), dtype=np.uint8)
+        return np.concatenate(self._frames)
+
+    def log_header(self) -> str:
+        """
+        Header of 7 lines as written by beam_test.py for AstroPix 3,
+        so generated logs can be read like recorded ones
+        """
+        config = self.config()
+        lines = [
+            f"Generator: { {k: config[k] for k in ('chipversion', 'nchips', 'seed')} }",
+            f"Geometry: { {'rows': self.rows, 'cols': self.cols} }",
+            f"Rate: { {k: config[k] for k in ('hits_per_readout', 'ticks_per_readout')} }",
+            f"Readout: { {k: config[k] for k in ('readout_size', 'idle_before', 'idle_after', 'gap')} }",
+            f"Errors: { {k: config[k] for k in ('truncate', 'corrupt')} }",
+            f"Clock: { {'sampleclock_period_ns': self.sampleclock_period_ns} }",
+            f"{config}",
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_log(self, path: str, nreadouts: int):
+        """
+        Write nreadouts readouts to a .log file in the format of beam_test.py
+
+        :param path: Output file
+        :param nreadouts: Number of readouts
+        """
+        with open(path, 'w') as f:
+            f.write(self.log_header())
+            for readout in self.stream(nreadouts):
+                f.write(f"{self._readout - 1}\t{str(binascii.hexlify(readout))}\n")
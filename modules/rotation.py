@@ -0,0 +1,259 @@
+"""
+Rotation of the output files of long runs
+
+The readout log and the decoded hit files of a run are split into segments of at most max_bytes
+of readouts or max_seconds. Segment n of run_20240101-120000.log is run_20240101-120000_0003.log
+for n = 3, the same for every hit file. A segment is finished when the readout log reaches a limit,
+all files of the run are then closed and reopened for the next segment, so every file of a segment
+holds the same readouts. Hits split between the last readout of a segment and the first readout of the
+next are written to the next segment.
+
+The manifest run_20240101-120000_manifest.json lists the segments with their files, readout range and
+time span. It is rewritten on every rotation, finished segments have closed set and can be decoded
+while the run continues, see iter_segments and decode_postRun.py --manifest.
+"""
+
+import json
+import os
+import time
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = '_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def segment_path(path: str, segment: int) -> str:
+    """Path of a segment of the output file path"""
+    root, suffix = os.path.splitext(path)
+    return f"{root}_{segment:04d}{suffix}"
+
+
+def manifest_path(path: str) -> str:
+    """Manifest of the run with readout log path"""
+    return os.path.splitext(path)[0] + MANIFEST_SUFFIX
+
+
+class SegmentWriter:
+    """
+    Output file of a rotated run, reopened for every segment
+
+    Has the interface of the wrapped writer, which is created by opener(path) for every segment.
+    """
+
+    def __init__(self, rotation, path: str, opener, log: bool = False):
+        """
+        :param rotation: OutputRotation of the run
+        :param path: Output file, the segment number is added before the suffix
+        :param opener: Function opening a writer for a path, e.g. a lambda around open_hit_writer
+        :param log: True for the readout log, its size and readouts decide when to rotate
+        """
+        self.rotation = rotation
+        self.path = path
+        self.opener = opener
+        self.log = log
+        self.writer = None
+        # Files of all segments so far, hits written to the closed ones
+        self.paths = []
+        self.hits = 0
+
+    def open(self, segment: int) -> str:
+        """Open the file of a segment, returns its path"""
+        self.writer = self.opener(segment_path(self.path, segment))
+        self.paths.append(self.writer.path)
+        return self.writer.path
+
+    def write(self, index: int, readout: bytes, host_time: float = None):
+        """Append one readout to the log, starts a new segment first if the current one is full"""
+        if self.log:
+            self.rotation.next_readout(index, host_time)
+        self.writer.write(index, readout, host_time)
+        if self.log:
+            self.rotation.update(self.writer.size)
+
+    def append(self, batch, *args, **kwargs):
+        self.writer.append(batch, *args, **kwargs)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        """Close the file of the current segment, the manifest is completed by OutputRotation.close"""
+        if self.writer is not None:
+            self.writer.close()
+            self.hits += getattr(self.writer, 'hits', 0)
+            self.writer = None
+
+
+class OutputRotation:
+    """
+    Split the output files of a run into segments and keep the manifest
+
+    Without limits the files are opened unchanged, without segments and manifest.
+    """
+
+    def __init__(self, path: str, max_bytes: int = None, max_seconds: float = None):
+        """
+        :param path: Readout log of the run, names the manifest
+        :param max_bytes: Start a new segment when the readout log of the segment is this large
+        :param max_seconds: Start a new segment after this many seconds of host time
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.manifest = manifest_path(path)
+
+        self.writers = []
+        self.segments = []
+        self.created = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_bytes) or bool(self.max_seconds)
+
+    def add(self, path: str, opener, log: bool = False):
+        """
+        Open an output file of the run
+
+        :param path: Output file
+        :param opener: Function opening a writer for a path
+        :param log: True for the readout log, exactly one per run
+
+        :returns: Writer of opener, in a SegmentWriter if rotation is enabled
+        """
+        if not self.enabled:
+            return opener(path)
+
+        writer = SegmentWriter(self, path, opener, log)
+        if not self.segments:
+            self._new_segment()
+        self.segments[-1]['files'].append(os.path.basename(writer.open(len(self.segments) - 1)))
+        if log:
+            self.segments[-1]['log'] = self.segments[-1]['files'][-1]
+        self.writers.append(writer)
+        self.write_manifest()
+        return writer
+
+    def _new_segment(self):
+        self.segments.append({
+            'segment':          len(self.segments),
+            'log':              None,
+            'files':            [],
+            'first_readout':    None,
+            'last_readout':     None,
+            'readouts':         0,
+            'start_time':       None,
+            'end_time':         None,
+            'bytes':            0,
+            'closed':           False,
+        })
+
+    def next_readout(self, index: int, host_time: float = None):
+        """Count a readout of the log, starts a new segment first if the current one is full"""
+        host_time = time.time() if host_time is None else host_time
+        current = self.segments[-1]
+
+        if current['readouts'] and (
+                (self.max_bytes and current['bytes'] >= self.max_bytes)
+                or (self.max_seconds and host_time - current['start_time'] >= self.max_seconds)):
+            self.rotate()
+            current = self.segments[-1]
+
+        if current['first_readout'] is None:
+            current['first_readout'] = index
+            current['start_time'] = host_time
+        current['last_readout'] = index
+        current['end_time'] = host_time
+        current['readouts'] += 1
+
+    def update(self, size: int):
+        """Size of the readout log of the current segment"""
+        self.segments[-1]['bytes'] = size
+
+    def rotate(self):
+        """Close all files and continue in the next segment"""
+        for writer in self.writers:
+            writer.close()
+        self.segments[-1]['closed'] = True
+        finished = self.segments[-1]
+
+        self._new_segment()
+        for writer in self.writers:
+            name = os.path.basename(writer.open(len(self.segments) - 1))
+            self.segments[-1]['files'].append(name)
+            if writer.log:
+                self.segments[-1]['log'] = name
+
+        self.write_manifest()
+        logger.info("Segment %d finished: readouts %s to %s, %d bytes", finished['segment'],
+                    finished['first_readout'], finished['last_readout'], finished['bytes'])
+
+    def write_manifest(self, complete: bool = False):
+        """Replace the manifest, readers never see a partial file"""
+        manifest = {
+            'version':      MANIFEST_VERSION,
+            'created':      self.created,
+            'max_bytes':    self.max_bytes,
+            'max_seconds':  self.max_seconds,
+            'complete':     complete,
+            'segments':     self.segments,
+        }
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self.manifest)
+
+    def close(self):
+        """Close all files and complete the manifest, at the end of the run"""
+        if not self.enabled:
+            return
+        for writer in self.writers:
+            writer.close()
+        if self.segments:
+            self.segments[-1]['closed'] = True
+        self.write_manifest(complete=True)
+        logger.info("%d segments listed in %s", len(self.segments), self.manifest)
+
+
+def read_manifest(path: str) -> dict:
+    """Manifest written by OutputRotation"""
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version', 0) > MANIFEST_VERSION:
+        logger.warning("%s has manifest version %s, newer than %d", path, manifest.get('version'), MANIFEST_VERSION)
+    return manifest
+
+
+def iter_segments(path: str, follow: bool = False, poll_seconds: float = 10):
+    """
+    Iterate over the finished segments of a run
+
+    :param path: Manifest of the run
+    :param follow: Wait for further segments until the run is complete
+    :param poll_seconds: Time between reads of the manifest when following
+
+    :yields: Segment dict of the manifest, log and files as paths next to the manifest,
+             last True for the final segment of a complete run
+    """
+    directory = os.path.dirname(path)
+    done = 0
+
+    while True:
+        manifest = read_manifest(path)
+        for n, segment in enumerate(manifest['segments'][done:], done):
+            if not segment['closed']:
+                break
+            segment = dict(segment)
+            segment['last'] = manifest['complete'] and n == len(manifest['segments']) - 1
+            segment['log'] = os.path.join(directory, segment['log']) if segment['log'] else None
+            segment['files'] = [os.path.join(directory, name) for name in segment['files']]
+            done += 1
+            yield segment
+
+        if manifest['complete'] or not follow:
+            return
+        time.sleep(poll_seconds)
@@ -0,0 +1,331 @@
+"""
+Catalog of the runs in an output directory
+
+The data taking scripts register every run in the SQLite database runs.sqlite in their output directory,
+catalog_runs.py adds runs of existing directories. A run is one readout log, or the segments of a rotated
+run, with the files written next to it. Runs are looked up by indexed columns instead of file names:
+
+    with RunCatalog('data/') as catalog:
+        runs = catalog.find(col=15, row=15, threshold=100.0)
+
+Tables:
+    runs    One row per run: name and start of the file names, script, pixel, injection in mV, threshold
+            in mV, chip version, yaml, readouts, hits, duration in s, the first log and the configuration
+            of the run header as JSON, see modules/rawdata.read_run_header
+    files   Every file of a run with its kind: log, hits, yml, manifest, header, decoded
+
+Paths are saved relative to the directory of the catalog, so the directory can be moved.
+"""
+
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+
+from modules.hitwriter import read_hits
+from modules.rawdata import RUN_HEADER_SUFFIX, RawReader, read_run_header
+from modules.rotation import SegmentWriter
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = 'runs.sqlite'
+CATALOG_VERSION = 1
+
+# Columns of runs that can be searched with find()
+RUN_COLUMNS = ('name', 'started', 'script', 'col', 'row', 'injection', 'threshold', 'chip_version', 'yaml',
+               'readouts', 'hits', 'duration', 'log')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id              INTEGER PRIMARY KEY,
+    name            TEXT,
+    started         TEXT,
+    script          TEXT,
+    col             INTEGER,
+    row             INTEGER,
+    injection       REAL,
+    threshold       REAL,
+    chip_version    INTEGER,
+    yaml            TEXT,
+    readouts        INTEGER,
+    hits            INTEGER,
+    duration        REAL,
+    log             TEXT UNIQUE NOT NULL,
+    config          TEXT,
+    registered      TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    run_id          INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    path            TEXT UNIQUE NOT NULL,
+    kind            TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_pixel ON runs(col, row);
+CREATE INDEX IF NOT EXISTS runs_injection ON runs(injection);
+CREATE INDEX IF NOT EXISTS runs_threshold ON runs(threshold);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+CREATE INDEX IF NOT EXISTS files_run ON files(run_id);
+"""
+
+# Parts of the output file names of the scripts, e.g. injectionscan_c15r15_1300.0inj_100.0thr_20240920-171837
+_TIMESTAMP = re.compile(r'_?(\d{8}-\d{6})(_\d{4})?$')
+_PIXEL = [re.compile(r'c(?P<col>\d+)r(?P<row>\d+)(?:_|$)'),
+          re.compile(r'r(?P<row>\d+)c(?P<col>\d+)(?:_|$)'),
+          re.compile(r'col(?P<col>\d+)_row(?P<row>\d+)')]
+_INJECTION_MV = re.compile(r'(?:^|_)(\d+(?:\.\d*)?)inj(?:_|$)')
+_INJECTION_V = re.compile(r'(?:^|_)(\d+(?:\.\d*)?)VInj(?:_|$)')
+_THRESHOLD = [re.compile(r'(?:^|_)(\d+(?:\.\d*)?)thr(?:_|$)'), re.compile(r'(?:^|_)(\d+(?:\.\d*)?)mVThresh(?:_|$)')]
+
+
+def parse_run_name(path: str) -> dict:
+    """
+    Run parameters in an output file name of the data taking scripts
+
+    :returns: Dict with name, started (%Y%m%d-%H%M%S), col, row, injection in mV and threshold in mV, None if not in the name
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    timestamp = _TIMESTAMP.search(stem)
+    name = stem[:timestamp.start()] if timestamp else stem
+    params = {'name': name.strip('_'), 'started': timestamp.group(1) if timestamp else None,
+              'col': None, 'row': None, 'injection': None, 'threshold': None}
+
+    for pattern in _PIXEL:
+        pixel = pattern.search(name)
+        if pixel:
+            params['col'], params['row'] = int(pixel.group('col')), int(pixel.group('row'))
+            break
+    injection = _INJECTION_MV.search(name)
+    if injection:
+        params['injection'] = float(injection.group(1))
+    elif _INJECTION_V.search(name):
+        params['injection'] = float(_INJECTION_V.search(name).group(1)) * 1000.
+    for pattern in _THRESHOLD:
+        threshold = pattern.search(name)
+        if threshold:
+            params['threshold'] = float(threshold.group(1))
+            break
+    return params
+
+
+def written_paths(writer) -> list:
+    """Files of an output writer, the file of every segment for a rotated output"""
+    return list(writer.paths) if isinstance(writer, SegmentWriter) else [writer.path]
+
+
+def _file_kind(path: str) -> str:
+    if '_offline.' in os.path.basename(path):
+        return 'decoded'
+    if path.endswith('_PPS.log'):
+        return 'filtered'
+    if path.endswith(RUN_HEADER_SUFFIX):
+        return 'header'
+    suffix = os.path.splitext(path)[1]
+    return {'.log': 'log', '.raw': 'log', '.yml': 'yml', '.yaml': 'yml', '.json': 'manifest'}.get(suffix, 'hits')
+
+
+class RunCatalog:
+    """SQLite catalog of the runs in a directory, see the module docstring"""
+
+    def __init__(self, path: str):
+        """
+        :param path: Output directory, the catalog is CATALOG_NAME in it, or the database file
+        """
+        self.path = os.path.join(path, CATALOG_NAME) if os.path.isdir(path) else path
+        self.directory = os.path.dirname(os.path.abspath(self.path))
+
+        # Several scripts may write to one directory, wait for their transactions
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA foreign_keys = ON')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version > CATALOG_VERSION:
+            raise ValueError(f"{self.path} has catalog version {version}, newer than {CATALOG_VERSION}")
+        with self._db:
+            self._db.executescript(_SCHEMA)
+            self._db.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+
+    def _relative(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.directory)
+
+    def path_of(self, relpath: str) -> str:
+        """Path of a file saved in the catalog"""
+        return os.path.normpath(os.path.join(self.directory, relpath))
+
+    def register(self, logs: list, files: list = (), script: str = None, hits: int = None, **params) -> int:
+        """
+        Add or update a run, its readouts, duration and configuration are read from the logs and their index
+
+        :param logs: Readout logs of the run, all segments of a rotated run in order
+        :param files: Further files of the run, e.g. hit files, yml, manifest
+        :param script: Data taking script
+        :param hits: Decoded hits, None if unknown
+        :param params: col, row, injection, threshold, chip_version, yaml, started, name, duration
+                       instead of the values from the file name and log header
+
+        :returns: Id of the run
+        """
+        logs = [logs] if isinstance(logs, str) else list(logs)
+        run = parse_run_name(logs[0])
+
+        readouts, first, last = 0, math.inf, -math.inf
+        for log in logs:
+            with RawReader(log) as reader:
+                readouts += len(reader)
+                times = reader.index['host_time']
+                if len(times) and not math.isnan(times[0]):
+                    first, last = min(first, float(times[0])), max(last, float(times[-1]))
+
+        # Parsed from the log header for runs without run header
+        header = read_run_header(logs[0])
+        config = {**header['config'], 'args': header['args']}
+        # Text of the arguments if the Namespace line of an old log header does not parse
+        args = header['args'] if isinstance(header['args'], dict) else {}
+        if run['col'] is None and isinstance(args.get('inject'), list) and len(args['inject']) == 2:
+            run['row'], run['col'] = args['inject']
+        if run['threshold'] is None and isinstance(args.get('threshold'), (int, float)):
+            run['threshold'] = float(args['threshold'])
+        run['chip_version'] = header['chip']['version'] if 'chip' in header else args.get('chipVer')
+        run['yaml'] = args.get('yaml')
+        # Logs indexed after the run have no host times
+        run['duration'] = last - first if first <= last else None
+        run.update(params)
+
+        row = {
+            **{name: run.get(name) for name in RUN_COLUMNS if name not in ('script', 'readouts', 'hits', 'log')},
+            'script':       script,
+            'readouts':     readouts,
+            'hits':         hits,
+            'log':          self._relative(logs[0]),
+            'config':       json.dumps(config, default=str),
+            'registered':   time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+        columns = ', '.join(row)
+        updates = ', '.join(f'{name} = excluded.{name}' for name in row if name not in ('log', 'hits', 'script'))
+        with self._db:
+            self._db.execute(f'INSERT INTO runs ({columns}) VALUES ({", ".join("?" * len(row))}) '
+                             f'ON CONFLICT(log) DO UPDATE SET {updates}, '
+                             'hits = coalesce(excluded.hits, hits), script = coalesce(excluded.script, script)',
+                             list(row.values()))
+            run_id = self._db.execute('SELECT id FROM runs WHERE log = ?', (row['log'],)).fetchone()[0]
+            self._add_files(run_id, list(logs) + list(files))
+        return run_id
+
+    def _add_files(self, run_id: int, paths: list, kind: str = None):
+        self._db.executemany('INSERT OR REPLACE INTO files (run_id, path, kind) VALUES (?, ?, ?)',
+                             [(run_id, self._relative(path), kind or _file_kind(path)) for path in paths])
+
+    def run_of(self, path: str) -> int:
+        """Id of the run a file belongs to, None if not in the catalog"""
+        found = self._db.execute('SELECT run_id FROM files WHERE path = ?', (self._relative(path),)).fetchone()
+        return None if found is None else found['run_id']
+
+    def add_files(self, log: str, paths: list, kind: str = None) -> int:
+        """
+        Add files to the run of a log, e.g. decoded outputs
+
+        :param kind: Kind of the files, by suffix if None
+
+        :returns: Id of the run, None if the log is not in the catalog
+        """
+        run_id = self.run_of(log)
+        if run_id is not None:
+            with self._db:
+                self._add_files(run_id, paths, kind)
+        return run_id
+
+    def find(self, **criteria) -> list:
+        """
+        Runs matching all criteria, ordered by start
+
+        :param criteria: Column of RUN_COLUMNS and its value, a list of values to match any of them
+
+        :returns: List of dicts with the columns of runs, config parsed
+        """
+        where, values = [], []
+        for name, value in criteria.items():
+            if name not in RUN_COLUMNS:
+                raise ValueError(f"Unknown run column {name}, use one of {RUN_COLUMNS}")
+            if isinstance(value, (list, tuple)):
+                where.append(f'{name} IN ({", ".join("?" * len(value))})')
+                values.extend(value)
+            elif value is None:
+                where.append(f'{name} IS NULL')
+            else:
+                where.append(f'{name} = ?')
+                values.append(value)
+        query = 'SELECT * FROM runs' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY started, id'
+
+        runs = [dict(row) for row in self._db.execute(query, values)]
+        for run in runs:
+            run['config'] = json.loads(run['config']) if run['config'] else {}
+        return runs
+
+    def files(self, run_id: int, kind: str = None) -> list:
+        """Paths of the files of a run, of one kind if given"""
+        query = 'SELECT path FROM files WHERE run_id = ?' + (' AND kind = ?' if kind else '') + ' ORDER BY path'
+        return [self.path_of(row['path']) for row in self._db.execute(query, (run_id, kind) if kind else (run_id,))]
+
+    def __len__(self) -> int:
+        return self._db.execute('SELECT count(*) FROM runs').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def count_hits(path: str) -> int:
+    """Hits in a file of a HitWriter, None if it cannot be read"""
+    if path.endswith('.csv'):
+        lines = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                lines += block.count(b'\n')
+        return max(lines - 1, 0)
+    try:
+        return len(read_hits(path))
+    except (ImportError, OSError, ValueError) as e: #pyarrow missing or file of a crashed run
+        logger.debug("Hits of %s not counted: %s", path, e)
+        return None
+
+
+def register_run(outdir: str, logs: list, files: list = (), **kwargs):
+    """
+    Register a finished run in the catalog of outdir, for the data taking scripts
+
+    Any error is logged only, the data of the run is on disk anyway and can be added with catalog_runs.py.
+
+    :param kwargs: script, hits and run parameters, see RunCatalog.register
+    """
+    try:
+        with RunCatalog(outdir) as catalog:
+            run_id = catalog.register(logs, files, **kwargs)
+        logger.info("Run %d registered in %s", run_id, os.path.join(outdir, CATALOG_NAME))
+    except Exception as e: # Never stops data taking, called before the connection is closed
+        logger.warning("Run not registered in the catalog of %s: %s", outdir, e)
+
+
+def register_files(log: str, paths: list, kind: str = None):
+    """
+    Add files to the run of a log in the catalog next to the log, e.g. decoded outputs, if there is a catalog
+
+    :param kind: Kind of the files, by suffix if None
+    """
+    path = os.path.join(os.path.dirname(log), CATALOG_NAME)
+    if not os.path.exists(path):
+        return
+    try:
+        with RunCatalog(path) as catalog:
+            if catalog.add_files(log, paths, kind) is None:
+                logger.debug("%s is not in %s, files not added", log, path)
+    except Exception as e:
+        logger.warning("Files not added to %s: %s", path, e)
@@ -0,0 +1,323 @@
+"""
+Event building and straight-line track fitting for AstroPix telescopes
+
+Hits of all telescope chips are sorted by time and split into events wherever two hits are
+more than window apart. Every chip is one layer at the z position given in the telescope
+section of the yml config. Per event and layer the hit with the largest ToT is used.
+Straight lines x(z) and y(z) are fitted to the layer hits of all events at once by least squares,
+from per event sums, without loops over events.
+
+Works on AstroPix 4 hits, AstroPix 3 pixel hits of modules.pixelreco and clusters of modules.clustering.
+"""
+
+import numpy as np
+
+from core.hitbatch import HitBatch
+from core.timestamps import TimestampUnwrapper
+
+import logging
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Pixel pitch per chip version in um
+PIXEL_PITCH_UM = {3: 500, 4: 500}
+
+# Columns of events, followed by residual columns per layer, see event_dtypes
+EVENT_DTYPES = {
+    'event':        np.uint32,
+    'time':         np.int64,
+    'duration':     np.int64,
+    'nhits':        np.uint16,
+    'nlayers':      np.uint8,
+    'x0_mm':        np.float64,
+    'tx':           np.float64,
+    'y0_mm':        np.float64,
+    'ty':           np.float64,
+    'chi2':         np.float64,
+    'ndf':          np.uint8,
+}
+
+
+def event_dtypes(nlayers: int) -> dict:
+    """
+    Event columns for a telescope of nlayers chips
+
+    Residuals res_x_<layer> and res_y_<layer> in mm are hit minus track, NaN without hit in the layer.
+    """
+    dtypes = dict(EVENT_DTYPES)
+    for layer in range(nlayers):
+        dtypes[f'res_x_{layer}'] = np.float64
+        dtypes[f'res_y_{layer}'] = np.float64
+    return dtypes
+
+
+def build_events(time: np.ndarray, window: int = 2) -> tuple:
+    """
+    Group hits into events
+
+    :param time: Monotonic time per hit, common to all chips
+    :param window: Hits further apart in time than window start a new event
+
+    :returns: Hit order sorted by time, event index per sorted hit
+    """
+    order = np.argsort(time, kind='stable')
+    t = np.asarray(time)[order]
+
+    new_event = np.ones(len(t), dtype=bool)
+    new_event[1:] = np.diff(t) > window
+
+    return order, np.cumsum(new_event) - 1
+
+
+def fit_lines(event: np.ndarray, z: np.ndarray, x: np.ndarray, nevents: int) -> tuple:
+    """
+    Least squares fit of x = x0 + tx * z per event
+
+    :param event: Event index per point, 0 to nevents - 1
+    :param z: z position per point
+    :param x: Measured position per point
+    :param nevents: Number of events
+
+    :returns: x0, tx per event, NaN if all points of an event have the same z
+    """
+    s0 = np.bincount(event, minlength=nevents).astype(np.float64)
+    sz = np.bincount(event, weights=z, minlength=nevents)
+    szz = np.bincount(event, weights=z * z, minlength=nevents)
+    sx = np.bincount(event, weights=x, minlength=nevents)
+    szx = np.bincount(event, weights=z * x, minlength=nevents)
+
+    det = s0 * szz - sz * sz
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tx = np.where(det != 0, (s0 * szx - sz * sx) / det, np.nan)
+        x0 = (sx - tx * sz) / s0
+
+    return x0, tx
+
+
+def fit_tracks(event: np.ndarray, layer: np.ndarray, row: np.ndarray, col: np.ndarray, time: np.ndarray,
+               tot_us: np.ndarray, layer_z: list, pitch_um: float = 500, min_layers: int = 3) -> HitBatch:
+    """
+    Fit straight tracks to hits grouped into events
+
+    :param event: Event index per hit, see build_events
+    :param layer: Telescope layer (chip ID) per hit
+    :param row: Row per hit, may be a cluster centroid
+    :param col: Column per hit, may be a cluster centroid
+    :param time: Monotonic time per hit
+    :param tot_us: ToT per hit, the largest ToT of an event and layer is fitted
+    :param layer_z: z position in mm per layer
+    :param pitch_um: Pixel pitch, x = col * pitch, y = row * pitch
+    :param min_layers: Events with hits in fewer layers are not fitted
+
+    :returns: HitBatch of fitted events with event_dtypes columns
+    """
+    nlayers = len(layer_z)
+    dtypes = event_dtypes(nlayers)
+
+    event = np.asarray(event, dtype=np.int64)
+    layer = np.asarray(layer, dtype=np.int64)
+    time = np.asarray(time, dtype=np.int64)
+    if not len(event):
+        return HitBatch.empty(dtypes)
+
+    nevents = int(event.max()) + 1
+    nhits = np.bincount(event, minlength=nevents)
+    start = np.full(nevents, np.iinfo(np.int64).max)
+    end = np.full(nevents, np.iinfo(np.int64).min)
+    np.minimum.at(start, event, time)
+    np.maximum.at(end, event, time)
+
+    # One point per event and layer, the first hit with the largest ToT
+    valid = np.flatnonzero(layer < nlayers)
+    if len(valid) < len(layer):
+        logger.warning("%d hits of chips without layer_z are not fitted", len(layer) - len(valid))
+    key = event[valid] * nlayers + layer[valid]
+    tot = np.asarray(tot_us, dtype=np.float64)[valid]
+    best_tot = np.full(nevents * nlayers, -np.inf)
+    np.maximum.at(best_tot, key, tot)
+    largest = tot == best_tot[key]
+    best = np.full(nevents * nlayers, len(layer))
+    np.minimum.at(best, key[largest], valid[largest])
+    # Sorted by event and layer
+    points = best[best < len(layer)]
+
+    e, lay = event[points], layer[points]
+    nlayers_hit = np.bincount(e, minlength=nevents)
+
+    fitted = np.flatnonzero(nlayers_hit >= max(min_layers, 2))
+    use = nlayers_hit[e] >= max(min_layers, 2)
+    points, lay = points[use], lay[use]
+    # Fitted events are numbered 0 to len(fitted) - 1
+    fe = np.searchsorted(fitted, e[use])
+
+    pitch_mm = pitch_um * 1e-3
+    z = np.asarray(layer_z, dtype=np.float64)[lay]
+    x = np.asarray(col, dtype=np.float64)[points] * pitch_mm
+    y = np.asarray(row, dtype=np.float64)[points] * pitch_mm
+
+    x0, tx = fit_lines(fe, z, x, len(fitted))
+    y0, ty = fit_lines(fe, z, y, len(fitted))
+
+    res_x = x - (x0[fe] + tx[fe] * z)
+    res_y = y - (y0[fe] + ty[fe] * z)
+
+    # Binary resolution of the pixel pitch
+    sigma2 = pitch_mm**2 / 12
+    chi2 = np.bincount(fe, weights=res_x**2 + res_y**2, minlength=len(fitted)) / sigma2
+    ndf = 2 * (nlayers_hit[fitted] - 2)
+
+    columns = {
+        'event':    fitted,
+        'time':     start[fitted],
+        'duration': end[fitted] - start[fitted],
+        'nhits':    np.minimum(nhits[fitted], np.iinfo(np.uint16).max),
+        'nlayers':  nlayers_hit[fitted],
+        'x0_mm':    x0,
+        'tx':       tx,
+        'y0_mm':    y0,
+        'ty':       ty,
+        'chi2':     chi2,
+        'ndf':      ndf,
+    }
+
+    residuals = np.full((2, nlayers, len(fitted)), np.nan)
+    residuals[0, lay, fe] = res_x
+    residuals[1, lay, fe] = res_y
+    for l in range(nlayers):
+        columns[f'res_x_{l}'] = residuals[0, l]
+        columns[f'res_y_{l}'] = residuals[1, l]
+
+    return HitBatch(columns, dtypes)
+
+
+class EventBuilder:
+    """
+    Build events and fit tracks of consecutive decoded readouts
+
+    Events which could still get hits of the next readout are kept until the next call.
+    Accepts AstroPix 4 hits (columns id, row, col, ts_dec1), AstroPix 3 pixel hits
+    (Chip ID, row, col, time, tot_us) and clusters (Chip ID, row, col, time, tot_us_sum).
+    """
+
+    def __init__(self, layer_z: list, window: int = 2, min_layers: int = 3, pitch_um: float = 500,
+                 time_column: str = None):
+        """
+        :param layer_z: z position in mm per telescope chip, see Asic.layer_z
+        :param window: Maximum time between hits of an event, in units of time_column
+        :param min_layers: Events with hits in fewer layers are not fitted
+        :param pitch_um: Pixel pitch, see PIXEL_PITCH_UM
+        :param time_column: Monotonic time of the hits, common to all chips. Default: 'time' of pixel hits
+            and clusters, 'chiptime' if decoded with it or AstroPix 4 ts_dec1 unwrapped in stream order
+        """
+        self.layer_z = list(layer_z)
+        self.window = window
+        self.min_layers = min_layers
+        self.pitch_um = pitch_um
+        self.time_column = time_column
+
+        self._unwrapper = TimestampUnwrapper(4, sampleclock_period_ns=1, ts_period_ns=1)
+        self.reset()
+
+    @property
+    def dtypes(self) -> dict:
+        """Columns of the returned events"""
+        return event_dtypes(len(self.layer_z))
+
+    def reset(self):
+        """Start a new run"""
+        self._unwrapper.reset()
+        self._pending = None
+        self._next_event = 0
+        self.events = 0
+        self.tracks = 0
+
+    def _hits(self, hits: HitBatch) -> dict:
+        """Columns needed for event building"""
+        time_column = self.time_column
+        if time_column is None:
+            time_column = next((name for name in ('time', 'chiptime') if name in hits), None)
+
+        if time_column is None:
+            time = self._unwrapper.unwrap(hits['ts_dec1'])
+        else:
+            time = np.asarray(hits[time_column], dtype=np.int64)
+
+        tot = hits['tot_us_sum'] if 'tot_us_sum' in hits else hits['tot_us']
+
+        return {
+            'layer':    np.asarray(hits['Chip ID'] if 'Chip ID' in hits else hits['id'], dtype=np.int64),
+            'row':      np.asarray(hits['row'], dtype=np.float64),
+            'col':      np.asarray(hits['col'], dtype=np.float64),
+            'time':     time,
+            'tot_us':   np.asarray(tot, dtype=np.float64),
+        }
+
+    def add(self, hits: HitBatch) -> HitBatch:
+        """
+        Build events of the next readout
+
+        :returns: HitBatch of fitted events with event_dtypes columns
+        """
+        data = self._hits(hits)
+        if self._pending is not None:
+            data = {key: np.concatenate([self._pending[key], value]) for key, value in data.items()}
+
+        if not len(data['time']):
+            return HitBatch.empty(self.dtypes)
+
+        order, event = build_events(data['time'], self.window)
+        data = {key: value[order] for key, value in data.items()}
+
+        # The last event can get hits of the next readout
+        hold = event == event[-1]
+        self._pending = {key: value[hold] for key, value in data.items()}
+
+        done = ~hold
+        return self._fit({key: value[done] for key, value in data.items()}, event[done])
+
+    def flush(self) -> HitBatch:
+        """Fit the events kept from the last readout, at the end of a run"""
+        if self._pending is None or not len(self._pending['time']):
+            self._pending = None
+            return HitBatch.empty(self.dtypes)
+
+        data, self._pending = self._pending, None
+        _, event = build_events(data['time'], self.window)
+        return self._fit(data, event)
+
+    def _fit(self, data: dict, event: np.ndarray) -> HitBatch:
+        """Fit hits sorted by event"""
+        if not len(event):
+            return HitBatch.empty(self.dtypes)
+
+        tracks = fit_tracks(event, data['layer'], data['row'], data['col'], data['time'], data['tot_us'],
+                            self.layer_z, self.pitch_um, self.min_layers)
+
+        # Event numbers continue over the run
+        nevents = int(event[-1]) + 1
+        tracks.columns['event'] += self._next_event
+        self._next_event += nevents
+        self.events += nevents
+        self.tracks += len(tracks)
+
+        return tracks
+
+    def __str__(self) -> str:
+        return f"{self.tracks} tracks fitted in {self.events} events"
+
+
+def reconstruct_tracks(hits: HitBatch, layer_z: list, window: int = 2, min_layers: int = 3,
+                       pitch_um: float = 500, time_column: str = None) -> HitBatch:
+    """
+    Build events and fit tracks of a whole run, see EventBuilder
+
+    :param hits: Hits of all chips in stream order, e.g. HitBuffer.to_batch()
+
+    :returns: HitBatch with event_dtypes columns
+    """
+    builder = EventBuilder(layer_z, window, min_layers, pitch_um, time_column)
+    tracks = HitBatch.concat([builder.add(hits), builder.flush()], builder.dtypes)
+    logger.info("Tracking: %s", builder)
+    return tracks
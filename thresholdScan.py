@@ -17,6 +17,9 @@ import time
 import logging
 import argparse
 
+from modules.rawdata import open_readout_log
+from modules.rotation import OutputRotation
+from modules.runcatalog import register_run, written_paths
 from modules.setup_logger import logger
 
 
@@ -70,11 +73,12 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
     astro.write_conf_to_yaml(ymlpathout)
     # And here for the text files/logs
     bitpath = outdir + pathdelim + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # Writes all the config information to the file, as text log or with --binary as raw file
+    # Long runs are split into segments listed in a manifest, see modules/rotation.py
+    rotation = OutputRotation(bitpath, max_bytes=args.rotateMB and args.rotateMB * 1e6,
+                              max_seconds=args.rotateMinutes and args.rotateMinutes * 60.)
+    bitfile = rotation.add(bitpath, lambda segpath: open_readout_log(segpath, astro.get_log_header() + str(args) + "\n",
+                           binary=args.binary, config=vars(args), run_header=astro.get_run_header(args)), log=True)
 
     try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly    
         while (True): # Loop continues 
@@ -84,8 +88,8 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
             readout = astro.get_readout()
             
             if readout: # Checks if hits are present
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
+                # Writes the readout to the log
+                bitfile.write(i, readout, time.time())
                 #print(binascii.hexlify(readout))
                 i += 1
                 astro.asic_update() #must be done after every interrupt check
@@ -103,6 +107,10 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
         interrfile.write(f"{r} \t {i} \n")
         interrfile.close()
         bitfile.close() # Close open file       
+        rotation.close() # Completes the manifest of a rotated run
+        # Adds the run to the catalog of the output directory, see modules/runcatalog.py
+        register_run(outdir, written_paths(bitfile), [ymlpathout] + ([rotation.manifest] if rotation.enabled else []),
+                     script='thresholdScan.py', col=col, row=row, threshold=args.threshold)
         if fpgaDiscon:
             astro.close_connection() # Closes SPI
             logger.info('FPGA Connection ended')
@@ -139,7 +147,15 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rowrange', action='store', default=[0,34], type=int, nargs=2,
                     help =  'Loop over given range of rows. Default: 0 34')
 
-    parser.add_argument
+    parser.add_argument('--binary', action='store_true', default=False, required=False,
+                    help='Save readouts as binary raw file (.raw) instead of text log, see convert_raw.py. Default: False')
+
+    parser.add_argument('--rotateMB', type=float, default=None, required=False,
+                    help='Start a new readout log when it reaches this size in MB, segments are listed in a manifest. Default: no rotation')
+
+    parser.add_argument('--rotateMinutes', type=float, default=None, required=False,
+                    help='Start a new readout log after this many minutes, segments are listed in a manifest. Default: no rotation')
+
     args = parser.parse_args()
     
     # Logging
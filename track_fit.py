@@ -0,0 +1,110 @@
+"""
+Build telescope events and fit straight tracks to decoded hits of all chips, after data-taking.
+Input is a CSV written by beam_test.py with -c: AstroPix 4 hits, AstroPix 3 pixel hits (_pixels.csv, --pixels)
+or clusters (_clusters.csv, --clusters). Events with fit parameters and residuals per layer are saved in CSV format.
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from core.asic import Asic
+from core.hitbatch import HitBatch
+from modules.tracking import EventBuilder, PIXEL_PITCH_UM
+
+from modules.setup_logger import logger
+
+
+def main(args):
+
+    #Layer positions from the telescope section of the yml, unless given on the command line
+    if args.layer_z is not None:
+        layer_z = args.layer_z
+    else:
+        asic = Asic(None, None)
+        asic.load_conf_from_yaml(args.chipVer, f"config/{args.yaml}.yml")
+        layer_z = asic.layer_z
+        if layer_z is None:
+            logger.error("No telescope layer_z in config/%s.yml, add it or use --layer_z", args.yaml)
+            exit()
+
+    logger.info("Fitting tracks through %d layers at z = %s mm", len(layer_z), layer_z)
+
+    frame = pd.read_csv(args.fileInput)
+    hits = HitBatch({name: frame[name].to_numpy() for name in frame.columns})
+
+    pitch_um = args.pitch if args.pitch is not None else PIXEL_PITCH_UM[args.chipVer]
+    builder = EventBuilder(layer_z, window=args.window, min_layers=args.minLayers, pitch_um=pitch_um)
+    tracks = HitBatch.concat([builder.add(hits), builder.flush()], builder.dtypes)
+    logger.info(f"Tracking: {builder}")
+
+    #Save csv
+    outpath = args.outFile if args.outFile is not None else args.fileInput[:-4] + '_tracks.csv'
+    trackframe = tracks.to_dataframe()
+    trackframe.index.name = "track"
+    logger.info(f"Saving to {outpath}")
+    trackframe.to_csv(outpath)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Telescope event building and track fitting')
+    parser.add_argument('-f', '--fileInput', required=True,
+                    help='Input CSV of decoded hits, pixel hits or clusters of all chips')
+
+    parser.add_argument('-o', '--outFile', default=None, required=False,
+                    help='Output CSV. Defaults to the input file name ending in _tracks.csv')
+
+    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig',
+                    help = 'filepath (in config/ directory) .yml file containing the telescope section with layer_z. Default: config/testconfig_v3.yml (AstroPix 3)')
+
+    parser.add_argument('-V', '--chipVer', default=3, required=False, type=int,
+                    help='Chip version - provide an int')
+
+    parser.add_argument('-z', '--layer_z', nargs='+', type=float, default=None, required=False,
+                    help='z position in mm of every chip, overrides layer_z of the yml')
+
+    parser.add_argument('-w', '--window', type=int, default=2, required=False,
+                    help='Maximum time between hits of an event, in units of the time column. Default: 2')
+
+    parser.add_argument('-m', '--minLayers', type=int, default=3, required=False,
+                    help='Minimum number of layers with a hit to fit a track. Default: 3')
+
+    parser.add_argument('--pitch', type=float, default=None, required=False,
+                    help='Pixel pitch in um. Default: pitch of the chip version')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
+
+    args = parser.parse_args()
+
+    #Default yml of the chip version, as in beam_test.py
+    if args.yaml == 'testconfig':
+        args.yaml = f"testconfig_v{args.chipVer}"
+
+    # Sets the loglevel
+    ll = args.loglevel
+    if ll == 'D':
+        loglevel = logging.DEBUG
+    elif ll == 'I':
+        loglevel = logging.INFO
+    elif ll == 'E':
+        loglevel = logging.ERROR
+    elif ll == 'W':
+        loglevel = logging.WARNING
+    elif ll == 'C':
+        loglevel = logging.CRITICAL
+
+    # Logging - print to terminal only
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
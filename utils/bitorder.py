@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Bit order reversal of bytes, shared by decoding and SPI write paths
+"""
+
+import numpy as np
+
+# Bit order reversed value of every byte, to be used with bytes.translate
+BITREVERSE_TABLE = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+# Same table as uint8 array, to be used as NumPy gather BITREVERSE_LUT[array]
+BITREVERSE_LUT = np.frombuffer(BITREVERSE_TABLE, dtype=np.uint8)
+
+
+def reverse_bitorder(data) -> bytes:
+    """
+    Reverse bit order of every byte in one C-level call
+
+    :param data: bytes, bytearray or list of ints
+
+    :returns: Reversed bytes
+    """
+    return bytes(data).translate(BITREVERSE_TABLE)